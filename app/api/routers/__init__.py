@@ -15,6 +15,8 @@ from app.api.routers import (
     admin,
     news,
     testing,
+    stream,
+    uploads,
 )
 
 # Основной роутер для API v1
@@ -28,6 +30,7 @@ public_routers = [
     (tasks.router, ["tasks"]),
     (news.router, ["news"]),
     (admin.router, ["admin"]),
+    (uploads.router, ["uploads"]),
 ]
 
 # Роутеры, которые требуют защиты App Check (опционально)
@@ -48,6 +51,7 @@ for router, tags in protected_routers:
 # WebSockets не могут отправлять кастомные заголовки во время рукопожатия
 api_router.include_router(notifications.router, tags=["websocket"])
 api_router.include_router(chat.router, tags=["chat"])
+api_router.include_router(stream.router, tags=["websocket"])
 api_router.include_router(testing.router, tags=["testing"])
 
 __all__ = ["api_router"]
\ No newline at end of file
@@ -7,7 +7,8 @@ import uuid
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select, delete, desc
 from sqlalchemy.orm import selectinload
-from app.utils import storage
+from loguru import logger
+from app.utils import aiofile, storage
 
 from app.models.users import User as UserModel, AdminPermission as AdminPermissionModel, PhotoAlbum as PhotoAlbumModel, AppVersion as AppVersionModel
 from app.models.categories import Category as CategoryModel
@@ -22,6 +23,12 @@ from app.schemas.news import News as NewsSchema
 from app.schemas.chat import ChatMessageResponse, DialogResponse, UploadInitRequest, UploadSessionResponse, UploadStatusResponse
 from app.schemas.orders import Order as OrderSchema
 from app.api.dependencies import get_async_db
+from app.services import chat_cache
+from app.services.chat_dialogs import refresh_dialog_pair
+from app.services.uploads import (
+    UploadKind, register_kind, get_metadata, create_session, load_session, receive, iter_upload_file, UploadConflict,
+    UploadSizeError
+)
 from app.core.auth import get_current_owner, get_current_admin, check_admin_permission
 
 router = APIRouter(prefix="/admin", tags=["admin"])
@@ -158,7 +165,7 @@ async def upload_app_version(
         filename = f"app_v{safe_version}{file_extension}"
 
         # Сохраняем через абстракцию хранилища (S3 или локально)
-        url, _ = storage.save_file(
+        url, _ = await aiofile.save_file(
             category="app",
             filename_hint=filename,
             fileobj=file.file,  # UploadFile.file — уже файловый объект
@@ -187,18 +194,13 @@ async def init_app_upload(
     db: AsyncSession = Depends(get_async_db)
 ):
     """Инициализирует сессию загрузки новой версии приложения (только владелец)."""
-    upload_id = str(uuid.uuid4())
-    session = FileUploadSession(
-        id=upload_id,
-        user_id=owner.id,
-        filename=req.filename,
-        file_size=req.file_size,
-        mime_type=req.mime_type,
-    )
-    db.add(session)
+    try:
+        session = await create_session(db, owner.id, req.filename, req.file_size, req.mime_type, kind="app")
+    except UploadSizeError as e:
+        raise HTTPException(status_code=413, detail=str(e))
     await db.commit()
     # Возвращаем 1МБ как чанк сайз по умолчанию, как в чате
-    return {"upload_id": upload_id, "offset": 0, "chunk_size": 1024 * 1024}
+    return {"upload_id": session.id, "offset": 0, "chunk_size": 1024 * 1024}
 
 @router.post("/upload-app/chunk/{upload_id}")
 async def upload_app_chunk(
@@ -239,8 +241,7 @@ async def upload_app_chunk(
 
     user_id = user.id
 
-    res = await db.execute(select(FileUploadSession).where(FileUploadSession.id == upload_id))
-    session = res.scalar_one_or_none()
+    session = await load_session(db, upload_id)
     
     if not session or session.user_id != user_id:
         raise HTTPException(status_code=404, detail="Upload session not found")
@@ -251,44 +252,31 @@ async def upload_app_chunk(
     if actual_offset != session.offset:
         return {"status": "error", "message": "Offset mismatch", "current_offset": session.offset}
 
-    # Путь к временному файлу
-    root_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-    temp_dir = os.path.join(root_dir, "media", "temp")
-    os.makedirs(temp_dir, exist_ok=True)
-    file_path = os.path.join(temp_dir, f"{upload_id}_{session.filename}")
-    
-    # Записываем чанк
-    mode = "ab" if actual_offset > 0 else "wb"
-    with open(file_path, mode) as f:
-        content = await chunk.read()
-        f.write(content)
-        session.offset += len(content)
-    
-    if session.offset >= session.file_size:
-        session.is_completed = True
-        session.offset = session.file_size
-        # Загружаем собранный файл в постоянное хранилище
-        with open(file_path, "rb") as f_in:
-            url, _ = storage.save_file(
-                category="app",
-                filename_hint=session.filename,
-                fileobj=f_in,
-                content_type=session.mime_type or "application/octet-stream",
-                private=False,
-            )
-        try:
-            os.remove(file_path)
-        except Exception:
-            pass
-            
-        await db.commit()
-        return {
-            "status": "completed",
-            "file_path": url
-        }
-    
+    try:
+        return await receive(db, session, actual_offset, iter_upload_file(chunk))
+    except UploadConflict as e:
+        return {"status": "error", "message": "Offset mismatch", "current_offset": e.offset}
+    except Exception as e:
+        logger.error(f"Error storing app upload chunk {upload_id}: {e}")
+        raise HTTPException(status_code=500, detail=f"Failed to store upload: {str(e)}")
+
+async def _on_app_upload_completed(db: AsyncSession, session: FileUploadSession, url: str) -> dict:
+    """
+    APK загружен. Legacy-клиент регистрирует версию отдельным запросом /upload-app с file_path,
+    tus-клиент может передать version в Upload-Metadata - тогда версия создается сразу.
+    """
+    version = get_metadata(session).get("version")
+    if version:
+        db.add(AppVersionModel(version=version, file_path=url))
     await db.commit()
-    return {"status": "ok", "offset": session.offset}
+    return {}
+
+register_kind("app", UploadKind(
+    category="app",
+    on_complete=_on_app_upload_completed,
+    authorize=lambda user: user.role == "owner",
+    keep_filename=True
+))
 
 @router.get("/upload-app/status/{upload_id}", response_model=UploadStatusResponse)
 async def get_app_upload_status(
@@ -297,8 +285,7 @@ async def get_app_upload_status(
     db: AsyncSession = Depends(get_async_db)
 ):
     """Возвращает статус загрузки файла приложения."""
-    res = await db.execute(select(FileUploadSession).where(FileUploadSession.id == upload_id))
-    session = res.scalar_one_or_none()
+    session = await load_session(db, upload_id)
     
     if not session or session.user_id != owner.id:
         raise HTTPException(status_code=404, detail="Upload session not found")
@@ -387,8 +374,17 @@ async def admin_delete_message(
     db: AsyncSession = Depends(get_async_db)
 ):
     """Удаляет сообщение (полностью из базы)."""
-    await db.execute(delete(ChatMessageModel).where(ChatMessageModel.id == message_id))
+    result = await db.execute(
+        delete(ChatMessageModel)
+        .where(ChatMessageModel.id == message_id)
+        .returning(ChatMessageModel.sender_id, ChatMessageModel.receiver_id)
+    )
+    dialogs = set(result.all())
+    for sender_id, receiver_id in dialogs:
+        await refresh_dialog_pair(db, sender_id, receiver_id)
     await db.commit()
+    for sender_id, receiver_id in dialogs:
+        await chat_cache.invalidate(sender_id, receiver_id)
     return {"message": "Message deleted"}
 
 @router.delete("/chats/messages")
@@ -398,8 +394,17 @@ async def admin_bulk_delete_messages(
     db: AsyncSession = Depends(get_async_db)
 ):
     """Удаляет несколько сообщений (полностью из базы)."""
-    await db.execute(delete(ChatMessageModel).where(ChatMessageModel.id.in_(message_ids)))
+    result = await db.execute(
+        delete(ChatMessageModel)
+        .where(ChatMessageModel.id.in_(message_ids))
+        .returning(ChatMessageModel.sender_id, ChatMessageModel.receiver_id)
+    )
+    dialogs = set(result.all())
+    for sender_id, receiver_id in dialogs:
+        await refresh_dialog_pair(db, sender_id, receiver_id)
     await db.commit()
+    for sender_id, receiver_id in dialogs:
+        await chat_cache.invalidate(sender_id, receiver_id)
     return {"message": f"Deleted {len(message_ids)} messages"}
 
 # Пример для категорий
@@ -4,72 +4,149 @@ import asyncio
 import os
 import uuid
 import io
+from functools import partial
 from datetime import datetime, timedelta
 from PIL import Image
 from fastapi import APIRouter, WebSocket, WebSocketDisconnect, Depends, UploadFile, File, Form, HTTPException, Query
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, or_, and_, func, update
-from sqlalchemy.orm import joinedload
+from sqlalchemy import select, or_, and_, func, update, tuple_, union_all
+from sqlalchemy.orm import joinedload, selectinload
 import jwt
 
-from app.core.config import SECRET_KEY, ALGORITHM
+from app.core.config import SECRET_KEY, ALGORITHM, CHAT_HISTORY_CACHE_SIZE
 from app.api.dependencies import get_async_db
-from app.models.chat import ChatMessage, FileUploadSession
+from app.database import async_session_maker
+from app.core.metrics import WS_FRAME_SECONDS, CHAT_HISTORY_CACHE_REQUESTS
+from app.models.chat import ChatMessage, ChatAttachment, FileUploadSession, ChatDialog
 from app.models.users import User as UserModel
 from app.schemas.chat import (
     ChatMessageCreate, ChatMessageResponse, DialogResponse, 
     UploadInitRequest, UploadSessionResponse, UploadStatusResponse,
-    BulkDeleteMessagesRequest
+    BulkDeleteMessagesRequest, ChatHistoryPage, ChatSearchPage
 )
 from app.api.routers.notifications import manager as notifications_manager
 from app.core.fcm import send_fcm_notification
 from app.core.auth import get_current_user, get_current_user_optional
+from app.core.ws import WebSocketManager, encode_event, coalescer, accept, send_event, receive_event
 from loguru import logger
-from app.utils import storage
+from app.utils import aiofile, storage
+from app.services import unread, presence, chat_cache, chat_attachments, chat_archive, chat_compaction
+from app.services import chat as chat_service
+from app.services.chat import cache_sent_message
+from app.services.chat_attachments import attachment_items
+from app.services.chat_cache import history_item, visible_to
+from app.services.uploads import (
+    UploadKind, register_kind, remember_upload, forget_upload, get_upload_target, get_metadata, resolve_upload_type,
+    create_session, load_session, get_offsets, receive, terminate, iter_upload_file, UploadConflict, UploadSizeError
+)
+from app.services.chat_search import search_messages as search_chat_messages
+from app.services.chat_dialogs import touch_dialogs, refresh_dialog, refresh_dialog_pair, mark_dialog_read, get_read_watermarks, is_read_by_receiver
 
 router = APIRouter(prefix="/chat", tags=["chat"])
 
-class ChatManager:
-    def __init__(self):
-        # user_id -> list of websockets
-        self.active_connections: Dict[int, List[WebSocket]] = {}
+class ChatManager(WebSocketManager):
+    namespace = "chat"
+    log_name = "ChatManager"
 
-    async def connect(self, websocket: WebSocket, user_id: int):
-        if user_id not in self.active_connections:
-            self.active_connections[user_id] = []
-        self.active_connections[user_id].append(websocket)
-        logger.debug(f"ChatManager: User {user_id} connected. Sockets: {len(self.active_connections[user_id])}")
+manager = ChatManager()
 
-    def disconnect(self, websocket: WebSocket, user_id: int):
-        if user_id in self.active_connections:
-            try:
-                self.active_connections[user_id].remove(websocket)
-                if not self.active_connections[user_id]:
-                    del self.active_connections[user_id]
-                logger.debug(f"ChatManager: User {user_id} disconnected. Sockets: {len(self.active_connections.get(user_id, []))}")
-            except ValueError:
-                pass
-
-    async def send_personal_message(self, message: dict, user_id: int):
-        if user_id in self.active_connections:
-            logger.debug(f"ChatManager: Sending message to user {user_id} (Connections: {len(self.active_connections[user_id])})")
-            tasks = [connection.send_json(message) for connection in self.active_connections[user_id]]
-            results = await asyncio.gather(*tasks, return_exceptions=True)
-            for i, result in enumerate(results):
-                if isinstance(result, Exception):
-                    logger.error(f"ChatManager: Failed to send to user {user_id}: {result}")
-                    # Remove broken connection
-                    try:
-                        self.active_connections[user_id].pop(i)
-                    except:
-                        pass
-            
-            if user_id in self.active_connections and not self.active_connections[user_id]:
-                del self.active_connections[user_id]
-        else:
-            logger.debug(f"ChatManager: User {user_id} NOT found in active connections.")
+async def bump_unread(msg: ChatMessage):
+    """Увеличивает счетчик непрочитанных получателя в Redis и отправляет ему новый бейдж."""
+    receiver_id, sender_id = int(msg.receiver_id), int(msg.sender_id)
+    if receiver_id == sender_id:
+        return
+    badge = await unread.increment_unread(receiver_id, sender_id)
+    if badge:
+        await notifications_manager.send_personal_message({"type": "unread_counts", "data": badge}, receiver_id)
+
+def _fcm_body(message_type: str, content: Optional[str], duration: Optional[float]) -> str:
+    def format_duration(seconds):
+        if seconds is None: return ""
+        minutes = int(seconds // 60)
+        remaining_seconds = int(seconds % 60)
+        return f" ({minutes}:{remaining_seconds:02d})"
+
+    if message_type == "video_note":
+        return f"📹 Видеосообщение{format_duration(duration)}"
+    elif message_type == "audio":
+        return f"🎤 Голосовое сообщение{format_duration(duration)}"
+    elif message_type == "image":
+        return "🖼️ Фотография"
+    elif message_type == "file":
+        return "📁 Файл"
+    return content if content else f"Отправил {message_type}"
+
+async def deliver_sent_message(
+    sent: chat_service.SentMessage,
+    sender_name: str,
+    sender_avatar: Optional[str]
+) -> dict:
+    """Рассылает new_message обоим участникам, обновляет бейдж и отправляет FCM, если у получателя есть токен."""
+    msg = sent.message
+    user_id, receiver_id = msg.sender_id, msg.receiver_id
+    if sent.created:
+        await bump_unread(msg)
 
-manager = ChatManager()
+    # Готовим данные ответа
+    response_data = {
+        "id": msg.id,
+        "client_id": msg.client_id,  # Возвращаем client_id для фронтенда
+        "sender_id": user_id,
+        "sender_name": sender_name,
+        "receiver_id": receiver_id,
+        "message": msg.message,
+        "file_path": msg.file_path,
+        "message_type": msg.message_type,
+        "duration": msg.duration,
+        "reply_to_id": msg.reply_to_id,
+        "reply_to": sent.reply_to,
+        "timestamp": msg.timestamp.isoformat(),
+        "is_read": 0
+    }
+    # Вложения с метаданными (размер, размеры кадра, длительность) - клиент размечает медиа до скачивания
+    attachments = attachment_items(msg)
+    if attachments is not None:
+        response_data["attachments"] = attachments
+
+    # Рассылаем сообщения всем участникам параллельно для минимальной задержки
+    frame = encode_event({"type": "new_message", "data": response_data})
+    await asyncio.gather(
+        manager.send_personal_message(frame, receiver_id),
+        manager.send_personal_message(frame, user_id),
+        notifications_manager.send_personal_message(frame, receiver_id, stream=False),
+        notifications_manager.send_personal_message(frame, user_id, stream=False),
+        return_exceptions=True
+    )
+
+    # Пуш через FCM: токен получателя прочитан вместе с сообщением (chat_service.send)
+    if sent.receiver_fcm_token:
+        logger.info(f"FCM: Triggering notification for receiver {receiver_id} with token {sent.receiver_fcm_token[:15]}...")
+        asyncio.create_task(send_fcm_notification(
+            token=sent.receiver_fcm_token,
+            title=sender_name,
+            body=_fcm_body(msg.message_type, msg.message, msg.duration),
+            sender_id=user_id,
+            sender_avatar=sender_avatar,
+            data={
+                "chat_id": str(user_id),
+                "message_id": str(msg.id)
+            }
+        ))
+    else:
+        logger.debug(f"FCM: Skipping notification for receiver {receiver_id}. No token found.")
+    return response_data
+
+async def _sync_deleted_messages(messages: List[ChatMessage], cleared_dialogs: set) -> None:
+    """Флаги удаления - в буфер истории; диалоги из cleared_dialogs (sender_id, receiver_id) сбрасываются целиком."""
+    cleared = {chat_cache.dialog_id(a, b) for a, b in cleared_dialogs}
+    for msg in messages:
+        if chat_cache.dialog_id(msg.sender_id, msg.receiver_id) not in cleared:
+            await chat_cache.patch(msg.sender_id, msg.receiver_id, msg.id, {
+                "deleted_by_sender": msg.deleted_by_sender,
+                "deleted_by_receiver": msg.deleted_by_receiver
+            })
+    for sender_id, receiver_id in cleared_dialogs:
+        await chat_cache.invalidate(sender_id, receiver_id)
 
 async def get_user_from_token(token: str, db: AsyncSession):
     try:
@@ -92,701 +169,517 @@ async def get_user_from_token(token: str, db: AsyncSession):
     except Exception:
         return None
 
-@router.websocket("/ws/{token}")
-async def websocket_chat_endpoint(
-    websocket: WebSocket,
-    token: str,
-    db: AsyncSession = Depends(get_async_db)
-):
-    # Accept immediately to avoid handshake rejection issues
-    await websocket.accept()
-    
-    # Clean token (remove potential quotes if passed incorrectly)
-    token = token.strip().strip('"').strip("'")
-
-    user = await get_user_from_token(token, db)
-    if user is None:
-        logger.warning(f"Chat WS rejected: invalid token {token[:10]}...")
-        await websocket.close(code=4003)
-        return
-        
+async def handle_chat_frame(websocket: WebSocket, db: AsyncSession, user: UserModel, message_data: dict):
+    """
+    Обрабатывает один входящий кадр чат-сокета.
+    Сессия БД передается на время обработки кадра и закрывается сразу после нее.
+    """
     user_id = user.id
-    await manager.connect(websocket, user_id)
-
-    # Fetch sender info once for the session
     sender_name = f"{user.first_name} {user.last_name}".strip() if (user.first_name or user.last_name) else "Пользователь"
     if not sender_name: sender_name = "Пользователь"
     sender_avatar = user.avatar_url
-
-    try:
-        while True:
-            data = await websocket.receive_text()
+    msg_type = message_data.get("type", "message")
+    
+    if msg_type == "get_dialogs":
+        from app.api.routers.chat import get_dialogs as fetch_dialogs_api
+        try:
+            dialogs_list = await fetch_dialogs_api(db=db, current_user=user)
+            # datetime кодируется при отправке: ISO-строка в JSON, миллисекунды в msgpack
+            logger.info(f"Sending WS dialogs to user {user_id}, count: {len(dialogs_list)}")
+            await send_event(websocket, {
+                "type": "dialogs_list",
+                "data": dialogs_list
+            })
+        except Exception as e:
+            logger.error(f"WS get_dialogs error: {e}")
+        return
+    
+    if msg_type == "get_history":
+        other_user_id = message_data.get("other_user_id")
+        limit = message_data.get("limit", 15)
+        skip = message_data.get("skip", 0)
+        before_id = message_data.get("before_id")
+        before_ts = message_data.get("before_ts")
+        if other_user_id:
             try:
-                message_data = json.loads(data)
-            except json.JSONDecodeError as e:
-                logger.error(f"Chat WS JSON error: {e}, data={data[:100]}")
-                continue
-            
-            # Обработка разных типов сообщений через WebSocket
-            msg_type = message_data.get("type", "message")
-            
-            if msg_type == "ping":
-                await websocket.send_json({"type": "pong"})
-                continue
-            
-            if msg_type == "get_dialogs":
-                from app.api.routers.chat import get_dialogs as fetch_dialogs_api
-                try:
-                    dialogs_list = await fetch_dialogs_api(db=db, current_user=user)
-                    # Конвертируем datetime в ISO формат для JSON
-                    processed_dialogs = []
-                    for d in dialogs_list:
-                        d_dict = dict(d) if not isinstance(d, dict) else d.copy()
-                        if isinstance(d_dict.get("last_message_time"), datetime):
-                            d_dict["last_message_time"] = d_dict["last_message_time"].isoformat()
-                        processed_dialogs.append(d_dict)
-
-                    logger.info(f"Sending WS dialogs to user {user_id}, count: {len(processed_dialogs)}")
-                    await websocket.send_json({
-                        "type": "dialogs_list",
-                        "data": processed_dialogs
-                    })
-                except Exception as e:
-                    logger.error(f"WS get_dialogs error: {e}")
-                continue
-            
-            if msg_type == "get_history":
-                other_user_id = message_data.get("other_user_id")
-                limit = message_data.get("limit", 15)
-                skip = message_data.get("skip", 0)
-                if other_user_id:
-                    from app.api.routers.chat import get_chat_history as fetch_history_api
-                    try:
-                        history = await fetch_history_api(other_user_id=int(other_user_id), limit=limit, skip=skip, db=db, current_user=user)
-                        # Конвертируем datetime в ISO формат для JSON
-                        processed_history = []
-                        for m in history:
-                            m_dict = dict(m) if not isinstance(m, dict) else m.copy()
-                            if isinstance(m_dict.get("timestamp"), datetime):
-                                m_dict["timestamp"] = m_dict["timestamp"].isoformat()
-                            processed_history.append(m_dict)
-                        
-                        logger.info(f"Sending WS history to user {user_id} for partner {other_user_id}, count: {len(processed_history)}")
-                        await websocket.send_json({
-                            "type": "chat_history",
-                            "other_user_id": int(other_user_id),
-                            "data": processed_history,
-                            "skip": skip
-                        })
-                    except Exception as e:
-                        logger.error(f"WS get_history error: {e}")
-                continue
-                
-            logger.debug(f"Chat WS received message type '{msg_type}' from user {user_id}")
-
-            if msg_type == "search_messages":
-                other_user_id = message_data.get("other_user_id")
-                query = message_data.get("query", "").lower()
-                if other_user_id and query:
-                    try:
-                        stmt = select(ChatMessage).where(
-                            or_(
-                                and_(ChatMessage.sender_id == user_id, ChatMessage.receiver_id == int(other_user_id)),
-                                and_(ChatMessage.sender_id == int(other_user_id), ChatMessage.receiver_id == user_id)
-                            ),
-                            or_(
-                                func.lower(ChatMessage.message).contains(query),
-                                func.lower(ChatMessage.file_path).contains(query)
-                            )
-                        ).order_by(ChatMessage.timestamp.desc())
-                        
-                        result = await db.execute(stmt)
-                        found_messages = result.scalars().all()
-                        
-                        processed_results = []
-                        for m in found_messages:
-                            m_dict = {
-                                "id": m.id,
-                                "timestamp": m.timestamp.isoformat() if m.timestamp else None,
-                                "message": m.message,
-                                "file_path": m.file_path,
-                                "sender_id": m.sender_id,
-                                "receiver_id": m.receiver_id,
-                                "message_type": m.message_type
-                            }
-                            processed_results.append(m_dict)
-                            
-                        await websocket.send_json({
-                            "type": "search_results",
-                            "other_user_id": int(other_user_id),
-                            "query": query,
-                            "data": processed_results
-                        })
-                    except Exception as e:
-                        logger.error(f"WS search_messages error: {e}")
-                continue
+                history, next_cursor = await load_chat_history(
+                    db, user_id, int(other_user_id), limit=int(limit), skip=int(skip),
+                    before_id=int(before_id) if before_id is not None else None,
+                    before_ts=datetime.fromisoformat(before_ts) if before_ts else None
+                )
+                # Курсор непрозрачен для клиента и всегда передается ISO-строкой (миллисекунд для keyset недостаточно)
+                if next_cursor:
+                    next_cursor = {"before_id": next_cursor["before_id"], "before_ts": next_cursor["before_ts"].isoformat()}
                 
-            if msg_type == "mark_read":
-                other_id = message_data.get("other_id")
-                if other_id:
-                    await db.execute(
-                        update(ChatMessage)
-                        .where(
-                            ChatMessage.sender_id == int(other_id),
-                            ChatMessage.receiver_id == user_id,
-                            ChatMessage.is_read == 0
-                        )
-                        .values(is_read=1)
-                    )
-                    await db.commit()
-                    
-                    # Уведомляем всех участников одновременно
-                    await asyncio.gather(
-                        notifications_manager.send_personal_message({
-                            "type": "your_messages_read",
-                            "data": {"reader_id": user_id}
-                        }, int(other_id)),
-                        manager.send_personal_message({
-                            "type": "messages_read",
-                            "reader_id": user_id
-                        }, int(other_id)),
-                        notifications_manager.send_personal_message({
-                            "type": "messages_read",
-                            "data": {"from_user_id": int(other_id)}
-                        }, user_id),
-                        return_exceptions=True
-                    )
-                continue
-
-            if msg_type == "typing":
-                other_user_id = message_data.get("other_user_id")
-                is_typing = message_data.get("is_typing", True)
-                if other_user_id:
-                    await manager.send_personal_message({
-                        "type": "typing",
-                        "user_id": user_id,
-                        "is_typing": is_typing
-                    }, int(other_user_id))
-                continue
+                logger.info(f"Sending WS history to user {user_id} for partner {other_user_id}, count: {len(history)}")
+                await send_event(websocket, {
+                    "type": "chat_history",
+                    "other_user_id": int(other_user_id),
+                    "data": history,
+                    "skip": skip,
+                    "next_cursor": next_cursor
+                })
+            except Exception as e:
+                logger.error(f"WS get_history error: {e}")
+        return
+        
+    logger.debug(f"Chat WS received message type '{msg_type}' from user {user_id}")
+
+    if msg_type == "search_messages":
+        other_user_id = message_data.get("other_user_id")
+        query = message_data.get("query", "")
+        limit = min(int(message_data.get("limit", 20)), 100)
+        offset = int(message_data.get("offset", 0))
+        if other_user_id and query:
+            try:
+                found_messages, next_offset = await search_chat_messages(
+                    db, user_id, int(other_user_id), query, limit=limit, offset=offset
+                )
 
-            if msg_type == "delete_message":
-                message_id_raw = message_data.get("message_id")
-                if message_id_raw:
-                    try:
-                        message_id = int(message_id_raw)
-                    except (ValueError, TypeError):
-                        logger.warning(f"Invalid message_id format in WS delete: {message_id_raw}")
-                        continue
-                        
-                    result = await db.execute(select(ChatMessage).where(ChatMessage.id == message_id))
-                    message = result.scalar_one_or_none()
-
-                    if message:
-                        is_sender = message.sender_id == user_id
-                        is_receiver = message.receiver_id == user_id
-
-                        if is_sender or is_receiver:
-                            receiver_id = message.receiver_id
-                            sender_id = message.sender_id
-                            file_path = message.file_path
-
-                            if is_sender:
-                                # Вместо физического удаления используем soft delete для обоих сторон
-                                # Это позволяет избежать проблем с reply_to_id и ссылочной целостностью
-                                message.deleted_by_sender = True
-                                message.deleted_by_receiver = True
-                                logger.info(f"WS: Message {message_id} soft-deleted for all by sender {user_id}")
-                            else:
-                                message.deleted_by_receiver = True
-                                logger.info(f"WS: Message {message_id} soft-deleted for receiver {user_id}")
-                            
-                            await db.commit()
+                await send_event(websocket, {
+                    "type": "search_results",
+                    "other_user_id": int(other_user_id),
+                    "query": query,
+                    "offset": offset,
+                    "next_offset": next_offset,
+                    "data": found_messages
+                })
+            except Exception as e:
+                logger.error(f"WS search_messages error: {e}")
+        return
+        
+    if msg_type == "mark_read":
+        other_id = message_data.get("other_id")
+        if other_id:
+            # Последнее сообщение, которое видел клиент (может быть еще не записано пачкой chat_writer)
+            try:
+                last_seen_id = int(message_data.get("last_message_id") or 0)
+            except (ValueError, TypeError):
+                last_seen_id = 0
+            await mark_dialog_read(db, user_id, int(other_id), last_seen_id)
+            await db.commit()
+            badge = await unread.reset_unread(user_id, int(other_id))
+            
+            # Уведомляем всех участников одновременно
+            await asyncio.gather(
+                notifications_manager.send_personal_message({
+                    "type": "your_messages_read",
+                    "data": {"reader_id": user_id}
+                }, int(other_id)),
+                manager.send_personal_message({
+                    "type": "messages_read",
+                    "reader_id": user_id
+                }, int(other_id)),
+                notifications_manager.send_personal_message({
+                    "type": "messages_read",
+                    "data": {"from_user_id": int(other_id), "unread": badge}
+                }, user_id),
+                return_exceptions=True
+            )
+        return
 
-                            # Если удалено отправителем ("для всех") и есть файл — удаляем его физически
-                            if is_sender and file_path:
-                                try:
-                                    # Очищаем контент сообщения, чтобы он не занимал место и не светился в логах
-                                    message.message = "[Сообщение удалено]"
-                                    message.file_path = None
-                                    await db.commit()
-                                    
-                                    root_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-                                    # Если это JSON список (media_group), удаляем все файлы
-                                    if message.message_type == "media_group":
-                                        try:
-                                            attachments = json.loads(file_path)
-                                            for att in attachments:
-                                                att_path = att.get("file_path")
-                                                if att_path:
-                                                    abs_path = os.path.join(root_dir, att_path.lstrip("/"))
-                                                    if os.path.exists(abs_path):
-                                                        os.remove(abs_path)
-                                        except: pass
-                                    else:
-                                        abs_path = os.path.join(root_dir, file_path.lstrip("/"))
-                                        if os.path.exists(abs_path):
-                                            os.remove(abs_path)
-                                except Exception as e:
-                                    logger.error(f"Error deleting chat file via WS: {e}")
-
-                            delete_event = {
-                                "type": "message_deleted",
-                                "message_id": message_id,
-                                "sender_id": sender_id,
-                                "receiver_id": receiver_id,
-                                "deleted_for_all": is_sender
-                            }
-                            
-                            if is_sender:
-                                await asyncio.gather(
-                                    manager.send_personal_message(delete_event, receiver_id),
-                                    manager.send_personal_message(delete_event, user_id),
-                                    notifications_manager.send_personal_message(delete_event, receiver_id),
-                                    notifications_manager.send_personal_message(delete_event, user_id),
-                                    return_exceptions=True
-                                )
-                            else:
-                                await asyncio.gather(
-                                    manager.send_personal_message(delete_event, user_id),
-                                    notifications_manager.send_personal_message(delete_event, user_id),
-                                    return_exceptions=True
-                                )
-                continue
+    if msg_type == "typing":
+        other_user_id = message_data.get("other_user_id")
+        is_typing = message_data.get("is_typing", True)
+        if other_user_id:
+            target_id = int(other_user_id)
+            typing_event = {
+                "type": "typing",
+                "user_id": user_id,
+                "is_typing": is_typing
+            }
+            # Нажатия клавиш схлопываются; окончание набора уходит сразу
+            await coalescer.submit(
+                "typing", (user_id, target_id),
+                partial(manager.send_personal_message, typing_event, target_id),
+                force=not is_typing
+            )
+        return
 
-            if msg_type == "bulk_delete":
-                message_ids_raw = message_data.get("message_ids", [])
-                if message_ids_raw:
-                    try:
-                        message_ids = [int(mid) for mid in message_ids_raw]
-                    except (ValueError, TypeError):
-                        logger.warning(f"Invalid message_ids format in WS bulk delete")
-                        continue
-                        
-                    result = await db.execute(
-                        select(ChatMessage).where(
-                            ChatMessage.id.in_(message_ids),
-                            or_(
-                                ChatMessage.sender_id == user_id,
-                                ChatMessage.receiver_id == user_id
-                            )
-                        )
-                    )
-                    messages = result.scalars().all()
-                    
-                    if messages:
-                        root_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-                        
-                        for msg in messages:
-                            m_receiver_id = msg.receiver_id
-                            m_sender_id = msg.sender_id
-                            m_file_path = msg.file_path
-                            m_id = msg.id
-                            
-                            m_is_sender = m_sender_id == user_id
-                            
-                            if m_is_sender:
-                                # Soft delete для всех
-                                msg.deleted_by_sender = True
-                                msg.deleted_by_receiver = True
-                                if m_file_path:
-                                    try:
-                                        msg.message = "[Сообщение удалено]"
-                                        msg.file_path = None
-                                        
-                                        # Если это JSON список (media_group), удаляем все файлы
-                                        if msg.message_type == "media_group":
-                                            try:
-                                                attachments = json.loads(m_file_path)
-                                                for att in attachments:
-                                                    att_path = att.get("file_path")
-                                                    if att_path:
-                                                        abs_path = os.path.join(root_dir, att_path.lstrip("/"))
-                                                        if os.path.exists(abs_path):
-                                                            os.remove(abs_path)
-                                            except: pass
-                                        else:
-                                            m_abs_path = os.path.join(root_dir, m_file_path.lstrip("/"))
-                                            if os.path.exists(m_abs_path):
-                                                os.remove(m_abs_path)
-                                    except Exception as e:
-                                        logger.error(f"Error bulk deleting chat file via WS: {e}")
-                            else:
-                                msg.deleted_by_receiver = True
-
-                            m_delete_event = {
-                                "type": "message_deleted",
-                                "message_id": m_id,
-                                "sender_id": m_sender_id,
-                                "receiver_id": m_receiver_id,
-                                "deleted_for_all": m_is_sender
-                            }
-                            
-                            if m_is_sender:
-                                await asyncio.gather(
-                                    manager.send_personal_message(m_delete_event, m_receiver_id),
-                                    manager.send_personal_message(m_delete_event, user_id),
-                                    notifications_manager.send_personal_message(m_delete_event, m_receiver_id),
-                                    notifications_manager.send_personal_message(m_delete_event, user_id),
-                                    return_exceptions=True
-                                )
-                            else:
-                                await asyncio.gather(
-                                    manager.send_personal_message(m_delete_event, user_id),
-                                    notifications_manager.send_personal_message(m_delete_event, user_id),
-                                    return_exceptions=True
-                                )
-                        await db.commit()
-                continue
+    if msg_type == "delete_message":
+        message_id_raw = message_data.get("message_id")
+        if message_id_raw:
+            try:
+                message_id = int(message_id_raw)
+            except (ValueError, TypeError):
+                logger.warning(f"Invalid message_id format in WS delete: {message_id_raw}")
+                return
+                
+            result = await db.execute(select(ChatMessage).where(ChatMessage.id == message_id))
+            message = result.scalar_one_or_none()
+
+            if message:
+                is_sender = message.sender_id == user_id
+                is_receiver = message.receiver_id == user_id
+
+                if is_sender or is_receiver:
+                    receiver_id = message.receiver_id
+                    sender_id = message.sender_id
+                    file_path = message.file_path
+
+                    if is_sender:
+                        # Вместо физического удаления используем soft delete для обоих сторон
+                        # Это позволяет избежать проблем с reply_to_id и ссылочной целостностью
+                        message.deleted_by_sender = True
+                        message.deleted_by_receiver = True
+                        logger.info(f"WS: Message {message_id} soft-deleted for all by sender {user_id}")
+                    else:
+                        message.deleted_by_receiver = True
+                        logger.info(f"WS: Message {message_id} soft-deleted for receiver {user_id}")
 
-            if msg_type == "upload_started":
-                receiver_id_raw = message_data.get("receiver_id")
-                upload_id = message_data.get("upload_id")
-                message_type = message_data.get("message_type", "file")
-                client_id = message_data.get("client_id")
-                duration = message_data.get("duration")
-                reply_to_id = message_data.get("reply_to_id")
-                if receiver_id_raw and upload_id:
-                    try:
-                        receiver_id = int(receiver_id_raw)
-                    except (ValueError, TypeError):
-                        logger.warning(f"Invalid receiver_id format in WS upload_started: {receiver_id_raw}")
-                        continue
-
-                    # Проверяем, есть ли уже плейсхолдер с таким client_id и upload_id
-                    existing_msg = None
-                    if client_id:
-                        # Ищем существующий плейсхолдер по client_id
-                        # Используем ту же логику, что и при сохранении обычного сообщения
-                        time_limit = datetime.utcnow() - timedelta(hours=24)
-                        res_existing = await db.execute(
-                            select(ChatMessage).where(
-                                ChatMessage.client_id == client_id,
-                                ChatMessage.sender_id == user_id,
-                                or_(
-                                    ChatMessage.is_uploading == True,
-                                    ChatMessage.upload_id.isnot(None)
-                                ),
-                                ChatMessage.timestamp >= time_limit
-                            )
-                        )
-                        existing_msg = res_existing.scalars().first()
-
-                    if existing_msg:
-                        # Обновляем существующий placeholder
-                        logger.debug(f"Updating existing placeholder message {existing_msg.id} for upload_started")
-                        existing_msg.upload_id = upload_id
-                        # Если новый тип более специфичный чем file, обновляем
-                        if message_type != "file" or existing_msg.message_type == "text":
-                            existing_msg.message_type = message_type
-                        if duration:
-                            existing_msg.duration = duration
-                        if reply_to_id:
-                            existing_msg.reply_to_id = reply_to_id
-                        new_msg = existing_msg
+                    if is_sender:
+                        await refresh_dialog_pair(db, sender_id, receiver_id)
                     else:
-                        # Создаем placeholder-сообщение с признаком загрузки
-                        new_msg = ChatMessage(
-                            sender_id=user_id,
-                            receiver_id=receiver_id,
-                            message=None,
-                            file_path=None,
-                            message_type=message_type,
-                            client_id=client_id,
-                            duration=duration,
-                            reply_to_id=reply_to_id,
-                            is_uploading=True,
-                            upload_id=upload_id
-                        )
-                        db.add(new_msg)
-                    
+                        await refresh_dialog(db, user_id, sender_id)
                     await db.commit()
-                    await db.refresh(new_msg)
 
-                    # Готовим данные отвечаемого сообщения, если оно есть
-                    reply_to_data = None
-                    if reply_to_id:
+                    # Если удалено отправителем ("для всех") и есть файл — удаляем его физически
+                    if is_sender and file_path:
                         try:
-                            reply_res = await db.execute(
-                                select(ChatMessage, UserModel.first_name, UserModel.last_name)
-                                .join(UserModel, ChatMessage.sender_id == UserModel.id)
-                                .where(ChatMessage.id == reply_to_id)
-                            )
-                            reply_row = reply_res.first()
-                            if reply_row:
-                                r_msg, r_fname, r_lname = reply_row
-                                reply_to_data = {
-                                    "id": r_msg.id,
-                                    "message": r_msg.message,
-                                    "message_type": r_msg.message_type,
-                                    "sender_id": r_msg.sender_id,
-                                    "sender_name": f"{r_fname} {r_lname}".strip() or "Пользователь"
-                                }
+                            urls = chat_compaction.file_path_urls(file_path, message.message_type)
+                            urls += await chat_compaction.attachment_urls(db, [message_id])
+                            # Очищаем контент сообщения, чтобы он не занимал место и не светился в логах
+                            message.message = "[Сообщение удалено]"
+                            message.file_path = None
+                            await chat_attachments.delete_for_messages(db, [message_id])
+                            await db.commit()
+                            await chat_compaction.delete_media(db, urls)
                         except Exception as e:
-                            logger.error(f"Error fetching reply_to message (upload_started): {e}")
+                            logger.error(f"Error deleting chat file via WS: {e}")
+                        await chat_cache.invalidate(sender_id, receiver_id)
+                    else:
+                        await chat_cache.patch(sender_id, receiver_id, message_id, {
+                            "deleted_by_sender": message.deleted_by_sender,
+                            "deleted_by_receiver": message.deleted_by_receiver
+                        })
 
-                    response_data = {
-                        "id": new_msg.id,
-                        "client_id": client_id,
-                        "sender_id": user_id,
-                        "sender_name": sender_name,
+                    delete_event = {
+                        "type": "message_deleted",
+                        "message_id": message_id,
+                        "sender_id": sender_id,
                         "receiver_id": receiver_id,
-                        "message": None,
-                        "file_path": None,
-                        "message_type": message_type,
-                        "duration": duration,
-                        "reply_to_id": reply_to_id,
-                        "reply_to": reply_to_data,
-                        "timestamp": new_msg.timestamp.isoformat(),
-                        "is_read": 0,
-                        "is_uploading": True,
-                        "upload_id": upload_id
+                        "deleted_for_all": is_sender
                     }
+                    
+                    if is_sender:
+                        frame = encode_event(delete_event)
+                        await asyncio.gather(
+                            manager.send_personal_message(frame, receiver_id),
+                            manager.send_personal_message(frame, user_id),
+                            notifications_manager.send_personal_message(frame, receiver_id, stream=False),
+                            notifications_manager.send_personal_message(frame, user_id, stream=False),
+                            return_exceptions=True
+                        )
+                    else:
+                        frame = encode_event(delete_event)
+                        await asyncio.gather(
+                            manager.send_personal_message(frame, user_id),
+                            notifications_manager.send_personal_message(frame, user_id, stream=False),
+                            return_exceptions=True
+                        )
+        return
 
-                    chat_event = {"type": "new_message", "data": response_data}
-                    await asyncio.gather(
-                        manager.send_personal_message(chat_event, receiver_id),
-                        manager.send_personal_message(chat_event, user_id),
-                        notifications_manager.send_personal_message(chat_event, receiver_id),
-                        notifications_manager.send_personal_message(chat_event, user_id),
-                        return_exceptions=True
+    if msg_type == "bulk_delete":
+        message_ids_raw = message_data.get("message_ids", [])
+        if message_ids_raw:
+            try:
+                message_ids = [int(mid) for mid in message_ids_raw]
+            except (ValueError, TypeError):
+                logger.warning(f"Invalid message_ids format in WS bulk delete")
+                return
+                
+            result = await db.execute(
+                select(ChatMessage).where(
+                    ChatMessage.id.in_(message_ids),
+                    or_(
+                        ChatMessage.sender_id == user_id,
+                        ChatMessage.receiver_id == user_id
                     )
-                continue
-
-            if msg_type == "upload_cancelled":
-                upload_id = message_data.get("upload_id")
-                if upload_id:
-                    logger.info(f"Chat WS: User {user_id} cancelled upload {upload_id}")
-                    # 1. Удаляем сессию загрузки
-                    session_stmt = select(FileUploadSession).where(FileUploadSession.id == upload_id)
-                    res_session = await db.execute(session_stmt)
-                    session = res_session.scalar_one_or_none()
+                )
+            )
+            messages = result.scalars().all()
+            
+            if messages:
+                affected_dialogs = set()
+                # Удаление с очисткой содержимого меняет и цитаты в ответах - такой буфер истории сбрасывается
+                cleared_dialogs = set()
+                cleared_ids = []
+                cleared_urls = []
+                
+                for msg in messages:
+                    m_receiver_id = msg.receiver_id
+                    m_sender_id = msg.sender_id
+                    m_file_path = msg.file_path
+                    m_id = msg.id
                     
-                    if session and session.user_id == user_id:
-                        # Удаляем временный файл
-                        root_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-                        temp_dir = os.path.join(root_dir, "media", "temp")
-                        file_path = os.path.join(temp_dir, f"{upload_id}_{session.filename}")
-                        if os.path.exists(file_path):
-                            try:
-                                os.remove(file_path)
-                            except Exception as e:
-                                logger.error(f"Failed to delete temp file on upload cancel: {e}")
-                                
-                        await db.delete(session)
+                    m_is_sender = m_sender_id == user_id
                     
-                    # 2. Ищем placeholder сообщение
-                    msg_stmt = select(ChatMessage).where(
-                        ChatMessage.upload_id == upload_id,
-                        ChatMessage.sender_id == user_id
-                    )
-                    res_msg = await db.execute(msg_stmt)
-                    ph_msg = res_msg.scalar_one_or_none()
+                    if m_is_sender:
+                        # Soft delete для всех
+                        msg.deleted_by_sender = True
+                        msg.deleted_by_receiver = True
+                        if m_file_path:
+                            cleared_dialogs.add((m_sender_id, m_receiver_id))
+                            cleared_ids.append(m_id)
+                            # Файлы удаляются после фиксации, если на них больше нет ссылок
+                            cleared_urls += chat_compaction.file_path_urls(m_file_path, msg.message_type)
+                            msg.message = "[Сообщение удалено]"
+                            msg.file_path = None
+                    else:
+                        msg.deleted_by_receiver = True
+                    affected_dialogs.add((m_sender_id, m_receiver_id, m_is_sender))
+
+                    m_delete_event = {
+                        "type": "message_deleted",
+                        "message_id": m_id,
+                        "sender_id": m_sender_id,
+                        "receiver_id": m_receiver_id,
+                        "deleted_for_all": m_is_sender
+                    }
                     
-                    if ph_msg:
-                        msg_id = ph_msg.id
-                        receiver_id = ph_msg.receiver_id
-                        await db.delete(ph_msg)
-                        await db.commit()
-                        
-                        # Уведомляем обоих участников об удалении сообщения
-                        delete_event = {
-                            "type": "message_deleted",
-                            "data": {
-                                "message_id": msg_id,
-                                "upload_id": upload_id
-                            }
-                        }
+                    if m_is_sender:
+                        frame = encode_event(m_delete_event)
                         await asyncio.gather(
-                            manager.send_personal_message(delete_event, user_id),
-                            manager.send_personal_message(delete_event, receiver_id),
-                            notifications_manager.send_personal_message(delete_event, user_id),
-                            notifications_manager.send_personal_message(delete_event, receiver_id),
+                            manager.send_personal_message(frame, m_receiver_id),
+                            manager.send_personal_message(frame, user_id),
+                            notifications_manager.send_personal_message(frame, m_receiver_id, stream=False),
+                            notifications_manager.send_personal_message(frame, user_id, stream=False),
                             return_exceptions=True
                         )
                     else:
-                        await db.commit()
-                continue
-
-            # Стандартная отправка сообщения
-            receiver_id_raw = message_data.get("receiver_id")
-            content = message_data.get("message")
-            file_path = message_data.get("file_path")
-            attachments = message_data.get("attachments")  # список объектов {file_path, type}
-            message_type = message_data.get("message_type", "text")
-            client_id = message_data.get("client_id")  # Добавлено для оптимистичных обновлений
-            duration = message_data.get("duration") # Длительность аудио/видео
-            reply_to_id = message_data.get("reply_to_id")
-            
-            if receiver_id_raw and (content or file_path or (attachments and len(attachments) > 0)):
-                # Приводим к int для корректного поиска в менеджерах соединений
-                try:
-                    receiver_id = int(receiver_id_raw)
-                except (ValueError, TypeError):
-                    logger.warning(f"Invalid receiver_id format: {receiver_id_raw}")
-                    continue
-                
-                # Если пришли вложения списком — считаем это медиа-группой и сохраняем
-                if attachments and len(attachments) > 0:
-                    message_type = "media_group"
-                    # Сохраняем вложения как JSON-строку в file_path для совместимости БД
-                    try:
-                        file_path = json.dumps(attachments)
-                    except Exception as e:
-                        logger.error(f"Failed to serialize attachments: {e}")
-                        file_path = None
-                
-                logger.debug(f"Saving message: type={message_type}, sender={user_id}, receiver={receiver_id}")
-                
-                # Ищем placeholder или уже созданное сообщение, если есть client_id
-                existing_msg = None
-                if client_id:
-                    # Ищем любые сообщения с этим client_id за последние 24 часа.
-                    # Это позволяет избежать дубликатов, если сообщение уже было создано через init_upload/upload_chunk.
-                    time_limit = datetime.utcnow() - timedelta(hours=24)
-                    res_existing = await db.execute(
-                        select(ChatMessage).where(
-                            ChatMessage.client_id == client_id,
-                            ChatMessage.sender_id == user_id,
-                            ChatMessage.timestamp >= time_limit
+                        frame = encode_event(m_delete_event)
+                        await asyncio.gather(
+                            manager.send_personal_message(frame, user_id),
+                            notifications_manager.send_personal_message(frame, user_id, stream=False),
+                            return_exceptions=True
                         )
+                for d_sender_id, d_receiver_id, d_for_all in affected_dialogs:
+                    if d_for_all:
+                        await refresh_dialog_pair(db, d_sender_id, d_receiver_id)
+                    else:
+                        await refresh_dialog(db, user_id, d_sender_id)
+                cleared_urls += await chat_compaction.attachment_urls(db, cleared_ids)
+                await chat_attachments.delete_for_messages(db, cleared_ids)
+                await db.commit()
+                try:
+                    await chat_compaction.delete_media(db, cleared_urls)
+                except Exception as e:
+                    logger.error(f"Error bulk deleting chat files via WS: {e}")
+                await _sync_deleted_messages(messages, cleared_dialogs)
+        return
+
+    if msg_type == "upload_started":
+        receiver_id_raw = message_data.get("receiver_id")
+        upload_id = message_data.get("upload_id")
+        message_type = message_data.get("message_type", "file")
+        client_id = message_data.get("client_id")
+        duration = message_data.get("duration")
+        reply_to_id = message_data.get("reply_to_id")
+        if receiver_id_raw and upload_id:
+            try:
+                receiver_id = int(receiver_id_raw)
+            except (ValueError, TypeError):
+                logger.warning(f"Invalid receiver_id format in WS upload_started: {receiver_id_raw}")
+                return
+
+            # Проверяем, есть ли уже плейсхолдер с таким client_id и upload_id
+            existing_msg = None
+            if client_id:
+                # Ищем существующий плейсхолдер по client_id
+                # Используем ту же логику, что и при сохранении обычного сообщения
+                time_limit = datetime.utcnow() - timedelta(hours=24)
+                res_existing = await db.execute(
+                    select(ChatMessage).where(
+                        ChatMessage.client_id == client_id,
+                        ChatMessage.sender_id == user_id,
+                        or_(
+                            ChatMessage.is_uploading == True,
+                            ChatMessage.upload_id.isnot(None)
+                        ),
+                        ChatMessage.timestamp >= time_limit
                     )
-                    # Если было несколько плейсхолдеров (например, для разных файлов в группе), берем первый для обновления, остальные удалим
-                    existing_msgs = res_existing.scalars().all()
-                    if existing_msgs:
-                        existing_msg = existing_msgs[0]
-                        if len(existing_msgs) > 1:
-                            for extra_ph in existing_msgs[1:]:
-                                await db.delete(extra_ph)
-                            logger.debug(f"Removed {len(existing_msgs) - 1} extra placeholders for client_id {client_id}")
-
-                if existing_msg:
-                    # Обновляем существующий placeholder
-                    logger.debug(f"Updating existing placeholder message {existing_msg.id} with client_id {client_id}")
-                    existing_msg.message = content
-                    existing_msg.file_path = file_path
+                )
+                existing_msg = res_existing.scalars().first()
+
+            if existing_msg:
+                # Обновляем существующий placeholder
+                logger.debug(f"Updating existing placeholder message {existing_msg.id} for upload_started")
+                existing_msg.upload_id = upload_id
+                # Если новый тип более специфичный чем file, обновляем
+                if message_type != "file" or existing_msg.message_type == "text":
                     existing_msg.message_type = message_type
+                if duration:
                     existing_msg.duration = duration
-                    existing_msg.reply_to_id = reply_to_id
-                    existing_msg.is_uploading = False
-                    existing_msg.upload_id = None
-                    existing_msg.timestamp = datetime.utcnow()
-                    new_msg = existing_msg
-                else:
-                    # Сохраняем в базу новое сообщение
-                    new_msg = ChatMessage(
-                        sender_id=user_id,
-                        receiver_id=receiver_id,
-                        message=content,
-                        file_path=file_path,
-                        message_type=message_type,
-                        client_id=client_id,
-                        duration=duration,
-                        reply_to_id=reply_to_id
-                    )
-                    db.add(new_msg)
-                
-                await db.commit()
-                await db.refresh(new_msg)
-
-                # Готовим данные отвечаемого сообщения, если оно есть
-                reply_to_data = None
                 if reply_to_id:
-                    try:
-                        reply_res = await db.execute(
-                            select(ChatMessage, UserModel.first_name, UserModel.last_name)
-                            .join(UserModel, ChatMessage.sender_id == UserModel.id)
-                            .where(ChatMessage.id == reply_to_id)
-                        )
-                        reply_row = reply_res.first()
-                        if reply_row:
-                            r_msg, r_fname, r_lname = reply_row
-                            reply_to_data = {
-                                "id": r_msg.id,
-                                "message": r_msg.message,
-                                "message_type": r_msg.message_type,
-                                "sender_id": r_msg.sender_id,
-                                "sender_name": f"{r_fname} {r_lname}".strip() or "Пользователь"
-                            }
-                    except Exception as e:
-                        logger.error(f"Error fetching reply_to message: {e}")
-
-                # sender_name is already fetched once above the loop
-
-                # Готовим данные ответа
-                response_data = {
-                    "id": new_msg.id,
-                    "client_id": client_id,  # Возвращаем client_id для фронтенда
-                    "sender_id": user_id,
-                    "sender_name": sender_name,
-                    "receiver_id": receiver_id,
-                    "message": content,
-                    "file_path": file_path,
-                    "message_type": message_type,
-                    "duration": duration,
-                    "reply_to_id": reply_to_id,
-                    "reply_to": reply_to_data,
-                    "timestamp": new_msg.timestamp.isoformat(),
-                    "is_read": 0
-                }
-                # В ответ добавляем attachments как список, если это media_group
-                if message_type == "media_group":
-                    try:
-                        response_data["attachments"] = attachments or json.loads(file_path or "[]")
-                    except Exception:
-                        response_data["attachments"] = []
-                
-                # Рассылаем сообщения всем участникам параллельно для минимальной задержки
-                chat_event = {
-                    "type": "new_message",
-                    "data": response_data
-                }
-                await asyncio.gather(
-                    manager.send_personal_message(chat_event, receiver_id),
-                    manager.send_personal_message(chat_event, user_id),
-                    notifications_manager.send_personal_message(chat_event, receiver_id),
-                    notifications_manager.send_personal_message(chat_event, user_id),
-                    return_exceptions=True
+                    existing_msg.reply_to_id = reply_to_id
+                new_msg = existing_msg
+            else:
+                # Создаем placeholder-сообщение с признаком загрузки
+                new_msg = ChatMessage(
+                    sender_id=user_id,
+                    receiver_id=receiver_id,
+                    message=None,
+                    file_path=None,
+                    message_type=message_type,
+                    client_id=client_id,
+                    duration=duration,
+                    reply_to_id=reply_to_id,
+                    is_uploading=True,
+                    upload_id=upload_id
                 )
+                db.add(new_msg)
+            
+            await db.flush()
+            await touch_dialogs(db, new_msg, count_unread=existing_msg is None)
+            await db.commit()
+            await db.refresh(new_msg)
+            remember_upload(upload_id, new_msg)
+            if existing_msg is None:
+                await bump_unread(new_msg)
 
-                # Отправляем Пуш через FCM, если получатель не подключен к WebSocket
-                # Находим получателя, чтобы взять его fcm_token
-                # Используем populate_existing=True, чтобы избежать старых данных в долгоживущих сессиях (WebSocket)
-                receiver = await db.get(UserModel, receiver_id, populate_existing=True)
-                
-                if receiver and receiver.fcm_token:
-                    def format_duration(seconds):
-                        if seconds is None: return ""
-                        minutes = int(seconds // 60)
-                        remaining_seconds = int(seconds % 60)
-                        return f" ({minutes}:{remaining_seconds:02d})"
-
-                    if message_type == "video_note":
-                        body = f"📹 Видеосообщение{format_duration(duration)}"
-                    elif message_type == "audio":
-                        body = f"🎤 Голосовое сообщение{format_duration(duration)}"
-                    elif message_type == "image":
-                        body = "🖼️ Фотография"
-                    elif message_type == "file":
-                        body = "📁 Файл"
-                    else:
-                        body = content if content else f"Отправил {message_type}"
-                    
-                    logger.info(f"FCM: Triggering notification for receiver {receiver_id} with token {receiver.fcm_token}")
-                    asyncio.create_task(send_fcm_notification(
-                        token=receiver.fcm_token,
-                        title=sender_name,
-                        body=body,
-                        sender_id=user_id,
-                        sender_avatar=sender_avatar,
-                        data={
-                            "chat_id": str(user_id),
-                            "message_id": str(new_msg.id)
+            # Готовим данные отвечаемого сообщения, если оно есть
+            reply_to_data = None
+            if reply_to_id:
+                try:
+                    reply_res = await db.execute(
+                        select(ChatMessage, UserModel.first_name, UserModel.last_name)
+                        .join(UserModel, ChatMessage.sender_id == UserModel.id)
+                        .where(ChatMessage.id == reply_to_id)
+                    )
+                    reply_row = reply_res.first()
+                    if reply_row:
+                        r_msg, r_fname, r_lname = reply_row
+                        reply_to_data = {
+                            "id": r_msg.id,
+                            "message": r_msg.message,
+                            "message_type": r_msg.message_type,
+                            "sender_id": r_msg.sender_id,
+                            "sender_name": f"{r_fname} {r_lname}".strip() or "Пользователь"
                         }
-                    ))
-                else:
-                    logger.debug(f"FCM: Skipping notification for receiver {receiver_id}. No token found.")
-            else:
-                logger.debug(f"Message skipped. receiver_id={receiver_id_raw}, content={bool(content)}, file_path={bool(file_path)}")
+                except Exception as e:
+                    logger.error(f"Error fetching reply_to message (upload_started): {e}")
+            await cache_sent_message(new_msg, reply_to_data)
+
+            response_data = {
+                "id": new_msg.id,
+                "client_id": client_id,
+                "sender_id": user_id,
+                "sender_name": sender_name,
+                "receiver_id": receiver_id,
+                "message": None,
+                "file_path": None,
+                "message_type": message_type,
+                "duration": duration,
+                "reply_to_id": reply_to_id,
+                "reply_to": reply_to_data,
+                "timestamp": new_msg.timestamp.isoformat(),
+                "is_read": 0,
+                "is_uploading": True,
+                "upload_id": upload_id
+            }
+
+            chat_event = {"type": "new_message", "data": response_data}
+            frame = encode_event(chat_event)
+            await asyncio.gather(
+                manager.send_personal_message(frame, receiver_id),
+                manager.send_personal_message(frame, user_id),
+                notifications_manager.send_personal_message(frame, receiver_id, stream=False),
+                notifications_manager.send_personal_message(frame, user_id, stream=False),
+                return_exceptions=True
+            )
+        return
+
+    if msg_type == "upload_cancelled":
+        upload_id = message_data.get("upload_id")
+        if upload_id:
+            logger.info(f"Chat WS: User {user_id} cancelled upload {upload_id}")
+            await cancel_chat_upload(db, user_id, upload_id)
+        return
+
+    # Стандартная отправка сообщения
+    receiver_id_raw = message_data.get("receiver_id")
+    content = message_data.get("message")
+    file_path = message_data.get("file_path")
+    attachments = message_data.get("attachments")  # список объектов {file_path, type}
+    message_type = message_data.get("message_type", "text")
+    client_id = message_data.get("client_id")  # Добавлено для оптимистичных обновлений
+    duration = message_data.get("duration") # Длительность аудио/видео
+    reply_to_id = message_data.get("reply_to_id")
+    
+    if receiver_id_raw and (content or file_path or (attachments and len(attachments) > 0)):
+        # Приводим к int для корректного поиска в менеджерах соединений
+        try:
+            receiver_id = int(receiver_id_raw)
+        except (ValueError, TypeError):
+            logger.warning(f"Invalid receiver_id format: {receiver_id_raw}")
+            return
+        
+        # Если пришли вложения списком — считаем это медиа-группой и сохраняем
+        if attachments and len(attachments) > 0:
+            message_type = "media_group"
+            # Сохраняем вложения как JSON-строку в file_path для совместимости БД
+            try:
+                file_path = json.dumps(attachments)
+            except Exception as e:
+                logger.error(f"Failed to serialize attachments: {e}")
+                file_path = None
+        
+        logger.debug(f"Saving message: type={message_type}, sender={user_id}, receiver={receiver_id}")
+        sent = await chat_service.send(
+            db, user_id, receiver_id, content, file_path, message_type, client_id, duration, reply_to_id, attachments
+        )
+        if sent is None:
+            logger.warning(f"Message skipped: receiver {receiver_id} not found")
+            return
+        await deliver_sent_message(sent, sender_name, sender_avatar)
+    else:
+        logger.debug(f"Message skipped. receiver_id={receiver_id_raw}, content={bool(content)}, file_path={bool(file_path)}")
+
+@router.websocket("/ws/{token}")
+async def websocket_chat_endpoint(
+    websocket: WebSocket,
+    token: str
+):
+    # Accept immediately to avoid handshake rejection issues
+    # Клиент может запросить бинарный протокол: Sec-WebSocket-Protocol: msgpack
+    await accept(websocket)
+    
+    # Clean token (remove potential quotes if passed incorrectly)
+    token = token.strip().strip('"').strip("'")
+
+    async with async_session_maker() as db:
+        user = await get_user_from_token(token, db)
+    if user is None:
+        logger.warning(f"Chat WS rejected: invalid token {token[:10]}...")
+        await websocket.close(code=4003)
+        return
+        
+    user_id = user.id
+    await manager.connect(websocket, user_id)
+    # Переподключение: досылаем события, пропущенные после last_event_id (или resync_required)
+    last_event_id = websocket.query_params.get("last_event_id")
+    if last_event_id:
+        await manager.replay(websocket, user_id, last_event_id)
+
+    try:
+        while True:
+            try:
+                message_data = await receive_event(websocket)
+            except ValueError as e:
+                logger.error(f"Chat WS frame error: {e}")
+                continue
+            
+            # Обработка разных типов сообщений через WebSocket
+            msg_type = message_data.get("type", "message")
+            
+            if msg_type == "ping":
+                await send_event(websocket, {"type": "pong"})
+                continue
+            
+            # Сессию БД берем только на время обработки кадра: простаивающие сокеты не держат соединения пула
+            with WS_FRAME_SECONDS.time():
+                async with async_session_maker() as db:
+                    await handle_chat_frame(websocket, db, user, message_data)
 
     except WebSocketDisconnect:
         logger.info(f"Chat WS disconnected for user {user_id}")
@@ -820,208 +713,47 @@ async def send_message_api(
         except Exception:
             file_path = None
     
-    # Ищем плейсхолдер, если есть client_id
-    existing_msg = None
-    if client_id:
-        time_limit = datetime.utcnow() - timedelta(hours=24)
-        res_existing = await db.execute(
-            select(ChatMessage).where(
-                ChatMessage.client_id == client_id,
-                ChatMessage.sender_id == user_id,
-                or_(
-                    ChatMessage.is_uploading == True,
-                    ChatMessage.upload_id.isnot(None)
-                ),
-                ChatMessage.timestamp >= time_limit
-            )
-        )
-        existing_msg = res_existing.scalars().first()
-
-    if existing_msg:
-        # Обновляем существующий placeholder
-        logger.debug(f"Updating existing placeholder message {existing_msg.id} via API")
-        existing_msg.message = content
-        existing_msg.file_path = file_path
-        # Если новый тип более специфичный, обновляем (но не затираем video_note)
-        if message_type != "file" and existing_msg.message_type != "video_note":
-            existing_msg.message_type = message_type
-        existing_msg.duration = duration
-        existing_msg.is_uploading = False
-        existing_msg.upload_id = None
-        existing_msg.timestamp = datetime.utcnow()
-        new_msg = existing_msg
-    else:
-        # Сохраняем в базу новое сообщение
-        new_msg = ChatMessage(
-            sender_id=user_id,
-            receiver_id=receiver_id,
-            message=content,
-            file_path=file_path,
-            message_type=message_type,
-            client_id=client_id,
-            duration=duration
-        )
-        db.add(new_msg)
-    
-    await db.commit()
-    await db.refresh(new_msg)
-
-    # Находим отправителя для имени и аватарки
-    sender_result = await db.execute(select(UserModel.first_name, UserModel.last_name, UserModel.avatar_url).where(UserModel.id == user_id))
-    sender_row = sender_result.first()
-    sender_name = f"{sender_row.first_name} {sender_row.last_name}".strip() if sender_row and (sender_row.first_name or sender_row.last_name) else "Пользователь"
-    if not sender_name: sender_name = "Пользователь"
-    sender_avatar = sender_row.avatar_url if sender_row else None
-
-    # Готовим данные ответа
-    response_data = {
-        "id": new_msg.id,
-        "client_id": client_id,  # Возвращаем client_id
-        "sender_id": user_id,
-        "sender_name": sender_name,
-        "receiver_id": receiver_id,
-        "message": content,
-        "file_path": file_path,
-        "message_type": message_type,
-        "duration": duration,
-        "timestamp": new_msg.timestamp.isoformat() if hasattr(new_msg.timestamp, 'isoformat') else new_msg.timestamp,
-        "is_read": 0
-    }
-    if message_type == "media_group":
-        try:
-            response_data["attachments"] = attachments or json.loads(file_path or "[]")
-        except Exception:
-            response_data["attachments"] = []
-
-    # Уведомляем всех параллельно
-    chat_event = {
-        "type": "new_message",
-        "data": response_data
-    }
-    await asyncio.gather(
-        manager.send_personal_message(chat_event, receiver_id),
-        manager.send_personal_message(chat_event, user_id),
-        notifications_manager.send_personal_message(chat_event, receiver_id),
-        notifications_manager.send_personal_message(chat_event, user_id),
-        return_exceptions=True
+    sent = await chat_service.send(
+        db, user_id, receiver_id, content, file_path, message_type, client_id, duration, msg_in.reply_to_id, attachments
     )
-
-    # FCM Notification
-    # Используем populate_existing=True, чтобы получить актуальный токен из БД
-    receiver = await db.get(UserModel, receiver_id, populate_existing=True)
-    
-    if receiver and receiver.fcm_token:
-        def format_duration(seconds):
-            if seconds is None: return ""
-            minutes = int(seconds // 60)
-            remaining_seconds = int(seconds % 60)
-            return f" ({minutes}:{remaining_seconds:02d})"
-
-        if message_type == "video_note":
-            body = f"📹 Видеосообщение{format_duration(duration)}"
-        elif message_type == "audio":
-            body = f"🎤 Голосовое сообщение{format_duration(duration)}"
-        elif message_type == "image":
-            body = "🖼️ Фотография"
-        elif message_type == "file":
-            body = "📁 Файл"
-        else:
-            body = content if content else f"Отправил {message_type}"
-        
-        logger.info(f"FCM (API): Triggering notification for receiver {receiver_id} with token {receiver.fcm_token[:15]}...")
-        asyncio.create_task(send_fcm_notification(
-            token=receiver.fcm_token,
-            title=sender_name,
-            body=body,
-            sender_id=user_id,
-            sender_avatar=sender_avatar,
-            data={
-                "chat_id": str(user_id),
-                "message_id": str(new_msg.id)
-            }
-        ))
-    else:
-        logger.debug(f"FCM (API): Skipping notification for receiver {receiver_id}. No token found.")
-
-    return response_data
-
-@router.get("/history/{other_user_id}", response_model=List[ChatMessageResponse])
-async def get_chat_history(
-    other_user_id: int,
-    limit: int = 15,
-    skip: int = 0,
-    db: AsyncSession = Depends(get_async_db),
-    current_user: UserModel = Depends(get_current_user)
-):
-    user_id = current_user.id
-    if user_id is None:
-        return []
-
-    result = await db.execute(
-        select(ChatMessage, FileUploadSession.offset.label("upload_offset"), FileUploadSession.file_size.label("upload_total"))
-        .outerjoin(FileUploadSession, ChatMessage.upload_id == FileUploadSession.id)
-        .options(joinedload(ChatMessage.reply_to).joinedload(ChatMessage.sender))
-        .where(
-            or_(
-                and_(ChatMessage.sender_id == user_id, ChatMessage.receiver_id == other_user_id, ChatMessage.deleted_by_sender == False),
-                and_(ChatMessage.sender_id == other_user_id, ChatMessage.receiver_id == user_id, ChatMessage.deleted_by_receiver == False)
-            )
-        )
-        # Исключаем плейсхолдеры, которые висят слишком долго (вероятно, загрузка прервана)
-        .where(
-            or_(
-                ChatMessage.is_uploading == False,
-                ChatMessage.timestamp >= datetime.utcnow() - timedelta(hours=1)
-            )
-        )
-        .order_by(ChatMessage.timestamp.desc())
-        .offset(skip)
-        .limit(limit)
+    if sent is None:
+        raise HTTPException(status_code=404, detail="Receiver not found")
+    sender_name = chat_service.display_name(current_user.first_name, current_user.last_name)
+    return await deliver_sent_message(sent, sender_name, current_user.avatar_url)
+
+def _history_branch(sender_id: int, receiver_id: int, deleted_flag, limit: int, cursor_ts: Optional[datetime], cursor_id: Optional[int]):
+    """
+    Одна "сторона" диалога (сообщения sender -> receiver), упорядоченная по индексу
+    (sender_id, receiver_id, timestamp, id). Keyset-условие позволяет не сканировать пропущенные строки.
+    deleted_flag=None - вместе с удаленными (буфер истории общий для обоих участников).
+    """
+    stmt = select(ChatMessage.id, ChatMessage.timestamp).where(
+        ChatMessage.sender_id == sender_id,
+        ChatMessage.receiver_id == receiver_id
     )
-    db_rows = result.all()
-
-    # Преобразуем в словари и добавим attachments для media_group
-    messages = []
-    for row in db_rows:
-        m = row.ChatMessage
-        item = {
-            "id": m.id,
-            "sender_id": m.sender_id,
-            "receiver_id": m.receiver_id,
-            "message": m.message,
-            "file_path": m.file_path,
-            "message_type": m.message_type,
-            "client_id": m.client_id,
-            "duration": m.duration,
-            "timestamp": m.timestamp,
-            "is_read": m.is_read,
-            "reply_to_id": m.reply_to_id,
-            "is_uploading": getattr(m, 'is_uploading', False),
-            "upload_id": getattr(m, 'upload_id', None),
-            "upload_offset": row.upload_offset,
-            "upload_total": row.upload_total,
-            "upload_progress": (row.upload_offset / row.upload_total) if row.upload_offset and row.upload_total else 0
-        }
-        
-        if m.reply_to:
-            r = m.reply_to
-            r_sender = r.sender
-            item["reply_to"] = {
-                "id": r.id,
-                "message": r.message,
-                "message_type": r.message_type,
-                "sender_id": r.sender_id,
-                "sender_name": f"{r_sender.first_name} {r_sender.last_name}".strip() or "Пользователь" if r_sender else "Пользователь"
-            }
-        else:
-            item["reply_to"] = None
-        if m.message_type == "media_group" and m.file_path:
-            try:
-                item["attachments"] = json.loads(m.file_path)
-            except Exception:
-                item["attachments"] = []
-        messages.append(item)
+    if deleted_flag is not None:
+        # Брошенные placeholder-загрузки удаляет задача collect_abandoned_uploads
+        stmt = stmt.where(deleted_flag == False)
+    if cursor_ts is not None and cursor_id is not None:
+        stmt = stmt.where(tuple_(ChatMessage.timestamp, ChatMessage.id) < tuple_(cursor_ts, cursor_id))
+    elif cursor_ts is not None:
+        stmt = stmt.where(ChatMessage.timestamp < cursor_ts)
+    return stmt.order_by(ChatMessage.timestamp.desc(), ChatMessage.id.desc()).limit(limit).subquery()
+
+def _reply_to_item(m: ChatMessage) -> Optional[dict]:
+    if not m.reply_to:
+        return None
+    r = m.reply_to
+    r_sender = r.sender
+    return {
+        "id": r.id,
+        "message": r.message,
+        "message_type": r.message_type,
+        "sender_id": r.sender_id,
+        "sender_name": f"{r_sender.first_name} {r_sender.last_name}".strip() or "Пользователь" if r_sender else "Пользователь"
+    }
 
+def _dedup_by_client_id(messages: List[dict]) -> List[dict]:
     # Дедупликация по client_id (схлопываем плейсхолдеры и готовые сообщения в истории)
     # Это предотвращает отображение дубликатов, если плейсхолдер не был удален вовремя
     unique_messages = []
@@ -1045,96 +777,287 @@ async def get_chat_history(
                 continue
             seen_client_ids[cid] = len(unique_messages)
         unique_messages.append(item)
+    return unique_messages
+
+async def _history_page(
+    db: AsyncSession,
+    user_id: int,
+    other_user_id: int,
+    items: List[dict],
+    limit: int,
+    uploads_info: Optional[Dict[str, tuple]] = None
+):
+    """
+    Дополняет элементы истории (chat_cache.history_item) полями читающего: is_read и прогресс загрузок.
+    uploads_info - {upload_id: (offset, file_size)} из БД; если не передан, читается по upload_id элементов.
+    """
+    next_cursor = None
+    if len(items) == limit:
+        last = items[-1]
+        next_cursor = {"before_id": last["id"], "before_ts": last["timestamp"]}
+
+    read_by_user, read_by_partner = await get_read_watermarks(db, user_id, other_user_id)
+    upload_ids = [item["upload_id"] for item in items if item["upload_id"]]
+    if uploads_info is None:
+        uploads_info = {}
+        if upload_ids:
+            res = await db.execute(
+                select(FileUploadSession.id, FileUploadSession.offset, FileUploadSession.file_size)
+                .where(FileUploadSession.id.in_(upload_ids))
+            )
+            uploads_info = {row.id: (row.offset, row.file_size) for row in res}
+    # Смещения идущих загрузок хранятся в Redis, в БД - только на момент создания сессии
+    live_offsets = await get_offsets(upload_ids)
+
+    messages = []
+    for item in items:
+        item = dict(item)
+        item.pop("deleted_by_sender", None)
+        item.pop("deleted_by_receiver", None)
+        db_offset, upload_total = uploads_info.get(item["upload_id"], (None, None))
+        upload_offset = live_offsets.get(item["upload_id"], db_offset)
+        item["is_read"] = is_read_by_receiver(item["id"], item["receiver_id"], user_id, read_by_user, read_by_partner)
+        item["upload_offset"] = upload_offset
+        item["upload_total"] = upload_total
+        item["upload_progress"] = (upload_offset / upload_total) if upload_offset and upload_total else 0
+        messages.append(item)
 
     # Возвращаем в обратном хронологическом порядке для FlatList inverted
-    return unique_messages
+    return _dedup_by_client_id(messages), next_cursor
 
-@router.get("/dialogs", response_model=List[DialogResponse])
-async def get_dialogs(
+async def _recent_history_items(db: AsyncSession, user_id: int, other_user_id: int) -> List[dict]:
+    """Последние CHAT_HISTORY_CACHE_SIZE сообщений диалога с обеих сторон, включая удаленные одним из участников."""
+    sent = _history_branch(user_id, other_user_id, None, CHAT_HISTORY_CACHE_SIZE, None, None)
+    received = _history_branch(other_user_id, user_id, None, CHAT_HISTORY_CACHE_SIZE, None, None)
+    page_ids = union_all(select(sent.c.id), select(received.c.id)).subquery()
+    result = await db.execute(
+        select(ChatMessage)
+        .options(joinedload(ChatMessage.reply_to).joinedload(ChatMessage.sender), selectinload(ChatMessage.attachments))
+        .where(ChatMessage.id.in_(select(page_ids.c.id)))
+        .order_by(ChatMessage.timestamp.desc(), ChatMessage.id.desc())
+        .limit(CHAT_HISTORY_CACHE_SIZE)
+    )
+    return [history_item(m, _reply_to_item(m)) for m in result.scalars().unique().all()]
+
+async def _cached_first_page(db: AsyncSession, user_id: int, other_user_id: int, limit: int):
+    """
+    Первая страница истории из кольцевого буфера диалога в Redis. При промахе буфер заполняется из БД.
+    None - ответить из буфера нельзя (Redis недоступен или видимых читающему сообщений в буфере меньше limit).
+    """
+    cached = await chat_cache.read(user_id, other_user_id)
+    if cached is None:
+        expected_version = await chat_cache.version(user_id, other_user_id)
+        if expected_version is None:
+            CHAT_HISTORY_CACHE_REQUESTS.labels("miss").inc()
+            return None
+        items = await _recent_history_items(db, user_id, other_user_id)
+        complete = len(items) < CHAT_HISTORY_CACHE_SIZE
+        await chat_cache.fill(user_id, other_user_id, items, complete, expected_version)
+        CHAT_HISTORY_CACHE_REQUESTS.labels("miss").inc()
+    else:
+        items, complete = cached
+        CHAT_HISTORY_CACHE_REQUESTS.labels("hit").inc()
+
+    visible = [item for item in items if visible_to(item, user_id)]
+    if len(visible) < limit and not complete:
+        # Читающий удалил у себя часть последних сообщений - страница глубже буфера
+        return None
+    return await _history_page(db, user_id, other_user_id, visible[:limit], limit)
+
+async def load_chat_history(
+    db: AsyncSession,
+    user_id: int,
+    other_user_id: int,
+    limit: int = 15,
+    skip: int = 0,
+    before_id: Optional[int] = None,
+    before_ts: Optional[datetime] = None
+):
+    """
+    Возвращает (messages, next_cursor) для диалога user_id <-> other_user_id.
+    В режиме курсора (before_id/before_ts) страница N стоит столько же, сколько первая;
+    skip поддерживается для старых клиентов. Первая страница отдается из буфера в Redis (chat_cache).
+    """
+    if before_id is None and before_ts is None and skip == 0 and limit <= CHAT_HISTORY_CACHE_SIZE:
+        page = await _cached_first_page(db, user_id, other_user_id, limit)
+        if page is not None:
+            return page
+
+    if before_id is not None and before_ts is None:
+        before_ts = (await db.execute(select(ChatMessage.timestamp).where(ChatMessage.id == before_id))).scalar_one_or_none()
+        if before_ts is None:
+            return [], None
+
+    window = skip + limit
+    sent = _history_branch(user_id, other_user_id, ChatMessage.deleted_by_sender, window, before_ts, before_id)
+    received = _history_branch(other_user_id, user_id, ChatMessage.deleted_by_receiver, window, before_ts, before_id)
+    page_ids = union_all(select(sent.c.id), select(received.c.id)).subquery()
+
+    result = await db.execute(
+        select(ChatMessage, FileUploadSession.offset.label("upload_offset"), FileUploadSession.file_size.label("upload_total"))
+        .outerjoin(FileUploadSession, ChatMessage.upload_id == FileUploadSession.id)
+        .options(joinedload(ChatMessage.reply_to).joinedload(ChatMessage.sender), selectinload(ChatMessage.attachments))
+        .where(ChatMessage.id.in_(select(page_ids.c.id)))
+        .order_by(ChatMessage.timestamp.desc(), ChatMessage.id.desc())
+        .offset(skip)
+        .limit(limit)
+    )
+    db_rows = result.all()
+    items = [history_item(row.ChatMessage, _reply_to_item(row.ChatMessage)) for row in db_rows]
+    uploads_info = {
+        row.ChatMessage.upload_id: (row.upload_offset, row.upload_total)
+        for row in db_rows if row.ChatMessage.upload_id
+    }
+    return await _history_page(db, user_id, other_user_id, items, limit, uploads_info)
+
+@router.get("/history/{other_user_id}", response_model=List[ChatMessageResponse])
+async def get_chat_history(
+    other_user_id: int,
+    limit: int = 15,
+    skip: int = 0,
+    before_id: Optional[int] = None,
+    before_ts: Optional[datetime] = None,
     db: AsyncSession = Depends(get_async_db),
     current_user: UserModel = Depends(get_current_user)
 ):
     user_id = current_user.id
     if user_id is None:
-        raise HTTPException(status_code=401, detail="Invalid token")
+        return []
 
-    # Находим всех собеседников, с которыми есть активные (не удаленные) сообщения
-    # Сначала те, кому мы писали
-    sent_to = select(ChatMessage.receiver_id).where(
-        ChatMessage.sender_id == user_id, 
-        ChatMessage.deleted_by_sender == False
-    )
-    # Потом те, кто нам писал
-    received_from = select(ChatMessage.sender_id).where(
-        ChatMessage.receiver_id == user_id, 
-        ChatMessage.deleted_by_receiver == False
-    )
-    
-    # Объединяем id собеседников и убираем дубликаты
-    partners_query = sent_to.union(received_from)
-    partners_result = await db.execute(partners_query)
-    # Используем set для уникальности, на случай если union не сработал как DISTINCT
-    partner_ids = list(set(partners_result.scalars().all()))
+    messages, _ = await load_chat_history(db, user_id, other_user_id, limit, skip, before_id, before_ts)
+    return messages
 
-    dialogs = []
-    for p_id in partner_ids:
-        if p_id == user_id: continue # На всякий случай
-
-        # Получаем данные пользователя
-        user_res = await db.execute(select(UserModel).where(UserModel.id == p_id))
-        partner = user_res.scalar_one_or_none()
-        if not partner: continue
-
-        # Последнее сообщение в диалоге
-        last_msg_res = await db.execute(
-            select(ChatMessage).where(
-                or_(
-                    and_(ChatMessage.sender_id == user_id, ChatMessage.receiver_id == p_id, ChatMessage.deleted_by_sender == False),
-                    and_(ChatMessage.sender_id == p_id, ChatMessage.receiver_id == user_id, ChatMessage.deleted_by_receiver == False)
-                )
-            )
-            .where(
-                or_(
-                    ChatMessage.is_uploading == False,
-                    ChatMessage.timestamp >= datetime.utcnow() - timedelta(hours=1)
-                )
-            )
-            .order_by(ChatMessage.timestamp.desc()).limit(1)
+@router.get("/history/{other_user_id}/page", response_model=ChatHistoryPage)
+async def get_chat_history_page(
+    other_user_id: int,
+    limit: int = Query(default=15, ge=1, le=100),
+    before_id: Optional[int] = None,
+    before_ts: Optional[datetime] = None,
+    db: AsyncSession = Depends(get_async_db),
+    current_user: UserModel = Depends(get_current_user)
+):
+    """
+    Страница истории по курсору: передайте next_cursor из предыдущего ответа, чтобы получить более старые сообщения.
+    Когда сообщения в БД закончились, а старые месяцы выгружены в архив, archive_cursor - курсор для /archive.
+    """
+    messages, next_cursor = await load_chat_history(db, current_user.id, other_user_id, limit, 0, before_id, before_ts)
+    archive_cursor = None
+    if next_cursor is None:
+        archived_until = await chat_archive.has_archives(db)
+        if archived_until is not None:
+            if messages:
+                archive_cursor = {"before_id": messages[-1]["id"], "before_ts": messages[-1]["timestamp"]}
+            elif before_ts is not None:
+                archive_cursor = {"before_id": before_id or 0, "before_ts": before_ts}
+            else:
+                archive_cursor = {"before_id": 0, "before_ts": archived_until}
+    return {"data": messages, "next_cursor": next_cursor, "archive_cursor": archive_cursor}
+
+@router.get("/history/{other_user_id}/archive", response_model=ChatHistoryPage)
+async def get_archived_chat_history(
+    other_user_id: int,
+    limit: int = Query(default=15, ge=1, le=100),
+    before_id: Optional[int] = None,
+    before_ts: Optional[datetime] = None,
+    db: AsyncSession = Depends(get_async_db),
+    current_user: UserModel = Depends(get_current_user)
+):
+    """
+    Медленный путь истории: сообщения из выгруженных в архив секций (Parquet). Начните с archive_cursor
+    из /page и передавайте next_cursor, пока он не станет null.
+    """
+    rows = await chat_archive.read_dialog(db, current_user.id, other_user_id, limit, before_ts, before_id)
+    archived: Dict[int, List[ChatAttachment]] = {
+        row["id"]: [ChatAttachment(**a) for a in row.pop("attachments")] for row in rows if "attachments" in row
+    }
+    # Архивы старого формата вложений не содержат: их строки могли остаться в chat_attachments
+    legacy_ids = [row["id"] for row in rows if row["id"] not in archived]
+    if legacy_ids:
+        res = await db.execute(
+            select(ChatAttachment)
+            .where(ChatAttachment.message_id.in_(legacy_ids))
+            .order_by(ChatAttachment.position)
         )
-        last_msg = last_msg_res.scalar_one_or_none()
-        if not last_msg: continue # Если нет видимых сообщений, не показываем диалог
-        
-        # Кол-во непрочитанных от этого пользователя
-        unread_res = await db.execute(
-            select(func.count(ChatMessage.id)).where(
-                ChatMessage.sender_id == p_id,
-                ChatMessage.receiver_id == user_id,
-                ChatMessage.is_read == 0,
-                ChatMessage.deleted_by_receiver == False
-            )
+        for attachment in res.scalars():
+            archived.setdefault(attachment.message_id, []).append(attachment)
+
+    items = []
+    for row in rows:
+        item = history_item(ChatMessage(**row), None)
+        if archived.get(row["id"]):
+            item["attachments"] = chat_attachments.items(archived[row["id"]])
+        items.append(item)
+    messages, next_cursor = await _history_page(db, current_user.id, other_user_id, items, limit, uploads_info={})
+    return {"data": messages, "next_cursor": next_cursor}
+
+@router.get("/search/{other_user_id}", response_model=ChatSearchPage)
+async def search_messages_api(
+    other_user_id: int,
+    q: str = Query(..., min_length=1, description="Поисковый запрос"),
+    limit: int = Query(default=20, ge=1, le=100),
+    offset: int = Query(default=0, ge=0),
+    db: AsyncSession = Depends(get_async_db),
+    current_user: UserModel = Depends(get_current_user)
+):
+    """Поиск по сообщениям диалога: результаты по убыванию релевантности, с подсвеченными фрагментами."""
+    items, next_offset = await search_chat_messages(db, current_user.id, other_user_id, q, limit=limit, offset=offset)
+    return {"data": items, "next_offset": next_offset}
+
+@router.get("/dialogs", response_model=List[DialogResponse])
+async def get_dialogs(
+    db: AsyncSession = Depends(get_async_db),
+    current_user: UserModel = Depends(get_current_user)
+):
+    user_id = current_user.id
+    if user_id is None:
+        raise HTTPException(status_code=401, detail="Invalid token")
+
+    # Список диалогов читается из денормализованной сводки одним индексированным запросом
+    result = await db.execute(
+        select(ChatDialog, UserModel)
+        .join(UserModel, UserModel.id == ChatDialog.partner_id)
+        .where(
+            ChatDialog.user_id == user_id,
+            ChatDialog.partner_id != user_id,
+            ChatDialog.last_message_id.isnot(None) # Если нет видимых сообщений, не показываем диалог
         )
-        unread_count = unread_res.scalar()
+        .order_by(ChatDialog.last_message_time.desc())
+    )
 
+    rows = result.all()
+    # Живой статус берем из Redis: users.status/last_seen записываются туда с задержкой (flush_presence)
+    live = await presence.get_statuses([partner.id for _, partner in rows])
+
+    dialogs = []
+    for dialog, partner in rows:
+        status, last_seen = live.get(partner.id, (partner.status, partner.last_seen))
         dialogs.append({
-            "user_id": p_id,
+            "user_id": partner.id,
             "email": partner.email,
             "first_name": partner.first_name,
             "last_name": partner.last_name,
             "avatar_url": getattr(partner, 'avatar_url', None), 
-            "last_message": last_msg.message if last_msg and last_msg.message else "[Файл]",
-            "last_message_time": last_msg.timestamp if last_msg and last_msg.timestamp else datetime.utcnow(),
-            "unread_count": unread_count or 0,
-            "status": partner.status,
-            "last_seen": partner.last_seen
+            "last_message": dialog.last_message_preview or "[Файл]",
+            "last_message_time": dialog.last_message_time or datetime.utcnow(),
+            "unread_count": dialog.unread_count or 0,
+            "status": status,
+            "last_seen": last_seen or partner.last_seen
         })
 
-    # Сортируем по времени последнего сообщения
-    dialogs.sort(key=lambda x: x["last_message_time"], reverse=True)
     return dialogs
 
+@router.get("/unread")
+async def get_unread_counts(
+    db: AsyncSession = Depends(get_async_db),
+    current_user: UserModel = Depends(get_current_user)
+):
+    """Счетчики непрочитанных: общий бейдж и по каждому диалогу."""
+    return await unread.get_unread_counts(current_user.id, db=db)
+
 @router.post("/mark-as-read/{other_user_id}")
 async def mark_messages_as_read(
     other_user_id: int,
+    last_message_id: Optional[int] = Query(None, ge=1, description="Последнее сообщение диалога, которое видел клиент"),
     db: AsyncSession = Depends(get_async_db),
     current_user: UserModel = Depends(get_current_user)
 ):
@@ -1142,22 +1065,14 @@ async def mark_messages_as_read(
     if user_id is None:
         raise HTTPException(status_code=401, detail="Invalid token")
 
-    await db.execute(
-        update(ChatMessage)
-        .where(
-            ChatMessage.sender_id == other_user_id,
-            ChatMessage.receiver_id == user_id,
-            ChatMessage.is_read == 0,
-            ChatMessage.deleted_by_receiver == False
-        )
-        .values(is_read=1)
-    )
+    await mark_dialog_read(db, user_id, other_user_id, last_message_id)
     await db.commit()
+    badge = await unread.reset_unread(user_id, other_user_id)
 
     # Уведомляем пользователя об обновлении счетчиков
     await notifications_manager.send_personal_message({
         "type": "messages_read",
-        "data": {"from_user_id": other_user_id}
+        "data": {"from_user_id": other_user_id, "unread": badge}
     }, user_id)
 
     # Уведомляем отправителя о том, что его сообщения прочитаны
@@ -1209,34 +1124,32 @@ async def delete_message(
         # Удаление только для себя (получателя)
         message.deleted_by_receiver = True
         logger.info(f"API: Message {message_id} soft-deleted for receiver {user_id}")
-    
+
+    if is_sender:
+        await refresh_dialog_pair(db, sender_id, receiver_id)
+    else:
+        await refresh_dialog(db, user_id, sender_id)
     await db.commit()
 
     # Если удаляет отправитель ("для всех") и есть файл — удаляем его физически
     if is_sender and file_path:
         try:
+            urls = chat_compaction.file_path_urls(file_path, message.message_type)
+            urls += await chat_compaction.attachment_urls(db, [message_id])
             # Очищаем контент
             message.message = "[Сообщение удалено]"
             message.file_path = None
+            await chat_attachments.delete_for_messages(db, [message_id])
             await db.commit()
-
-            root_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-            if message.message_type == "media_group":
-                try:
-                    attachments = json.loads(file_path)
-                    for att in attachments:
-                        att_path = att.get("file_path")
-                        if att_path:
-                            abs_path = os.path.join(root_dir, att_path.lstrip("/"))
-                            if os.path.exists(abs_path):
-                                os.remove(abs_path)
-                except: pass
-            else:
-                abs_path = os.path.join(root_dir, file_path.lstrip("/"))
-                if os.path.exists(abs_path):
-                    os.remove(abs_path)
+            await chat_compaction.delete_media(db, urls)
         except Exception as e:
             logger.error(f"Error deleting chat file: {e}")
+        await chat_cache.invalidate(sender_id, receiver_id)
+    else:
+        await chat_cache.patch(sender_id, receiver_id, message_id, {
+            "deleted_by_sender": message.deleted_by_sender,
+            "deleted_by_receiver": message.deleted_by_receiver
+        })
 
     # Уведомляем участников через WebSocket чата
     delete_event = {
@@ -1246,17 +1159,18 @@ async def delete_message(
         "receiver_id": receiver_id,
         "deleted_for_all": is_sender
     }
+    frame = encode_event(delete_event)
     
     # Если удалено для всех, уведомляем обоих. 
     # Если только для себя, уведомляем только себя (чтобы интерфейс обновился)
     if is_sender:
-        await manager.send_personal_message(delete_event, receiver_id)
-        await manager.send_personal_message(delete_event, user_id)
-        await notifications_manager.send_personal_message(delete_event, receiver_id)
-        await notifications_manager.send_personal_message(delete_event, user_id)
+        await manager.send_personal_message(frame, receiver_id)
+        await manager.send_personal_message(frame, user_id)
+        await notifications_manager.send_personal_message(frame, receiver_id, stream=False)
+        await notifications_manager.send_personal_message(frame, user_id, stream=False)
     else:
-        await manager.send_personal_message(delete_event, user_id)
-        await notifications_manager.send_personal_message(delete_event, user_id)
+        await manager.send_personal_message(frame, user_id)
+        await notifications_manager.send_personal_message(frame, user_id, stream=False)
 
     return {"status": "ok"}
 
@@ -1284,9 +1198,11 @@ async def bulk_delete_messages(
     if not messages:
         return {"status": "ok", "deleted_count": 0}
 
-    root_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-    
     deleted_ids = []
+    affected_dialogs = set()
+    cleared_dialogs = set()
+    cleared_ids = []
+    cleared_urls = []
     for msg in messages:
         receiver_id = msg.receiver_id
         sender_id = msg.sender_id
@@ -1299,32 +1215,18 @@ async def bulk_delete_messages(
             # Soft delete для всех
             msg.deleted_by_sender = True
             msg.deleted_by_receiver = True
-            # Удаляем файлы
+            # Файлы удаляются после фиксации, если на них больше нет ссылок
             if file_path:
-                try:
-                    msg.message = "[Сообщение удалено]"
-                    msg.file_path = None
-                    # Если это JSON список (media_group), удаляем все файлы
-                    if msg.message_type == "media_group":
-                        try:
-                            attachments = json.loads(file_path)
-                            for att in attachments:
-                                att_path = att.get("file_path")
-                                if att_path:
-                                    abs_path = os.path.join(root_dir, att_path.lstrip("/"))
-                                    if os.path.exists(abs_path):
-                                        os.remove(abs_path)
-                        except: pass
-                    else:
-                        abs_path = os.path.join(root_dir, file_path.lstrip("/"))
-                        if os.path.exists(abs_path):
-                            os.remove(abs_path)
-                except Exception as e:
-                    logger.error(f"Error deleting chat file: {e}")
+                cleared_dialogs.add((sender_id, receiver_id))
+                cleared_ids.append(message_id)
+                cleared_urls += chat_compaction.file_path_urls(file_path, msg.message_type)
+                msg.message = "[Сообщение удалено]"
+                msg.file_path = None
         else:
             msg.deleted_by_receiver = True
 
         deleted_ids.append(message_id)
+        affected_dialogs.add((sender_id, receiver_id, is_sender))
         
         # Уведомляем участников
         delete_event = {
@@ -1334,17 +1236,30 @@ async def bulk_delete_messages(
             "receiver_id": receiver_id,
             "deleted_for_all": is_sender
         }
+        frame = encode_event(delete_event)
         
         if is_sender:
-            await manager.send_personal_message(delete_event, receiver_id)
-            await manager.send_personal_message(delete_event, user_id)
-            await notifications_manager.send_personal_message(delete_event, receiver_id)
-            await notifications_manager.send_personal_message(delete_event, user_id)
+            await manager.send_personal_message(frame, receiver_id)
+            await manager.send_personal_message(frame, user_id)
+            await notifications_manager.send_personal_message(frame, receiver_id, stream=False)
+            await notifications_manager.send_personal_message(frame, user_id, stream=False)
         else:
-            await manager.send_personal_message(delete_event, user_id)
-            await notifications_manager.send_personal_message(delete_event, user_id)
+            await manager.send_personal_message(frame, user_id)
+            await notifications_manager.send_personal_message(frame, user_id, stream=False)
 
+    for d_sender_id, d_receiver_id, d_for_all in affected_dialogs:
+        if d_for_all:
+            await refresh_dialog_pair(db, d_sender_id, d_receiver_id)
+        else:
+            await refresh_dialog(db, user_id, d_sender_id)
+    cleared_urls += await chat_compaction.attachment_urls(db, cleared_ids)
+    await chat_attachments.delete_for_messages(db, cleared_ids)
     await db.commit()
+    try:
+        await chat_compaction.delete_media(db, cleared_urls)
+    except Exception as e:
+        logger.error(f"Error deleting chat files: {e}")
+    await _sync_deleted_messages(messages, cleared_dialogs)
     return {"status": "ok", "deleted_count": len(deleted_ids)}
 
 @router.post("/upload")
@@ -1373,7 +1288,7 @@ async def upload_chat_file(
 
     # Сохраняем оригинал через абстракцию хранилища
     base_name = str(uuid.uuid4())
-    original_url, _ = storage.save_file(
+    original_url, _ = await aiofile.save_file(
         category="chat",
         filename_hint=f"{base_name}{file_extension or ''}",
         fileobj=io.BytesIO(content),
@@ -1390,7 +1305,7 @@ async def upload_chat_file(
                 fmt = "JPEG" if file_extension_lower in [".jpg", ".jpeg"] else None
                 img.save(thumb_buffer, format=fmt)
                 thumb_buffer.seek(0)
-                _thumb_url, _ = storage.save_file(
+                _thumb_url, _ = await aiofile.save_file(
                     category="chat",
                     filename_hint=f"{base_name}_thumb{file_extension or ''}",
                     fileobj=thumb_buffer,
@@ -1402,6 +1317,331 @@ async def upload_chat_file(
 
     return {"file_path": original_url, "message_type": message_type}
 
+# --- Возобновляемые загрузки медиа чата (общий сервис app.services.uploads) ---
+
+async def create_upload_placeholder(
+    db: AsyncSession,
+    sender: UserModel,
+    upload_id: str,
+    receiver_id: int,
+    client_id: Optional[str],
+    message_type: Optional[str],
+    duration: Optional[float],
+    reply_to_id: Optional[int]
+) -> ChatMessage:
+    """Создает (или переиспользует по client_id) placeholder-сообщение загрузки и рассылает new_message."""
+    user_id = sender.id
+    # Проверяем, не создано ли уже сообщение с таким client_id (например, через WS)
+    stmt_check = select(ChatMessage).where(
+        ChatMessage.sender_id == user_id,
+        ChatMessage.client_id == client_id
+    )
+    existing_msg = (await db.execute(stmt_check)).scalars().first() if client_id else None
+    
+    if existing_msg:
+        logger.debug(f"Upload placeholder: Message with client_id {client_id} already exists (id: {existing_msg.id}). Updating upload_id.")
+        existing_msg.upload_id = upload_id
+        new_msg = existing_msg
+        # Убеждаемся, что статус uploading установлен
+        new_msg.is_uploading = True
+    else:
+        new_msg = ChatMessage(
+            sender_id=user_id,
+            receiver_id=receiver_id,
+            message=None,
+            file_path=None,
+            message_type=message_type or "file",
+            client_id=client_id,
+            duration=duration,
+            reply_to_id=reply_to_id,
+            is_uploading=True,
+            upload_id=upload_id
+        )
+        db.add(new_msg)
+    
+    await db.flush()
+    await touch_dialogs(db, new_msg, count_unread=existing_msg is None)
+    await db.commit()
+    await db.refresh(new_msg)
+    remember_upload(upload_id, new_msg)
+    if existing_msg is None:
+        await bump_unread(new_msg)
+    
+    # Отправляем уведомление о новом сообщении (плейсхолдере)
+    sender_name = f"{sender.first_name} {sender.last_name}".strip() or "Пользователь"
+    
+    # Готовим данные отвечаемого сообщения, если оно есть
+    reply_to_data = None
+    if reply_to_id:
+        try:
+            reply_res = await db.execute(
+                select(ChatMessage, UserModel.first_name, UserModel.last_name)
+                .join(UserModel, ChatMessage.sender_id == UserModel.id)
+                .where(ChatMessage.id == reply_to_id)
+            )
+            reply_row = reply_res.first()
+            if reply_row:
+                r_msg, r_fname, r_lname = reply_row
+                reply_to_data = {
+                    "id": r_msg.id,
+                    "message": r_msg.message,
+                    "message_type": r_msg.message_type,
+                    "sender_id": r_msg.sender_id,
+                    "sender_name": f"{r_fname} {r_lname}".strip() or "Пользователь"
+                }
+        except Exception:
+            pass
+    await cache_sent_message(new_msg, reply_to_data)
+
+    response_data = {
+        "id": new_msg.id,
+        "client_id": client_id,
+        "sender_id": user_id,
+        "sender_name": sender_name,
+        "receiver_id": receiver_id,
+        "message": None,
+        "file_path": None,
+        "message_type": message_type or "file",
+        "duration": duration,
+        "reply_to_id": reply_to_id,
+        "reply_to": reply_to_data,
+        "timestamp": new_msg.timestamp.isoformat(),
+        "is_read": 0,
+        "is_uploading": True,
+        "upload_id": upload_id
+    }
+    chat_event = {"type": "new_message", "data": response_data}
+    frame = encode_event(chat_event)
+    await asyncio.gather(
+        manager.send_personal_message(frame, receiver_id),
+        manager.send_personal_message(frame, user_id),
+        notifications_manager.send_personal_message(frame, receiver_id, stream=False),
+        notifications_manager.send_personal_message(frame, user_id, stream=False),
+        return_exceptions=True
+    )
+    return new_msg
+
+
+async def _on_chat_upload_created(db: AsyncSession, sender: UserModel, session: FileUploadSession) -> None:
+    """tus: placeholder по метаданным загрузки (receiver_id, client_id, message_type, duration, reply_to_id)."""
+    meta = get_metadata(session)
+    if not meta.get("receiver_id"):
+        return
+    try:
+        receiver_id = int(meta["receiver_id"])
+        reply_to_id = int(meta["reply_to_id"]) if meta.get("reply_to_id") else None
+        duration = float(meta["duration"]) if meta.get("duration") else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid upload metadata")
+    await create_upload_placeholder(
+        db, sender, session.id, receiver_id, meta.get("client_id"),
+        meta.get("message_type"), duration, reply_to_id
+    )
+
+
+async def _on_chat_upload_progress(db: AsyncSession, session: FileUploadSession) -> None:
+    # Отправляем прогресс по WebSocket, если есть placeholder-сообщение.
+    # Placeholder берется из памяти процесса, промежуточные значения схлопываются (не чаще WS_UPLOAD_PROGRESS_INTERVAL)
+    user_id = session.user_id
+    target = await get_upload_target(db, session.id, user_id)
+    if not target:
+        return
+    progress_payload = {
+        "type": "upload_progress",
+        "data": {
+            "upload_id": session.id,
+            "message_id": target.message_id,
+            "offset": session.offset,
+            "total": session.file_size,
+            "progress": float(session.offset) / float(session.file_size) if session.file_size else 0.0
+        }
+    }
+    frame = encode_event(progress_payload)
+    for recipient_id in {user_id, target.receiver_id}:
+        await coalescer.submit(
+            "upload_progress", (user_id, recipient_id, session.id),
+            partial(manager.send_personal_message, frame, recipient_id),
+            force=session.offset >= session.file_size
+        )
+
+
+async def _on_chat_upload_completed(db: AsyncSession, session: FileUploadSession, url: str) -> dict:
+    """Файл сохранен: обновляет placeholder-сообщения, рассылает message_updated и FCM получателю."""
+    upload_id = session.id
+    user_id = session.user_id
+    forget_upload(upload_id)
+    message_type, _ = resolve_upload_type(session.filename, session.mime_type)
+
+    # Пытаемся обновить placeholder-сообщения (могут быть дубли при сбоях)
+    res_msg2 = await db.execute(
+        select(ChatMessage).where(
+            ChatMessage.upload_id == upload_id,
+            ChatMessage.sender_id == user_id
+        )
+    )
+    upd_messages = res_msg2.scalars().all()
+    
+    upd_msg = None
+    meta = get_metadata(session)
+    attachments = {}
+    if upd_messages:
+        for msg in upd_messages:
+            msg.file_path = url
+            # Не меняем тип, если это видео-заметка (кружок)
+            if msg.message_type != "video_note":
+                msg.message_type = message_type
+            msg.is_uploading = False
+            msg.upload_id = None
+            # Размер известен из сессии, размеры кадра и длительность - из метаданных клиента, если он их передал
+            attachments[msg.id] = await chat_attachments.replace(db, msg.id, [{
+                **meta,
+                "file_path": url,
+                "type": msg.message_type,
+                "size": session.file_size
+            }])
+        
+        # Используем первое сообщение для уведомления
+        upd_msg = upd_messages[0]
+        # Сообщение изменено на месте - сводки диалога пересчитываются, как после удаления
+        await db.flush()
+        for sender_id, receiver_id in {(msg.sender_id, msg.receiver_id) for msg in upd_messages}:
+            await refresh_dialog_pair(db, sender_id, receiver_id)
+        
+    await db.commit() # Фиксируем всё: и сессию, и сообщение
+    for msg in upd_messages:
+        await chat_cache.patch(msg.sender_id, msg.receiver_id, msg.id, {
+            "file_path": msg.file_path,
+            "message_type": msg.message_type,
+            "is_uploading": False,
+            "upload_id": None,
+            "attachments": chat_attachments.items(attachments[msg.id])
+        })
+    
+    # Отправляем уведомления (вне основной транзакции БД)
+    if upd_msg:
+        try:
+            update_event = {"type": "message_updated", "data": {
+                "id": upd_msg.id,
+                "file_path": url,
+                "message_type": upd_msg.message_type,
+                "is_uploading": False,
+                "upload_id": upload_id,
+                "attachments": chat_attachments.items(attachments[upd_msg.id]),
+                "client_id": upd_msg.client_id,
+                "sender_id": upd_msg.sender_id,
+                "receiver_id": upd_msg.receiver_id,
+                "timestamp": upd_msg.timestamp.isoformat() if upd_msg.timestamp else None
+            }}
+            frame = encode_event(update_event)
+            await asyncio.gather(
+                manager.send_personal_message(frame, user_id),
+                manager.send_personal_message(frame, upd_msg.receiver_id),
+                notifications_manager.send_personal_message(frame, upd_msg.receiver_id, stream=False),
+                notifications_manager.send_personal_message(frame, user_id, stream=False),
+                return_exceptions=True
+            )
+        except Exception as e:
+            logger.error(f"WebSocket notifications failed: {e}")
+        
+        # FCM push-уведомление получателю
+        try:
+            sender_name, sender_avatar, fcm_token = await chat_service.notify_context(db, user_id, upd_msg.receiver_id)
+            if fcm_token:
+                final_type = upd_msg.message_type
+                if final_type == "video_note":
+                    fcm_body = f"📹 Видеосообщение"
+                elif final_type in ("voice", "audio"):
+                    fcm_body = f"🎤 Голосовое сообщение"
+                elif final_type == "image":
+                    fcm_body = "🖼️ Фотография"
+                elif final_type == "video":
+                    fcm_body = "🎥 Видео"
+                else:
+                    fcm_body = "📁 Файл"
+
+                asyncio.create_task(send_fcm_notification(
+                    token=fcm_token,
+                    title=sender_name,
+                    body=fcm_body,
+                    sender_id=user_id,
+                    sender_avatar=sender_avatar,
+                    data={
+                        "chat_id": str(user_id),
+                        "message_id": str(upd_msg.id)
+                    }
+                ))
+        except Exception as e:
+            logger.error(f"FCM notification failed after upload: {e}")
+    
+    res_type = upd_msg.message_type if upd_msg else message_type
+    logger.debug(f"Upload completed for session {upload_id}, message_id: {upd_msg.id if upd_msg else 'N/A'}, type: {res_type}")
+    return {"message_type": res_type}
+
+
+async def _delete_upload_placeholder(db: AsyncSession, user_id: int, upload_id: str) -> None:
+    """Удаляет placeholder отмененной загрузки и уведомляет обоих участников."""
+    msg_stmt = select(ChatMessage).where(
+        ChatMessage.upload_id == upload_id,
+        ChatMessage.sender_id == user_id
+    )
+    res_msg = await db.execute(msg_stmt)
+    ph_msg = res_msg.scalar_one_or_none()
+    
+    if not ph_msg:
+        await db.commit()
+        return
+
+    msg_id = ph_msg.id
+    receiver_id = ph_msg.receiver_id
+    await db.delete(ph_msg)
+    await db.flush()
+    await refresh_dialog_pair(db, user_id, receiver_id)
+    await db.commit()
+    await chat_cache.invalidate(user_id, receiver_id)
+    
+    # Уведомляем участников через WebSocket
+    delete_event = {
+        "type": "message_deleted",
+        "data": {
+            "message_id": msg_id,
+            "upload_id": upload_id
+        }
+    }
+    frame = encode_event(delete_event)
+    await asyncio.gather(
+        manager.send_personal_message(frame, user_id),
+        manager.send_personal_message(frame, receiver_id),
+        notifications_manager.send_personal_message(frame, user_id, stream=False),
+        notifications_manager.send_personal_message(frame, receiver_id, stream=False),
+        return_exceptions=True
+    )
+
+
+async def _on_chat_upload_terminated(db: AsyncSession, session: FileUploadSession) -> None:
+    forget_upload(session.id)
+    await _delete_upload_placeholder(db, session.user_id, session.id)
+
+
+async def cancel_chat_upload(db: AsyncSession, user_id: int, upload_id: str) -> None:
+    """Отмена загрузки по WS (upload_cancelled) и HTTP: сессия, временные файлы и placeholder."""
+    session = await load_session(db, upload_id)
+    if session and session.user_id == user_id:
+        await terminate(db, session)
+        return
+    # Сессии может не быть (placeholder создан по upload_started, а init_upload не дошел)
+    forget_upload(upload_id)
+    await _delete_upload_placeholder(db, user_id, upload_id)
+
+
+register_kind("chat", UploadKind(
+    category="chat",
+    on_complete=_on_chat_upload_completed,
+    on_create=_on_chat_upload_created,
+    on_terminate=_on_chat_upload_terminated,
+    on_progress=_on_chat_upload_progress,
+    stream=True
+))
+
 @router.post("/upload/init", response_model=UploadSessionResponse)
 async def init_upload(
     req: UploadInitRequest,
@@ -1413,98 +1653,14 @@ async def init_upload(
         if user_id is None:
             raise HTTPException(status_code=401, detail="Invalid token")
         
-        upload_id = str(uuid.uuid4())
-        new_session = FileUploadSession(
-            id=upload_id,
-            user_id=user_id,
-            filename=req.filename,
-            file_size=req.file_size,
-            mime_type=req.mime_type
-        )
-        db.add(new_session)
-        
+        new_session = await create_session(db, user_id, req.filename, req.file_size, req.mime_type, kind="chat")
+        upload_id = new_session.id
+
         # Если передан receiver_id, создаем placeholder сообщения сразу
         if req.receiver_id:
-            # Проверяем, не создано ли уже сообщение с таким client_id (например, через WS)
-            stmt_check = select(ChatMessage).where(
-                ChatMessage.sender_id == user_id,
-                ChatMessage.client_id == req.client_id
-            )
-            existing_msg = (await db.execute(stmt_check)).scalars().first()
-            
-            if existing_msg:
-                logger.debug(f"init_upload: Message with client_id {req.client_id} already exists (id: {existing_msg.id}). Updating upload_id.")
-                existing_msg.upload_id = upload_id
-                new_msg = existing_msg
-                # Убеждаемся, что статус uploading установлен
-                new_msg.is_uploading = True
-            else:
-                new_msg = ChatMessage(
-                    sender_id=user_id,
-                    receiver_id=req.receiver_id,
-                    message=None,
-                    file_path=None,
-                    message_type=req.message_type or "file",
-                    client_id=req.client_id,
-                    duration=req.duration,
-                    reply_to_id=req.reply_to_id,
-                    is_uploading=True,
-                    upload_id=upload_id
-                )
-                db.add(new_msg)
-            
-            await db.commit()
-            await db.refresh(new_msg)
-            
-            # Отправляем уведомление о новом сообщении (плейсхолдере)
-            sender_name = f"{current_user.first_name} {current_user.last_name}".strip() or "Пользователь"
-            
-            # Готовим данные отвечаемого сообщения, если оно есть
-            reply_to_data = None
-            if req.reply_to_id:
-                try:
-                    reply_res = await db.execute(
-                        select(ChatMessage, UserModel.first_name, UserModel.last_name)
-                        .join(UserModel, ChatMessage.sender_id == UserModel.id)
-                        .where(ChatMessage.id == req.reply_to_id)
-                    )
-                    reply_row = reply_res.first()
-                    if reply_row:
-                        r_msg, r_fname, r_lname = reply_row
-                        reply_to_data = {
-                            "id": r_msg.id,
-                            "message": r_msg.message,
-                            "message_type": r_msg.message_type,
-                            "sender_id": r_msg.sender_id,
-                            "sender_name": f"{r_fname} {r_lname}".strip() or "Пользователь"
-                        }
-                except Exception:
-                    pass
-
-            response_data = {
-                "id": new_msg.id,
-                "client_id": req.client_id,
-                "sender_id": user_id,
-                "sender_name": sender_name,
-                "receiver_id": req.receiver_id,
-                "message": None,
-                "file_path": None,
-                "message_type": req.message_type or "file",
-                "duration": req.duration,
-                "reply_to_id": req.reply_to_id,
-                "reply_to": reply_to_data,
-                "timestamp": new_msg.timestamp.isoformat(),
-                "is_read": 0,
-                "is_uploading": True,
-                "upload_id": upload_id
-            }
-            chat_event = {"type": "new_message", "data": response_data}
-            await asyncio.gather(
-                manager.send_personal_message(chat_event, req.receiver_id),
-                manager.send_personal_message(chat_event, user_id),
-                notifications_manager.send_personal_message(chat_event, req.receiver_id),
-                notifications_manager.send_personal_message(chat_event, user_id),
-                return_exceptions=True
+            await create_upload_placeholder(
+                db, current_user, upload_id, req.receiver_id, req.client_id,
+                req.message_type, req.duration, req.reply_to_id
             )
         else:
             await db.commit()
@@ -1512,6 +1668,8 @@ async def init_upload(
         return {"upload_id": upload_id, "offset": 0}
     except HTTPException:
         raise
+    except UploadSizeError as e:
+        raise HTTPException(status_code=413, detail=str(e))
     except Exception as e:
         logger.error(f"Error in init_upload: {e}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -1530,13 +1688,14 @@ async def get_active_uploads(
         FileUploadSession.is_completed == False
     ).order_by(FileUploadSession.created_at.desc()))
     sessions = res.scalars().all()
+    offsets = await get_offsets([s.id for s in sessions])
     
     return [
         {
             "upload_id": s.id,
             "filename": s.filename,
             "file_size": s.file_size,
-            "offset": s.offset,
+            "offset": offsets.get(s.id, s.offset),
             "mime_type": s.mime_type,
             "created_at": s.created_at.isoformat()
         } for s in sessions
@@ -1552,8 +1711,7 @@ async def get_upload_status(
     if user_id is None:
         raise HTTPException(status_code=401, detail="Invalid token")
         
-    res = await db.execute(select(FileUploadSession).where(FileUploadSession.id == upload_id))
-    session = res.scalar_one_or_none()
+    session = await load_session(db, upload_id)
     
     if not session or session.user_id != user_id:
         raise HTTPException(status_code=404, detail="Upload session not found")
@@ -1572,56 +1730,7 @@ async def cancel_upload_api(
 ):
     user_id = current_user.id
     logger.info(f"Chat API: User {user_id} cancelled upload {upload_id}")
-    
-    # 1. Удаляем сессию загрузки
-    session_stmt = select(FileUploadSession).where(FileUploadSession.id == upload_id)
-    res_session = await db.execute(session_stmt)
-    session = res_session.scalar_one_or_none()
-    
-    if session and session.user_id == user_id:
-        # Удаляем временный файл
-        root_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-        temp_dir = os.path.join(root_dir, "media", "temp")
-        file_path = os.path.join(temp_dir, f"{upload_id}_{session.filename}")
-        if os.path.exists(file_path):
-            try:
-                os.remove(file_path)
-            except Exception as e:
-                logger.error(f"Failed to delete temp file on upload cancel: {e}")
-                
-        await db.delete(session)
-    
-    # 2. Ищем placeholder сообщение
-    msg_stmt = select(ChatMessage).where(
-        ChatMessage.upload_id == upload_id,
-        ChatMessage.sender_id == user_id
-    )
-    res_msg = await db.execute(msg_stmt)
-    ph_msg = res_msg.scalar_one_or_none()
-    
-    if ph_msg:
-        msg_id = ph_msg.id
-        receiver_id = ph_msg.receiver_id
-        await db.delete(ph_msg)
-        await db.commit()
-        
-        # Уведомляем участников через WebSocket
-        delete_event = {
-            "type": "message_deleted",
-            "data": {
-                "message_id": msg_id,
-                "upload_id": upload_id
-            }
-        }
-        await asyncio.gather(
-            manager.send_personal_message(delete_event, user_id),
-            manager.send_personal_message(delete_event, receiver_id),
-            notifications_manager.send_personal_message(delete_event, user_id),
-            notifications_manager.send_personal_message(delete_event, receiver_id),
-            return_exceptions=True
-        )
-    else:
-        await db.commit()
+    await cancel_chat_upload(db, user_id, upload_id)
         
     return {"status": "ok", "message": "Upload cancelled"}
 
@@ -1658,8 +1767,7 @@ async def upload_chunk(
             "offset": offset, "q_offset": q_offset
         }}
 
-    res = await db.execute(select(FileUploadSession).where(FileUploadSession.id == upload_id))
-    session = res.scalar_one_or_none()
+    session = await load_session(db, upload_id)
     
     if not session or session.user_id != user_id:
         raise HTTPException(status_code=404, detail="Upload session not found")
@@ -1670,184 +1778,10 @@ async def upload_chunk(
     if actual_offset != session.offset:
         return {"status": "error", "message": "Offset mismatch", "current_offset": session.offset}
 
-    # Путь к временному файлу
-    # Используем абсолютный путь относительно корня приложения
-    root_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-    temp_dir = os.path.join(root_dir, "media", "temp")
-    os.makedirs(temp_dir, exist_ok=True)
-    file_path = os.path.join(temp_dir, f"{upload_id}_{session.filename}")
-    
-    # Записываем чанк
-    mode = "ab" if actual_offset > 0 else "wb"
-    with open(file_path, mode) as f:
-        content = await chunk.read()
-        f.write(content)
-        session.offset += len(content)
-
-    # Отправляем прогресс по WebSocket, если есть placeholder-сообщение
     try:
-        res_msg = await db.execute(
-            select(ChatMessage).where(
-                ChatMessage.upload_id == upload_id,
-                ChatMessage.sender_id == user_id
-            )
-        )
-        ph_msg = res_msg.scalar_one_or_none()
-        if ph_msg:
-            progress_payload = {
-                "type": "upload_progress",
-                "data": {
-                    "upload_id": upload_id,
-                    "message_id": ph_msg.id,
-                    "offset": session.offset,
-                    "total": session.file_size,
-                    "progress": float(session.offset) / float(session.file_size) if session.file_size else 0.0
-                }
-            }
-            await asyncio.gather(
-                manager.send_personal_message(progress_payload, user_id),
-                manager.send_personal_message(progress_payload, ph_msg.receiver_id),
-                return_exceptions=True
-            )
+        return await receive(db, session, actual_offset, iter_upload_file(chunk))
+    except UploadConflict as e:
+        return {"status": "error", "message": "Offset mismatch", "current_offset": e.offset}
     except Exception as e:
-        logger.error(f"upload_progress send failed: {e}")
-    
-    if session.offset >= session.file_size:
-        session.is_completed = True
-        session.offset = session.file_size
-        
-        # Загружаем собранный файл в постоянное хранилище (S3/локально)
-        file_extension = os.path.splitext(session.filename)[1]
-        
-        # Определяем тип (по аналогии с обычным upload)
-        message_type = "file"
-        final_content_type = session.mime_type or "application/octet-stream"
-        
-        if file_extension.lower() == ".pdf":
-            final_content_type = "application/pdf"
-
-        if file_extension.lower() in [".jpg", ".jpeg", ".png", ".gif", ".webp"]:
-            message_type = "image"
-        elif file_extension.lower() in [".mp4", ".webm", ".ogg"]:
-            message_type = "video"
-        elif file_extension.lower() in [".m4a", ".mp3", ".wav", ".aac", ".amr", ".3gp"]:
-            message_type = "voice"
-            
-        unique_name = f"{uuid.uuid4()}{file_extension}"
-        try:
-            with open(file_path, "rb") as f_in:
-                url, _ = storage.save_file(
-                    category="chat",
-                    filename_hint=unique_name,
-                    fileobj=f_in,
-                    content_type=final_content_type,
-                    private=False,
-                )
-            
-            # Удаляем временный файл
-            try:
-                os.remove(file_path)
-            except Exception:
-                pass
-                
-            # Пытаемся обновить placeholder-сообщения (могут быть дубли при сбоях)
-            res_msg2 = await db.execute(
-                select(ChatMessage).where(
-                    ChatMessage.upload_id == upload_id,
-                    ChatMessage.sender_id == user_id
-                )
-            )
-            upd_messages = res_msg2.scalars().all()
-            
-            upd_msg = None
-            if upd_messages:
-                for msg in upd_messages:
-                    msg.file_path = url
-                    # Не меняем тип, если это видео-заметка (кружок)
-                    if msg.message_type != "video_note":
-                        msg.message_type = message_type
-                    msg.is_uploading = False
-                    msg.upload_id = None
-                
-                # Используем первое сообщение для уведомления
-                upd_msg = upd_messages[0]
-                
-            await db.commit() # Фиксируем всё: и сессию, и сообщение
-            
-            # Отправляем уведомления (вне основной транзакции БД)
-            if upd_msg:
-                try:
-                    update_event = {"type": "message_updated", "data": {
-                        "id": upd_msg.id,
-                        "file_path": url,
-                        "message_type": upd_msg.message_type,
-                        "is_uploading": False,
-                        "upload_id": upload_id,
-                        "client_id": upd_msg.client_id,
-                        "sender_id": upd_msg.sender_id,
-                        "receiver_id": upd_msg.receiver_id,
-                        "timestamp": upd_msg.timestamp.isoformat() if upd_msg.timestamp else None
-                    }}
-                    await asyncio.gather(
-                        manager.send_personal_message(update_event, user_id),
-                        manager.send_personal_message(update_event, upd_msg.receiver_id),
-                        notifications_manager.send_personal_message(update_event, upd_msg.receiver_id),
-                        notifications_manager.send_personal_message(update_event, user_id),
-                        return_exceptions=True
-                    )
-                except Exception as e:
-                    logger.error(f"WebSocket notifications failed: {e}")
-                
-                # FCM push-уведомление получателю
-                try:
-                    receiver = await db.get(UserModel, upd_msg.receiver_id)
-                    if receiver and receiver.fcm_token:
-                        sender_result = await db.execute(
-                            select(UserModel.first_name, UserModel.last_name, UserModel.avatar_url)
-                            .where(UserModel.id == user_id)
-                        )
-                        sender_row = sender_result.first()
-                        sender_name = f"{sender_row.first_name} {sender_row.last_name}".strip() if sender_row and (sender_row.first_name or sender_row.last_name) else "Пользователь"
-                        sender_avatar = sender_row.avatar_url if sender_row else None
-
-                        final_type = upd_msg.message_type
-                        if final_type == "video_note":
-                            fcm_body = f"📹 Видеосообщение"
-                        elif final_type in ("voice", "audio"):
-                            fcm_body = f"🎤 Голосовое сообщение"
-                        elif final_type == "image":
-                            fcm_body = "🖼️ Фотография"
-                        elif final_type == "video":
-                            fcm_body = "🎥 Видео"
-                        else:
-                            fcm_body = "📁 Файл"
-
-                        asyncio.create_task(send_fcm_notification(
-                            token=receiver.fcm_token,
-                            title=sender_name,
-                            body=fcm_body,
-                            sender_id=user_id,
-                            sender_avatar=sender_avatar,
-                            data={
-                                "chat_id": str(user_id),
-                                "message_id": str(upd_msg.id)
-                            }
-                        ))
-                except Exception as e:
-                    logger.error(f"FCM notification failed after upload: {e}")
-            
-            res_type = upd_msg.message_type if upd_msg else message_type
-            logger.debug(f"Upload completed for session {upload_id}, message_id: {upd_msg.id if upd_msg else 'N/A'}, type: {res_type}")
-            
-            return {
-                "status": "completed",
-                "file_path": url,
-                "message_type": res_type
-            }
-        except Exception as e:
-            logger.error(f"Error finalizing upload {upload_id}: {e}")
-            await db.rollback()
-            raise HTTPException(status_code=500, detail=f"Failed to finalize upload: {str(e)}")
-    
-    await db.commit()
-    return {"status": "ok", "offset": session.offset}
+        logger.error(f"Error storing chunk for upload {upload_id}: {e}")
+        raise HTTPException(status_code=500, detail=f"Failed to store upload: {str(e)}")
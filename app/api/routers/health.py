@@ -3,13 +3,14 @@ from typing import List
 
 from fastapi import APIRouter, BackgroundTasks, Request
 from loguru import logger
-from starlette.responses import HTMLResponse
+from starlette.responses import HTMLResponse, Response
 from starlette.templating import Jinja2Templates
 from starlette.websockets import WebSocketDisconnect, WebSocket
 
 from app.core.celery_app import celery_app as celery
 from app.tasks.example_tasks import send_notification as call_background_task
 from app.core.fcm import send_fcm_notification
+from app.core.metrics import render_metrics
 
 
 router = APIRouter(prefix="", tags=["health"])
@@ -28,6 +29,13 @@ async def health_check():
     return {"status": "healthy"}
 
 
+@router.get("/metrics", include_in_schema=False)
+async def metrics():
+    """Метрики Prometheus: пул соединений БД, WebSocket-соединения, время обработки кадров."""
+    body, content_type = render_metrics()
+    return Response(content=body, media_type=content_type)
+
+
 # Session endpoints (лучше переместить в отдельный router для auth/sessions)
 @router.get("/create_session")
 async def session_set(request: Request):
@@ -8,7 +8,7 @@ import uuid
 import io
 from pathlib import Path
 from PIL import Image
-from app.utils import storage
+from app.utils import aiofile, storage
 
 from app.api.dependencies import get_async_db
 from app.core.auth import get_current_user, get_current_admin, get_current_user_optional
@@ -99,7 +99,7 @@ async def save_news_image(file: UploadFile) -> tuple[str, str]:
     base_name = str(uuid.uuid4())
 
     # Save original via storage abstraction
-    original_url, _ = storage.save_file(
+    original_url, _ = await aiofile.save_file(
         category="news",
         filename_hint=f"{base_name}{extension}",
         fileobj=io.BytesIO(content),
@@ -125,7 +125,7 @@ async def save_news_image(file: UploadFile) -> tuple[str, str]:
             try:
                 img.save(thumb_buffer, format=fmt)
                 thumb_buffer.seek(0)
-                thumb_url, _ = storage.save_file(
+                thumb_url, _ = await aiofile.save_file(
                     category="news",
                     filename_hint=f"{base_name}_thumb{extension}",
                     fileobj=thumb_buffer,
@@ -399,7 +399,7 @@ async def _process_validated_image(file: UploadFile, content: bytes) -> tuple[st
     base_name = str(uuid.uuid4())
 
     # Save original
-    original_url, _ = storage.save_file(
+    original_url, _ = await aiofile.save_file(
         category="news",
         filename_hint=f"{base_name}{extension}",
         fileobj=io.BytesIO(content),
@@ -424,7 +424,7 @@ async def _process_validated_image(file: UploadFile, content: bytes) -> tuple[st
             try:
                 img.save(thumb_buffer, format=fmt)
                 thumb_buffer.seek(0)
-                thumb_url, _ = storage.save_file(
+                thumb_url, _ = await aiofile.save_file(
                     category="news",
                     filename_hint=f"{base_name}_thumb{extension}",
                     fileobj=thumb_buffer,
@@ -861,16 +861,15 @@ async def delete_news(
 
     # Удаление файлов из хранилища
     try:
-        from app.utils import storage as _storage
         for path in paths_to_delete:
             try:
                 if path.startswith("http"):
                     parts = path.split("/")
                     if len(parts) > 4:
                         key = "/".join(parts[4:])
-                        _storage.delete("news", key)
+                        await aiofile.delete("news", key)
                 else:
-                    _storage.delete("news", path)
+                    await aiofile.delete("news", path)
             except Exception as e:
                 print(f"news.delete: failed to delete {path}: {e}")
     except Exception as e:
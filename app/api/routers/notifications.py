@@ -1,72 +1,24 @@
-from typing import Dict, List
+from typing import Dict, List, Set
 import asyncio
+import uuid
 from fastapi import APIRouter, WebSocket, WebSocketDisconnect, Depends
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import update, select, func
+from sqlalchemy import select, func
 import jwt
-from datetime import datetime
 
 from app.core.config import SECRET_KEY, ALGORITHM
 from app.api.dependencies import get_async_db
 from app.models.users import User as UserModel
+from app.core.ws import WebSocketManager, encode_event, send_event
+from app.services import presence
+from app.services.unread import get_unread_counts
 from loguru import logger
 
 router = APIRouter(prefix="/ws", tags=["websocket"])
 
-class ConnectionManager:
-    def __init__(self):
-        # Храним активные подключения: {user_id: [websocket1, websocket2, ...]}
-        self.active_connections: Dict[int, List[WebSocket]] = {}
-
-    async def connect(self, websocket: WebSocket, user_id: int):
-        if user_id not in self.active_connections:
-            self.active_connections[user_id] = []
-        
-        # Close and remove any existing stale connections for this user if they are already connected
-        # Optional: Some apps allow multiple tabs/devices, so we just add to the list.
-        # But if the user has many stale ones, we might want to prune them.
-        self.active_connections[user_id].append(websocket)
-        logger.debug(f"NotificationsManager: User {user_id} connected. Active sockets: {len(self.active_connections[user_id])}")
-
-    def disconnect(self, websocket: WebSocket, user_id: int):
-        if user_id in self.active_connections:
-            try:
-                self.active_connections[user_id].remove(websocket)
-                if not self.active_connections[user_id]:
-                    del self.active_connections[user_id]
-                logger.debug(f"NotificationsManager: User {user_id} disconnected. Remaining sockets: {len(self.active_connections.get(user_id, []))}")
-            except ValueError:
-                pass
-
-    async def send_personal_message(self, message: dict, user_id: int):
-        logger.debug(f"NotificationsManager trying to send message to user {user_id}. Type: {type(user_id)}")
-        logger.debug(f"Active connections: {list(self.active_connections.keys())}")
-        if user_id in self.active_connections:
-            tasks = [connection.send_json(message) for connection in self.active_connections[user_id]]
-            results = await asyncio.gather(*tasks, return_exceptions=True)
-            for i, result in enumerate(results):
-                if isinstance(result, Exception):
-                    logger.error(f"NotificationsManager failed to send to user {user_id}: {result}")
-                    # Remove broken connection
-                    try:
-                        self.active_connections[user_id].pop(i)
-                    except:
-                        pass
-                else:
-                    logger.debug(f"NotificationsManager sent message to user {user_id}: {message.get('type')}")
-            
-            if user_id in self.active_connections and not self.active_connections[user_id]:
-                del self.active_connections[user_id]
-        else:
-            logger.debug(f"User {user_id} NOT found in Notifications active connections.")
-
-    async def broadcast(self, message: dict):
-        tasks = []
-        for user_id in self.active_connections:
-            for connection in self.active_connections[user_id]:
-                tasks.append(connection.send_json(message))
-        if tasks:
-            await asyncio.gather(*tasks, return_exceptions=True)
+class ConnectionManager(WebSocketManager):
+    namespace = "notifications"
+    log_name = "NotificationsManager"
 
 manager = ConnectionManager()
 
@@ -89,24 +41,49 @@ async def get_user_from_token(token: str, db: AsyncSession):
     except jwt.PyJWTError:
         return None
 
-async def update_user_status(user_id: int, status: str, db: AsyncSession):
-    last_seen = None
-    if status == "offline":
-        last_seen = datetime.utcnow().isoformat()
-    
-    await db.execute(
-        update(UserModel)
-        .where(UserModel.id == user_id)
-        .values(status=status, last_seen=last_seen if status == "offline" else UserModel.last_seen)
-    )
-    await db.commit()
-    
-    # Получаем актуальный last_seen из базы, если мы его не обновляли (для online)
-    if status == "online":
-        result = await db.execute(select(UserModel.last_seen).where(UserModel.id == user_id))
-        last_seen = result.scalar()
-        
-    return last_seen
+async def publish_user_status(event: dict, recipients: Set[int]):
+    """Рассылка user_status друзьям и собеседникам (см. app.services.presence); кадр кодируется один раз."""
+    frame = encode_event(event)
+    for recipient_id in recipients:
+        await manager.send_personal_message(frame, recipient_id)
+
+presence.set_publisher(publish_user_status)
+
+async def set_user_online(user_id: int, conn_id: str):
+    """Регистрирует соединение; user_status рассылается, только если пользователь был офлайн."""
+    await presence.connected(user_id, conn_id)
+
+async def set_user_offline(user_id: int, conn_id: str):
+    """Снимает соединение; offline рассылается после задержки, если пользователь не переподключился."""
+    await presence.disconnected(user_id, conn_id)
+
+async def send_initial_state(websocket: WebSocket, user_id: int, db: AsyncSession):
+    """Начальные счетчики сразу после подключения: заявки в друзья и непрочитанные сообщения."""
+    # Send initial friend request count
+    try:
+        from app.models.users import Friendship
+        result = await db.execute(
+            select(func.count(Friendship.id)).where(
+                Friendship.friend_id == user_id,
+                Friendship.status == "pending"
+            )
+        )
+        count = result.scalar()
+        await send_event(websocket, {
+            "type": "friend_requests_count",
+            "count": count
+        })
+    except Exception as e:
+        logger.error(f"Failed to send initial friend requests count: {e}")
+
+    # Бейдж непрочитанных сообщений (из Redis, без запроса к chat_messages)
+    try:
+        await send_event(websocket, {
+            "type": "unread_counts",
+            "data": await get_unread_counts(user_id, db=db)
+        })
+    except Exception as e:
+        logger.error(f"Failed to send initial unread counts: {e}")
 
 @router.websocket("/notifications")
 async def websocket_endpoint(
@@ -135,6 +112,7 @@ async def websocket_endpoint(
 
     from app.database import async_session_maker
     user_id = None
+    conn_id = uuid.uuid4().hex
     try:
         async with async_session_maker() as db:
             user = await get_user_from_token(token, db)
@@ -143,40 +121,16 @@ async def websocket_endpoint(
                 await websocket.close(code=4003)
                 return
             
-            user_id = user.id
+            # get_user_from_token возвращает id пользователя
+            user_id = user
 
             await manager.connect(websocket, user_id)
             logger.info(f"WS Connected: user_id={user_id}")
-            last_seen = await update_user_status(user_id, "online", db)
-            await manager.broadcast({
-                "type": "user_status",
-                "data": {
-                    "user_id": user_id,
-                    "status": "online",
-                    "last_seen": last_seen
-                }
-            })
-
-            # Send initial friend request count
-            from app.api.routers.users import get_friend_requests
-            try:
-                # We need a proper user object or just user_id if the function allows
-                # get_friend_requests(db, current_user)
-                # Let's just do a direct query for simplicity to avoid dependency hell
-                from app.models.users import Friendship
-                result = await db.execute(
-                    select(func.count(Friendship.id)).where(
-                        Friendship.friend_id == user_id,
-                        Friendship.status == "pending"
-                    )
-                )
-                count = result.scalar()
-                await websocket.send_json({
-                    "type": "friend_requests_count",
-                    "count": count
-                })
-            except Exception as e:
-                logger.error(f"Failed to send initial friend requests count: {e}")
+            await set_user_online(user_id, conn_id)
+            await send_initial_state(websocket, user_id, db)
+            last_event_id = websocket.query_params.get("last_event_id")
+            if last_event_id:
+                await manager.replay(websocket, user_id, last_event_id)
     
         try:
             while True:
@@ -186,6 +140,7 @@ async def websocket_endpoint(
                     import json
                     message_data = json.loads(data)
                     if message_data.get("type") == "ping":
+                        await presence.heartbeat(user_id, conn_id)
                         await websocket.send_json({"type": "pong"})
                 except Exception:
                     pass
@@ -193,27 +148,9 @@ async def websocket_endpoint(
             if user_id is not None:
                 logger.info(f"WS Disconnected: user_id={user_id}")
                 manager.disconnect(websocket, user_id)
-                async with async_session_maker() as db_off:
-                    last_seen = await update_user_status(user_id, "offline", db_off)
-                    await manager.broadcast({
-                        "type": "user_status",
-                        "data": {
-                            "user_id": user_id,
-                            "status": "offline",
-                            "last_seen": last_seen
-                        }
-                    })
+                await set_user_offline(user_id, conn_id)
     except Exception as e:
         logger.error(f"WS Error for user_id={user_id if user_id is not None else 'unknown'}: {e}")
         if user_id is not None:
             manager.disconnect(websocket, user_id)
-            async with async_session_maker() as db_err:
-                last_seen = await update_user_status(user_id, "offline", db_err)
-                await manager.broadcast({
-                    "type": "user_status",
-                    "data": {
-                        "user_id": user_id,
-                        "status": "offline",
-                        "last_seen": last_seen
-                    }
-                })
+            await set_user_offline(user_id, conn_id)
@@ -2,7 +2,7 @@ import uuid
 import io
 from pathlib import Path
 from PIL import Image
-from app.utils import storage
+from app.utils import aiofile, storage
 
 from fastapi import APIRouter, Depends, HTTPException, Query, UploadFile, File
 from sqlalchemy import select, update, and_, func, desc
@@ -48,7 +48,7 @@ async def save_product_image(file: UploadFile) -> tuple[str, str]:
     base_name = str(uuid.uuid4())
 
     # Save original via storage
-    original_url, _ = storage.save_file(
+    original_url, _ = await aiofile.save_file(
         category="products",
         filename_hint=f"{base_name}{extension}",
         fileobj=io.BytesIO(content),
@@ -65,7 +65,7 @@ async def save_product_image(file: UploadFile) -> tuple[str, str]:
             fmt = "JPEG" if extension in [".jpg", ".jpeg"] else None
             img.save(thumb_buffer, format=fmt)
             thumb_buffer.seek(0)
-            thumb_url, _ = storage.save_file(
+            thumb_url, _ = await aiofile.save_file(
                 category="products",
                 filename_hint=f"{base_name}_thumb{extension}",
                 fileobj=thumb_buffer,
@@ -78,26 +78,24 @@ async def save_product_image(file: UploadFile) -> tuple[str, str]:
     return original_url, thumb_url
 
 
-def remove_product_image(url: str | None, thumb_url: str | None = None) -> None:
+async def remove_product_image(url: str | None, thumb_url: str | None = None) -> None:
     """
     Удаляет файл(ы) изображения, поддерживает как локальные пути, так и S3/YC URL.
     """
-    from app.utils import storage as _storage
-
-    def _delete_by_path_or_url(p: str):
+    async def _delete_by_path_or_url(p: str):
         if p.startswith("http"):
             parts = p.split("/")
             if len(parts) > 4:
                 key = "/".join(parts[4:])  # products/...
-                _storage.delete("products", key)
+                await aiofile.delete("products", key)
         else:
-            _storage.delete("products", p)
+            await aiofile.delete("products", p)
 
     for image_url in [url, thumb_url]:
         if not image_url:
             continue
         try:
-            _delete_by_path_or_url(image_url)
+            await _delete_by_path_or_url(image_url)
         except Exception as e:
             print(f"remove_product_image: failed to delete {image_url}: {e}")
 
@@ -346,7 +344,7 @@ async def delete_product_image(
     if not product or (product.seller_id != current_user.id and current_user.role not in ['admin', 'owner']):
         raise HTTPException(403, "Not allowed")
 
-    remove_product_image(img.image_url, img.thumbnail_url)
+    await remove_product_image(img.image_url, img.thumbnail_url)
     await db.delete(img)
     
     # Если это было основное фото, обновляем его у товара
@@ -385,7 +383,7 @@ async def delete_product(
     await db.execute(
         update(ProductModel).where(ProductModel.id == product_id).values(is_active=False)
     )
-    remove_product_image(product.image_url, product.thumbnail_url)
+    await remove_product_image(product.image_url, product.thumbnail_url)
 
     await db.commit()
     await db.refresh(product)  # Для возврата is_active = False
@@ -0,0 +1,99 @@
+import uuid
+
+from fastapi import APIRouter, WebSocket, WebSocketDisconnect
+from loguru import logger
+
+from app.api.routers.chat import get_user_from_token, handle_chat_frame
+from app.api.routers.notifications import set_user_online, set_user_offline, send_initial_state
+from app.core.metrics import WS_FRAME_SECONDS
+from app.core.ws import stream_manager, TOPICS, accept, send_event, receive_event
+from app.database import async_session_maker
+from app.services import presence
+
+router = APIRouter(prefix="/ws", tags=["websocket"])
+
+
+def parse_topics(raw, default_all: bool = False) -> set:
+    """
+    topics=chat,presence или ["chat", "presence"]; неизвестные топики отбрасываются.
+    Пусто - все топики при default_all (строка подключения), иначе пустое множество.
+    """
+    if not raw:
+        return set(TOPICS) if default_all else set()
+    if isinstance(raw, str):
+        raw = raw.split(",")
+    elif not isinstance(raw, (list, tuple)):
+        return set()
+    return {str(t).strip() for t in raw} & set(TOPICS)
+
+
+@router.websocket("/stream")
+async def websocket_stream_endpoint(websocket: WebSocket):
+    """
+    Единый сокет вместо /ws/notifications и /chat/ws/{token}.
+    Подключение: /ws/stream?token=...&topics=chat,presence,orders,social[&last_event_id=...]
+    Клиент может менять подписки кадрами {"type": "subscribe"|"unsubscribe", "topics": [...]};
+    остальные кадры обрабатываются так же, как в чат-сокете.
+    Протокол кадров - JSON или msgpack (Sec-WebSocket-Protocol: msgpack).
+    """
+    await accept(websocket)
+
+    token = (websocket.query_params.get("token") or "").strip().strip('"').strip("'")
+    if not token or token in ("null", "undefined"):
+        await websocket.close(code=4003)
+        return
+
+    async with async_session_maker() as db:
+        user = await get_user_from_token(token, db)
+    if user is None:
+        logger.warning(f"Stream WS rejected: invalid token {token[:10]}...")
+        await websocket.close(code=4003)
+        return
+
+    user_id = user.id
+    conn_id = uuid.uuid4().hex
+    try:
+        # Регистрация и начальное состояние - внутри try: обрыв во время рукопожатия тоже снимает сокет и присутствие
+        topics = parse_topics(websocket.query_params.get("topics"), default_all=True)
+        await stream_manager.connect(websocket, user_id, topics)
+        logger.info(f"Stream WS connected: user_id={user_id}, topics={sorted(stream_manager.topics.get(websocket, ()))}")
+        await set_user_online(user_id, conn_id)
+        async with async_session_maker() as db:
+            await send_initial_state(websocket, user_id, db)
+        last_event_id = websocket.query_params.get("last_event_id")
+        if last_event_id:
+            await stream_manager.replay(websocket, user_id, last_event_id)
+
+        while True:
+            try:
+                message_data = await receive_event(websocket)
+            except ValueError as e:
+                logger.error(f"Stream WS frame error: {e}")
+                continue
+
+            msg_type = message_data.get("type", "message")
+
+            if msg_type == "ping":
+                await presence.heartbeat(user_id, conn_id)
+                await send_event(websocket, {"type": "pong"})
+                continue
+
+            if msg_type in ("subscribe", "unsubscribe"):
+                current = set(stream_manager.topics.get(websocket, ()))
+                requested = parse_topics(message_data.get("topics"))
+                current = current | requested if msg_type == "subscribe" else current - requested
+                stream_manager.set_topics(websocket, current)
+                await send_event(websocket, {"type": "subscriptions", "topics": sorted(stream_manager.topics[websocket])})
+                continue
+
+            with WS_FRAME_SECONDS.time():
+                async with async_session_maker() as db:
+                    await handle_chat_frame(websocket, db, user, message_data)
+
+    except WebSocketDisconnect:
+        logger.info(f"Stream WS disconnected for user {user_id}")
+    except Exception as e:
+        logger.error(f"Error in stream WS for user {user_id}: {e}")
+    finally:
+        stream_manager.disconnect(websocket, user_id)
+        await set_user_offline(user_id, conn_id)
@@ -3,12 +3,15 @@ from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select, delete, and_, or_
 import asyncio
 from app.api.dependencies import get_async_db
-from app.api.routers.chat import manager as chat_manager
+from app.api.routers.chat import manager as chat_manager, bump_unread
 from app.api.routers.notifications import manager as notifications_manager
 from app.core.fcm import send_fcm_notification
 from app.models.users import User as UserModel
 from app.models.chat import ChatMessage
 from app.schemas.chat import ChatMessageCreate, ChatMessageResponse
+from app.services import chat_cache
+from app.services.chat import cache_sent_message
+from app.services.chat_dialogs import touch_dialogs, refresh_dialog_pair, get_read_marks, get_read_watermarks, is_read_by_receiver
 from typing import List, Optional
 from datetime import datetime
 import os
@@ -36,8 +39,12 @@ async def send_message_as_user(
         is_read=0
     )
     db.add(new_msg)
+    await db.flush()
+    await touch_dialogs(db, new_msg)
     await db.commit()
     await db.refresh(new_msg)
+    await bump_unread(new_msg)
+    await cache_sent_message(new_msg, None)
     
     # Пытаемся получить имя отправителя и аватарку
     res = await db.execute(select(UserModel.first_name, UserModel.last_name, UserModel.avatar_url).where(UserModel.id == sender_id))
@@ -45,6 +52,8 @@ async def send_message_as_user(
     sender_name = f"{user_info.first_name} {user_info.last_name}" if user_info else f"User {sender_id}"
     sender_avatar = user_info.avatar_url if user_info else None
 
+    read_by_sender, read_by_receiver = await get_read_watermarks(db, sender_id, new_msg.receiver_id)
+
     # Подготовка ответа
     resp_msg = ChatMessageResponse(
         id=new_msg.id,
@@ -56,7 +65,7 @@ async def send_message_as_user(
         client_id=new_msg.client_id,
         duration=new_msg.duration,
         timestamp=new_msg.timestamp,
-        is_read=new_msg.is_read,
+        is_read=is_read_by_receiver(new_msg.id, new_msg.receiver_id, sender_id, read_by_sender, read_by_receiver),
         sender_name=sender_name
     )
 
@@ -68,7 +77,7 @@ async def send_message_as_user(
     await chat_manager.send_personal_message(chat_event, new_msg.receiver_id)
     
     # Также уведомление через notifications_manager
-    await notifications_manager.send_personal_message(chat_event, user_id=new_msg.receiver_id)
+    await notifications_manager.send_personal_message(chat_event, user_id=new_msg.receiver_id, stream=False)
 
     # Push-уведомление через FCM (для тестирования доставки)
     receiver = await db.get(UserModel, new_msg.receiver_id, populate_existing=True)
@@ -127,6 +136,8 @@ async def get_test_history(
     user_ids = list(set([m.sender_id for m in messages]))
     user_res = await db.execute(select(UserModel.id, UserModel.first_name, UserModel.last_name).where(UserModel.id.in_(user_ids)))
     user_map = {u.id: f"{u.first_name} {u.last_name}" for u in user_res.fetchall()}
+    # Прочитанность - по отметкам прочтения диалога, а не по полю is_read строки
+    read_by_user1, read_by_user2 = await get_read_watermarks(db, user1_id, user2_id)
 
     return [
         ChatMessageResponse(
@@ -139,7 +150,7 @@ async def get_test_history(
             client_id=m.client_id,
             duration=m.duration,
             timestamp=m.timestamp,
-            is_read=m.is_read,
+            is_read=is_read_by_receiver(m.id, m.receiver_id, user1_id, read_by_user1, read_by_user2),
             sender_name=user_map.get(m.sender_id, f"User {m.sender_id}")
         ) for m in messages
     ]
@@ -160,7 +171,9 @@ async def clear_test_chat(
         )
     )
     await db.execute(stmt)
+    await refresh_dialog_pair(db, user1_id, user2_id)
     await db.commit()
+    await chat_cache.invalidate(user1_id, user2_id)
     return {"status": "success", "message": f"Chat between {user1_id} and {user2_id} cleared"}
 
 @router.get("/last_messages", response_model=List[ChatMessageResponse])
@@ -179,6 +192,8 @@ async def get_last_messages(
     user_ids = list(set([m.sender_id for m in messages]))
     user_res = await db.execute(select(UserModel.id, UserModel.first_name, UserModel.last_name).where(UserModel.id.in_(user_ids)))
     user_map = {u.id: f"{u.first_name} {u.last_name}" for u in user_res.fetchall()}
+    # Сообщения из разных диалогов: отметка прочтения получателя для каждой пары
+    read_marks = await get_read_marks(db, [(m.receiver_id, m.sender_id) for m in messages])
 
     return [
         ChatMessageResponse(
@@ -191,7 +206,7 @@ async def get_last_messages(
             client_id=m.client_id,
             duration=m.duration,
             timestamp=m.timestamp,
-            is_read=m.is_read,
+            is_read=1 if m.id <= read_marks.get((m.receiver_id, m.sender_id), 0) else 0,
             sender_name=user_map.get(m.sender_id, f"User {m.sender_id}")
         ) for m in messages
     ]
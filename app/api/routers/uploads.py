@@ -0,0 +1,245 @@
+import base64
+import binascii
+from typing import AsyncIterator, Dict, Optional
+
+from fastapi import APIRouter, Depends, HTTPException, Request, Response
+from loguru import logger
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.api.dependencies import get_async_db
+from app.core.auth import get_current_user
+from app.core.config import UPLOAD_MAX_SIZE
+from app.models.chat import FileUploadSession
+from app.models.users import User as UserModel
+from app.services import uploads
+
+# Сервер возобновляемых загрузок по протоколу tus 1.0.0 (https://tus.io/protocols/resumable-upload):
+# core + creation, termination и concatenation. Concatenation позволяет клиенту грузить файл
+# несколькими частями параллельно (Upload-Concat: partial) и затем склеить их (Upload-Concat: final;...).
+# Тип загрузки передается в Upload-Metadata (kind: chat | app), остальные метаданные получает хук типа.
+
+router = APIRouter(prefix="/uploads", tags=["uploads"])
+
+TUS_VERSION = "1.0.0"
+TUS_EXTENSIONS = "creation,termination,concatenation"
+TUS_HEADERS = {"Tus-Resumable": TUS_VERSION}
+
+
+def _error(status_code: int, detail: str) -> HTTPException:
+    return HTTPException(status_code=status_code, detail=detail, headers=TUS_HEADERS)
+
+
+def _check_version(request: Request) -> None:
+    if request.headers.get("Tus-Resumable") != TUS_VERSION:
+        raise HTTPException(
+            status_code=412, detail="Unsupported tus version", headers={"Tus-Version": TUS_VERSION}
+        )
+
+
+def _parse_metadata(raw: Optional[str]) -> Dict[str, str]:
+    """Upload-Metadata: пары "ключ base64(значение)" через запятую."""
+    metadata = {}
+    if not raw:
+        return metadata
+    for pair in raw.split(","):
+        parts = pair.strip().split(" ")
+        if not parts[0]:
+            continue
+        try:
+            metadata[parts[0]] = base64.b64decode(parts[1]).decode() if len(parts) > 1 else ""
+        except (binascii.Error, UnicodeDecodeError):
+            raise _error(400, f"Invalid Upload-Metadata value for {parts[0]}")
+    return metadata
+
+
+def _int_header(request: Request, name: str) -> Optional[int]:
+    value = request.headers.get(name)
+    if value is None:
+        return None
+    if not value.isdigit():
+        raise _error(400, f"Invalid {name}")
+    return int(value)
+
+
+async def _get_session(db: AsyncSession, upload_id: str, user: UserModel) -> FileUploadSession:
+    # Незавершенная загрузка берется из Redis; параллельные PATCH разводит атомарная проверка смещения
+    session = await uploads.load_session(db, upload_id)
+    if not session or session.user_id != user.id:
+        raise _error(404, "Upload not found")
+    return session
+
+
+def _upload_headers(session: FileUploadSession) -> Dict[str, str]:
+    headers = {
+        **TUS_HEADERS,
+        "Upload-Offset": str(session.offset),
+        "Upload-Length": str(session.file_size),
+        "Cache-Control": "no-store",
+    }
+    if session.concat:
+        headers["Upload-Concat"] = session.concat
+    if session.result_url:
+        headers["X-Upload-File-Path"] = session.result_url
+    return headers
+
+
+async def _limit_body(request: Request, remaining: int) -> AsyncIterator[bytes]:
+    received = 0
+    async for data in request.stream():
+        received += len(data)
+        if received > remaining:
+            raise _error(413, "Request body exceeds Upload-Length")
+        yield data
+
+
+@router.options("/files")
+@router.options("/files/{upload_id}")
+async def tus_options():
+    """Возможности сервера (tus discovery)."""
+    return Response(status_code=204, headers={
+        **TUS_HEADERS,
+        "Tus-Version": TUS_VERSION,
+        "Tus-Extension": TUS_EXTENSIONS,
+        "Tus-Max-Size": str(UPLOAD_MAX_SIZE),
+    })
+
+
+@router.post("/files", status_code=201)
+async def tus_create(
+    request: Request,
+    db: AsyncSession = Depends(get_async_db),
+    current_user: UserModel = Depends(get_current_user)
+):
+    """Создает загрузку (creation) или склеивает завершенные части в итоговый файл (concatenation)."""
+    _check_version(request)
+    metadata = _parse_metadata(request.headers.get("Upload-Metadata"))
+    kind_name = metadata.pop("kind", "chat")
+    kind = uploads.get_kind(kind_name)
+    if kind is None:
+        raise _error(400, f"Unknown upload kind: {kind_name}")
+    if not kind.authorize(current_user):
+        raise _error(403, "Upload kind is not allowed")
+
+    filename = metadata.pop("filename", None) or "file"
+    mime_type = metadata.pop("filetype", None)
+    concat_header = (request.headers.get("Upload-Concat") or "").strip()
+
+    if concat_header.startswith("final;"):
+        partial_ids = [url.rstrip("/").rsplit("/", 1)[-1] for url in concat_header[len("final;"):].split()]
+        if not partial_ids:
+            raise _error(400, "Upload-Concat final requires partial uploads")
+        res = await db.execute(select(FileUploadSession).where(FileUploadSession.id.in_(partial_ids)))
+        found = {s.id: s for s in res.scalars().all()}
+        partials = [found.get(upload_id) for upload_id in partial_ids]
+        if any(
+            s is None or s.user_id != current_user.id or s.concat != "partial" or s.kind != kind_name
+            for s in partials
+        ):
+            raise _error(400, "Invalid partial uploads")
+        if not all(s.is_completed for s in partials):
+            raise _error(400, "Partial uploads are not finished")
+
+        try:
+            session = await uploads.create_session(
+                db, current_user.id, filename, sum(s.file_size for s in partials), mime_type,
+                kind=kind_name, concat="final", metadata=metadata
+            )
+        except uploads.UploadSizeError:
+            raise _error(413, "Upload exceeds Tus-Max-Size")
+        if kind.on_create is not None:
+            await kind.on_create(db, current_user, session)
+        try:
+            await uploads.concatenate(db, session, partials)
+        except Exception as e:
+            logger.error(f"tus: concatenation of {session.id} failed: {e}")
+            await db.rollback()
+            raise _error(500, "Failed to concatenate upload")
+        headers = {**TUS_HEADERS, "Location": f"{request.url.path.rstrip('/')}/{session.id}"}
+        if session.result_url:
+            headers["X-Upload-File-Path"] = session.result_url
+        return Response(status_code=201, headers=headers)
+
+    if concat_header and concat_header != "partial":
+        raise _error(400, "Invalid Upload-Concat")
+    upload_length = _int_header(request, "Upload-Length")
+    if not upload_length:
+        raise _error(400, "Upload-Length is required")
+    if upload_length > UPLOAD_MAX_SIZE:
+        raise _error(413, "Upload exceeds Tus-Max-Size")
+
+    session = await uploads.create_session(
+        db, current_user.id, filename, upload_length, mime_type,
+        kind=kind_name, concat=concat_header or None, metadata=metadata
+    )
+    if session.concat is None and kind.on_create is not None:
+        await kind.on_create(db, current_user, session)
+    await db.commit()
+    return Response(status_code=201, headers={
+        **TUS_HEADERS, "Location": f"{request.url.path.rstrip('/')}/{session.id}"
+    })
+
+
+@router.head("/files/{upload_id}")
+async def tus_head(
+    upload_id: str,
+    request: Request,
+    db: AsyncSession = Depends(get_async_db),
+    current_user: UserModel = Depends(get_current_user)
+):
+    """Текущее смещение загрузки: с него клиент продолжает после обрыва."""
+    _check_version(request)
+    session = await _get_session(db, upload_id, current_user)
+    return Response(status_code=200, headers=_upload_headers(session))
+
+
+@router.patch("/files/{upload_id}")
+async def tus_patch(
+    upload_id: str,
+    request: Request,
+    db: AsyncSession = Depends(get_async_db),
+    current_user: UserModel = Depends(get_current_user)
+):
+    """Дописывает тело запроса с позиции Upload-Offset."""
+    _check_version(request)
+    if request.headers.get("Content-Type") != "application/offset+octet-stream":
+        raise _error(415, "Content-Type must be application/offset+octet-stream")
+    offset = _int_header(request, "Upload-Offset")
+    if offset is None:
+        raise _error(400, "Upload-Offset is required")
+
+    session = await _get_session(db, upload_id, current_user)
+    if session.concat == "final":
+        raise _error(403, "Final upload cannot be patched")
+    if offset != session.offset:
+        raise _error(409, "Upload-Offset mismatch")
+    if session.is_completed:
+        return Response(status_code=204, headers=_upload_headers(session))
+
+    try:
+        result = await uploads.receive(db, session, offset, _limit_body(request, session.file_size - offset))
+    except HTTPException:
+        raise
+    except uploads.UploadConflict:
+        raise _error(409, "Upload-Offset mismatch")
+    except Exception as e:
+        logger.error(f"tus: failed to store upload {upload_id}: {e}")
+        raise _error(500, "Failed to store upload")
+    headers = _upload_headers(session)
+    if result.get("file_path"):
+        headers["X-Upload-File-Path"] = result["file_path"]
+    return Response(status_code=204, headers=headers)
+
+
+@router.delete("/files/{upload_id}")
+async def tus_terminate(
+    upload_id: str,
+    request: Request,
+    db: AsyncSession = Depends(get_async_db),
+    current_user: UserModel = Depends(get_current_user)
+):
+    """Отмена загрузки (termination): временные файлы, S3 multipart upload и placeholder."""
+    _check_version(request)
+    session = await _get_session(db, upload_id, current_user)
+    await uploads.terminate(db, session)
+    return Response(status_code=204, headers=TUS_HEADERS)
@@ -59,7 +59,7 @@ from firebase_admin import auth as firebase_auth
 from PIL import Image
 from fastapi import UploadFile, File, Form
 from datetime import datetime
-from app.utils import storage
+from app.utils import aiofile, storage
 
 from sqlalchemy.orm import selectinload
 
@@ -1556,7 +1556,7 @@ async def save_user_photo(file: UploadFile) -> tuple[str, str]:
     content = await file.read()
 
     # Сохраняем оригинал через абстракцию хранилища
-    original_url, original_fs_path = storage.save_file(
+    original_url, original_fs_path = await aiofile.save_file(
         category="users",
         filename_hint=original_name,
         fileobj=io.BytesIO(content),
@@ -1588,7 +1588,7 @@ async def save_user_photo(file: UploadFile) -> tuple[str, str]:
                 img.save(thumb_buffer, format="JPEG")
                 thumb_buffer.seek(0)
                 
-                thumb_url, _ = storage.save_file(
+                thumb_url, _ = await aiofile.save_file(
                     category="users",
                     filename_hint=thumb_name,
                     fileobj=thumb_buffer,
@@ -1612,7 +1612,7 @@ async def save_user_photo(file: UploadFile) -> tuple[str, str]:
                 fmt = "JPEG" if file_extension.lower() in [".jpg", ".jpeg"] else "PNG"
                 img.save(thumb_buffer, format=fmt)
                 thumb_buffer.seek(0)
-                thumb_url, _ = storage.save_file(
+                thumb_url, _ = await aiofile.save_file(
                     category="users",
                     filename_hint=thumb_name,
                     fileobj=thumb_buffer,
@@ -2151,7 +2151,6 @@ async def delete_photo(
     # Удаление файлов
     try:
         # Используем абстракцию хранилища для удаления
-        from app.utils import storage
         # В UserPhoto мы не храним ключи отдельно, поэтому пытаемся извлечь ключ из URL
         # или передаем как есть, если это локальный путь
         if db_photo.image_url.startswith("http"):
@@ -2160,18 +2159,18 @@ async def delete_photo(
             parts = db_photo.image_url.split("/")
             if len(parts) > 4:
                 key = "/".join(parts[4:])
-                storage.delete("users", key)
+                await aiofile.delete("users", key)
         else:
-            storage.delete("users", db_photo.image_url)
+            await aiofile.delete("users", db_photo.image_url)
 
         if db_photo.preview_url and db_photo.preview_url != db_photo.image_url:
             if db_photo.preview_url.startswith("http"):
                 parts = db_photo.preview_url.split("/")
                 if len(parts) > 4:
                     key = "/".join(parts[4:])
-                    storage.delete("users", key)
+                    await aiofile.delete("users", key)
             else:
-                storage.delete("users", db_photo.preview_url)
+                await aiofile.delete("users", db_photo.preview_url)
     except Exception as e:
         print(f"Error deleting files: {e}")
         
@@ -2208,16 +2207,15 @@ async def bulk_delete_photos(
     await db.commit()
     
     # Удаление файлов
-    from app.utils import storage
     for path in paths_to_delete:
         try:
             if path.startswith("http"):
                 parts = path.split("/")
                 if len(parts) > 4:
                     key = "/".join(parts[4:])
-                    storage.delete("users", key)
+                    await aiofile.delete("users", key)
             else:
-                storage.delete("users", path)
+                await aiofile.delete("users", path)
         except Exception as e:
             print(f"Error deleting file {path}: {e}")
             
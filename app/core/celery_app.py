@@ -1,16 +1,19 @@
 from celery import Celery
-from app.core.config import CELERY_BROKER_URL, CELERY_RESULT_BACKEND
+from app.core.config import CELERY_BROKER_URL, CELERY_RESULT_BACKEND, UNREAD_RECONCILE_INTERVAL, PRESENCE_FLUSH_INTERVAL, UPLOAD_GC_INTERVAL, CHAT_WRITE_RECOVER_INTERVAL, CHAT_PARTITION_INTERVAL, CHAT_COMPACTION_INTERVAL
 
 celery_app = Celery(
     "worker",
     broker=CELERY_BROKER_URL,
     backend=CELERY_RESULT_BACKEND,
-    include=["app.tasks.example_tasks"]
+    include=["app.tasks.example_tasks", "app.tasks.chat_tasks", "app.tasks.presence_tasks", "app.tasks.upload_tasks"]
 )
 
 # Форсируем загрузку задач при импорте
 try:
     import app.tasks.example_tasks
+    import app.tasks.chat_tasks
+    import app.tasks.presence_tasks
+    import app.tasks.upload_tasks
 except ImportError:
     pass
 
@@ -21,4 +24,30 @@ celery_app.conf.update(
     timezone="UTC",
     enable_utc=True,
     broker_connection_retry_on_startup=True,
+    beat_schedule={
+        "reconcile-unread-counters": {
+            "task": "reconcile_unread_counters",
+            "schedule": UNREAD_RECONCILE_INTERVAL,
+        },
+        "flush-presence": {
+            "task": "flush_presence",
+            "schedule": PRESENCE_FLUSH_INTERVAL,
+        },
+        "collect-abandoned-uploads": {
+            "task": "collect_abandoned_uploads",
+            "schedule": UPLOAD_GC_INTERVAL,
+        },
+        "recover-pending-messages": {
+            "task": "recover_pending_messages",
+            "schedule": CHAT_WRITE_RECOVER_INTERVAL,
+        },
+        "maintain-chat-partitions": {
+            "task": "maintain_chat_partitions",
+            "schedule": CHAT_PARTITION_INTERVAL,
+        },
+        "compact-deleted-messages": {
+            "task": "compact_deleted_messages",
+            "schedule": CHAT_COMPACTION_INTERVAL,
+        },
+    },
 )
@@ -45,6 +45,61 @@ ALLOWED_HOSTS = [
 ]
 REDIS_HOST = os.getenv("REDIS_HOST", "redis")
 REDIS_PORT = os.getenv("REDIS_PORT", "6379")
+# Отдельная БД Redis для данных приложения (db 0 занят Celery, db 1 - коды подтверждения)
+REDIS_APP_DB = int(os.getenv("REDIS_APP_DB", "2"))
+REDIS_URL = f"redis://{REDIS_HOST}:{REDIS_PORT}/{REDIS_APP_DB}"
+
+# Бэкенд доставки WebSocket-событий:
+# "redis" - pub/sub между воркерами (gunicorn --workers N), "local" - только текущий процесс
+WS_BACKEND = os.getenv("WS_BACKEND", "redis").lower()
+# Очередь отправки на каждый сокет: размер, политика при переполнении (drop - выбросить самое старое событие,
+# close - закрыть медленный сокет) и таймаут записи одного кадра в секундах
+WS_SEND_QUEUE_SIZE = int(os.getenv("WS_SEND_QUEUE_SIZE", "256"))
+WS_SEND_OVERFLOW = os.getenv("WS_SEND_OVERFLOW", "close").lower()
+WS_SEND_TIMEOUT = float(os.getenv("WS_SEND_TIMEOUT", "10"))
+# Эфемерные события отправляются одному получателю не чаще раза в N секунд (промежуточные значения схлопываются)
+WS_TYPING_INTERVAL = float(os.getenv("WS_TYPING_INTERVAL", "2"))
+WS_UPLOAD_PROGRESS_INTERVAL = float(os.getenv("WS_UPLOAD_PROGRESS_INTERVAL", "0.5"))
+# Журнал событий пользователя для досылки после переподключения (Redis Stream): сколько событий
+# хранить на пользователя и сколько секунд журнал живет без новых событий
+WS_EVENT_LOG_MAXLEN = int(os.getenv("WS_EVENT_LOG_MAXLEN", "1000"))
+WS_EVENT_LOG_TTL = int(os.getenv("WS_EVENT_LOG_TTL", "86400"))
+# Возобновляемые загрузки (tus, /uploads/files): максимальный размер одного файла в байтах
+UPLOAD_MAX_SIZE = int(os.getenv("UPLOAD_MAX_SIZE", str(2 * 1024 ** 3)))
+# Сколько секунд состояние незавершенной загрузки живет в Redis без новых чанков
+UPLOAD_STATE_TTL = int(os.getenv("UPLOAD_STATE_TTL", "86400"))
+# Сборка мусора загрузок: загрузка без чанков дольше UPLOAD_ABANDON_AFTER секунд считается брошенной
+# (сессия, временные файлы, multipart upload в S3 и placeholder-сообщение удаляются); период запуска задачи
+UPLOAD_ABANDON_AFTER = int(os.getenv("UPLOAD_ABANDON_AFTER", str(6 * 3600)))
+UPLOAD_GC_INTERVAL = int(os.getenv("UPLOAD_GC_INTERVAL", "600"))
+# Потоки пула файлового ввода-вывода медиа (app.utils.aiofile) на процесс
+MEDIA_IO_THREADS = int(os.getenv("MEDIA_IO_THREADS", "8"))
+# Кэш первой страницы истории чата в Redis (кольцевой буфер последних сообщений диалога):
+# сколько сообщений хранить на диалог, сколько диалогов держать (лишние вытесняются по LRU)
+# и сколько секунд буфер живет без обращений
+CHAT_HISTORY_CACHE_SIZE = int(os.getenv("CHAT_HISTORY_CACHE_SIZE", "50"))
+CHAT_HISTORY_CACHE_DIALOGS = int(os.getenv("CHAT_HISTORY_CACHE_DIALOGS", "10000"))
+CHAT_HISTORY_CACHE_TTL = int(os.getenv("CHAT_HISTORY_CACHE_TTL", "3600"))
+# Запись сообщений с отложенной фиксацией (только PostgreSQL): сообщение получает id из последовательности,
+# сразу рассылается и попадает в Redis Stream chat:pending, а в БД пишется пачками - каждые
+# CHAT_WRITE_BATCH_SIZE сообщений или CHAT_WRITE_FLUSH_MS миллисекунд. Записи, которые процесс не успел
+# сохранить (падение), через CHAT_WRITE_RECOVER_AFTER секунд сохраняет задача recover_pending_messages
+CHAT_WRITE_BEHIND = os.getenv("CHAT_WRITE_BEHIND", "false").lower() == "true"
+CHAT_WRITE_BATCH_SIZE = int(os.getenv("CHAT_WRITE_BATCH_SIZE", "200"))
+CHAT_WRITE_FLUSH_MS = int(os.getenv("CHAT_WRITE_FLUSH_MS", "50"))
+CHAT_WRITE_RECOVER_AFTER = int(os.getenv("CHAT_WRITE_RECOVER_AFTER", "60"))
+CHAT_WRITE_RECOVER_INTERVAL = int(os.getenv("CHAT_WRITE_RECOVER_INTERVAL", "60"))
+# Помесячные секции chat_messages (PostgreSQL): сколько секций создавать заранее, через сколько месяцев
+# секция уходит в архив (Parquet в хранилище, читается через /chat/history/{id}/archive), период задачи
+# обслуживания секций (секунды) и каталог архивов при локальном хранилище (он же кэш архивов, скачанных из S3)
+CHAT_PARTITION_PREMAKE_MONTHS = int(os.getenv("CHAT_PARTITION_PREMAKE_MONTHS", "3"))
+CHAT_ARCHIVE_AFTER_MONTHS = int(os.getenv("CHAT_ARCHIVE_AFTER_MONTHS", "12"))
+CHAT_PARTITION_INTERVAL = int(os.getenv("CHAT_PARTITION_INTERVAL", "86400"))
+CHAT_ARCHIVE_DIR = os.getenv("CHAT_ARCHIVE_DIR", str(Path(__file__).resolve().parent.parent / "archive"))
+# Уплотнение chat_messages: сообщения, удаленные обоими участниками, удаляются из таблицы вместе с файлами
+# пачками по CHAT_COMPACTION_BATCH_SIZE строк; период задачи compact_deleted_messages (секунды)
+CHAT_COMPACTION_BATCH_SIZE = int(os.getenv("CHAT_COMPACTION_BATCH_SIZE", "500"))
+CHAT_COMPACTION_INTERVAL = int(os.getenv("CHAT_COMPACTION_INTERVAL", "3600"))
 
 POSTGRES_USER = os.getenv("POSTGRES_USER", "ecommerce_user")
 POSTGRES_PASSWORD = os.getenv("POSTGRES_PASSWORD", "xxxxxxxx")
@@ -60,6 +115,13 @@ DATABASE_URL = os.getenv("DATABASE_URL", DEFAULT_DB_URL)
 
 CELERY_BROKER_URL = f"redis://{REDIS_HOST}:{REDIS_PORT}/0"
 CELERY_RESULT_BACKEND = f"redis://{REDIS_HOST}:{REDIS_PORT}/0"
+# Период сверки счетчиков непрочитанных в Redis с БД (секунды)
+UNREAD_RECONCILE_INTERVAL = int(os.getenv("UNREAD_RECONCILE_INTERVAL", "300"))
+# Присутствие: время жизни heartbeat соединения (клиент шлет ping чаще), задержка перед рассылкой offline
+# (переподключение в этот промежуток событий не порождает) и период записи статусов в users (секунды)
+PRESENCE_TTL = int(os.getenv("PRESENCE_TTL", "90"))
+PRESENCE_OFFLINE_GRACE = int(os.getenv("PRESENCE_OFFLINE_GRACE", "5"))
+PRESENCE_FLUSH_INTERVAL = int(os.getenv("PRESENCE_FLUSH_INTERVAL", "30"))
 
 FIREBASE_SERVICE_ACCOUNT_PATH = os.getenv("FIREBASE_SERVICE_ACCOUNT_PATH", "firebase-service-account.json")
 FIREBASE_APP_CHECK_ENFORCED = os.getenv("FIREBASE_APP_CHECK_ENFORCED", "false").lower() == "true"
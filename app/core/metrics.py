@@ -0,0 +1,101 @@
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, Counter, Gauge, Histogram, generate_latest
+from prometheus_client.core import GaugeMetricFamily
+
+from app.database import async_engine
+
+# Метрики считаются на уровне процесса: при нескольких воркерах gunicorn каждый отдает свои значения
+
+WS_CONNECTIONS = Gauge(
+    "ws_connections",
+    "Открытые WebSocket-соединения в этом процессе",
+    ["namespace"],
+)
+
+WS_SEND_QUEUE_DEPTH = Gauge(
+    "ws_send_queue_depth",
+    "Суммарное количество событий в очередях отправки сокетов",
+    ["namespace"],
+)
+
+WS_SEND_DROPPED = Counter(
+    "ws_send_dropped_total",
+    "События, выброшенные из-за переполнения очереди отправки",
+    ["namespace"],
+)
+
+WS_SLOW_CONSUMER_EVICTIONS = Counter(
+    "ws_slow_consumer_evictions_total",
+    "Сокеты, закрытые из-за переполнения очереди, таймаута или ошибки записи",
+    ["namespace"],
+)
+
+WS_EVENTS_COALESCED = Counter(
+    "ws_events_coalesced_total",
+    "Эфемерные события, замененные более новым значением до отправки",
+    ["type"],
+)
+
+WS_FRAME_SECONDS = Histogram(
+    "chat_ws_frame_seconds",
+    "Время обработки входящего кадра чат-сокета (включая время удержания сессии БД)",
+)
+
+MEDIA_IO_SECONDS = Histogram(
+    "media_io_seconds",
+    "Время файловой операции медиа в пуле потоков",
+    ["op"],
+)
+
+MEDIA_IO_WAIT_SECONDS = Histogram(
+    "media_io_wait_seconds",
+    "Ожидание свободного потока пула файлового ввода-вывода",
+)
+
+CHAT_HISTORY_CACHE_REQUESTS = Counter(
+    "chat_history_cache_requests_total",
+    "Запросы первой страницы истории чата: hit - из буфера в Redis, miss - из БД",
+    ["result"],
+)
+
+CHAT_WRITE_BATCH_ROWS = Histogram(
+    "chat_write_batch_rows",
+    "Сообщения в одной пачке записи с отложенной фиксацией",
+    buckets=(1, 5, 10, 25, 50, 100, 200, 500, 1000),
+)
+
+CHAT_WRITE_PENDING = Gauge(
+    "chat_write_pending",
+    "Сообщения, разосланные, но еще не записанные в БД этим процессом",
+)
+
+EVENT_LOOP_LAG_SECONDS = Histogram(
+    "event_loop_lag_seconds",
+    "Задержка пробуждения цикла событий сверх запланированной (блокирующий код в async-обработчиках)",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5),
+)
+
+
+class DBPoolCollector:
+    """Снимает состояние пула соединений async_engine в момент запроса /metrics."""
+
+    def collect(self):
+        pool = async_engine.pool
+        stats = {
+            "size": getattr(pool, "size", None),
+            "checked_out": getattr(pool, "checkedout", None),
+            "checked_in": getattr(pool, "checkedin", None),
+            "overflow": getattr(pool, "overflow", None),
+        }
+        gauge = GaugeMetricFamily("db_pool_connections", "Состояние пула соединений БД", labels=["state"])
+        for state, getter in stats.items():
+            if callable(getter):
+                gauge.add_metric([state], getter())
+        yield gauge
+
+
+REGISTRY.register(DBPoolCollector())
+
+
+def render_metrics() -> tuple[bytes, str]:
+    """Возвращает (тело, content-type) для эндпоинта /metrics."""
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
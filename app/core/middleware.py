@@ -106,6 +106,11 @@ def setup_middleware(app: FastAPI) -> None:
         allow_credentials=True,
         allow_methods=["*"],
         allow_headers=["*"],
+        # Заголовки протокола tus (/uploads/files) должны быть видны браузерным клиентам
+        expose_headers=[
+            "Location", "Tus-Resumable", "Tus-Version", "Tus-Extension", "Tus-Max-Size",
+            "Upload-Offset", "Upload-Length", "Upload-Concat", "X-Upload-File-Path",
+        ],
     )
 
     # Trusted Host
@@ -0,0 +1,24 @@
+import redis.asyncio as aioredis
+
+from app.core.config import REDIS_URL
+
+_client: aioredis.Redis | None = None
+
+
+def get_redis() -> aioredis.Redis:
+    """
+    Возвращает общий асинхронный клиент Redis для данных приложения.
+    Клиент создается лениво и переиспользует пул соединений внутри процесса.
+    """
+    global _client
+    if _client is None:
+        _client = aioredis.Redis.from_url(REDIS_URL)
+    return _client
+
+
+def new_redis() -> aioredis.Redis:
+    """
+    Создает отдельный клиент Redis.
+    Нужен там, где код работает в собственном event loop (например, задачи Celery через asyncio.run).
+    """
+    return aioredis.Redis.from_url(REDIS_URL)
@@ -0,0 +1,682 @@
+import asyncio
+import json
+from datetime import datetime, timezone
+from functools import partial
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Union
+
+from fastapi import WebSocket, WebSocketDisconnect
+from loguru import logger
+
+from app.core.config import (
+    WS_BACKEND, WS_SEND_QUEUE_SIZE, WS_SEND_OVERFLOW, WS_SEND_TIMEOUT, WS_TYPING_INTERVAL, WS_UPLOAD_PROGRESS_INTERVAL,
+    WS_EVENT_LOG_MAXLEN, WS_EVENT_LOG_TTL
+)
+from app.core.metrics import (
+    WS_CONNECTIONS, WS_SEND_QUEUE_DEPTH, WS_SEND_DROPPED, WS_SLOW_CONSUMER_EVICTIONS, WS_EVENTS_COALESCED
+)
+from app.core.redis import get_redis
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - orjson необязателен, стандартный json медленнее, но совместим
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover - без msgpack бинарный протокол просто не предлагается клиентам
+    msgpack = None
+
+# handler(user_id, frame) - доставка готового кадра в локальные сокеты; user_id=None означает broadcast
+DeliveryHandler = Callable[[Optional[int], str], Awaitable[None]]
+
+
+# Бинарный протокол: клиент предлагает его в Sec-WebSocket-Protocol, по умолчанию - JSON
+MSGPACK_SUBPROTOCOL = "msgpack"
+# Поля, которые в msgpack-кадрах передаются как целое число миллисекунд UTC
+TIMESTAMP_FIELDS = frozenset({"timestamp", "last_message_time", "last_seen", "created_at", "updated_at"})
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value)
+
+
+def _to_millis(value: datetime) -> int:
+    # В БД время хранится без часового пояса (UTC)
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return int(value.timestamp() * 1000)
+
+
+def _compact(value, key: Optional[str] = None):
+    """Готовит событие к msgpack: datetime и ISO-строки полей TIMESTAMP_FIELDS -> миллисекунды."""
+    if isinstance(value, dict):
+        return {k: _compact(v, k) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_compact(v) for v in value]
+    if isinstance(value, datetime):
+        return _to_millis(value)
+    if isinstance(value, str) and key in TIMESTAMP_FIELDS:
+        try:
+            return _to_millis(datetime.fromisoformat(value))
+        except ValueError:
+            return value
+    return value
+
+
+def pack_event(message: dict) -> bytes:
+    return msgpack.packb(_compact(message), default=str)
+
+
+class EventFrame(str):
+    """
+    Закодированный кадр события; помнит тип события, чтобы кадр можно было маршрутизировать по топикам.
+    msgpack-вариант кодируется при первой отправке в бинарный сокет и переиспользуется для остальных.
+    """
+    event_type: Optional[str] = None
+    message: Optional[dict] = None
+    _packed: Optional[bytes] = None
+
+    def binary(self) -> bytes:
+        if self._packed is None:
+            # Кадр из Redis приходит только текстом - исходное событие восстанавливаем из JSON
+            self._packed = pack_event(self.message if self.message is not None else json.loads(self))
+        return self._packed
+
+    def with_event_id(self, event_id: str) -> "EventFrame":
+        """Копия кадра с полем event_id; JSON не перекодируется - поле дописывается в начало объекта."""
+        frame = EventFrame('{"event_id":"%s",%s' % (event_id, self[1:]) if self != "{}" else '{"event_id":"%s"}' % event_id)
+        frame.event_type = self.event_type
+        if self.message is not None:
+            frame.message = {"event_id": event_id, **self.message}
+        return frame
+
+
+def encode_event(message: dict) -> EventFrame:
+    """
+    Кодирует событие в текстовый кадр WebSocket один раз; дальше один и тот же кадр
+    публикуется в Redis и пишется во все сокеты получателей.
+    """
+    if orjson is not None:
+        frame = EventFrame(orjson.dumps(message, default=_json_default, option=orjson.OPT_NON_STR_KEYS).decode())
+    else:
+        frame = EventFrame(json.dumps(message, default=_json_default))
+    frame.event_type = message.get("type")
+    frame.message = message
+    return frame
+
+
+# Журнал событий: events:{namespace}:{user_id} - Redis Stream с кадрами, отправленными пользователю.
+# Id записи (монотонный id Redis Stream) уходит клиенту в поле event_id; переподключаясь,
+# клиент передает last_event_id и получает только пропущенные события.
+# Эфемерные события в журнал не пишутся: устаревшие значения после переподключения не нужны.
+EPHEMERAL_EVENTS = frozenset({"typing", "upload_progress", "user_status", "pong"})
+
+
+def event_log_key(namespace: str, user_id: int) -> str:
+    return f"events:{namespace}:{user_id}"
+
+
+async def log_event(namespace: str, user_id: int, frame: EventFrame, redis=None) -> EventFrame:
+    """
+    Добавляет кадр в журнал пользователя и возвращает его с event_id. Если Redis недоступен - кадр без event_id.
+    redis - свой клиент для задач Celery (у каждой свой event loop).
+    """
+    if frame.event_type in EPHEMERAL_EVENTS:
+        return frame
+    key = event_log_key(namespace, user_id)
+    try:
+        async with (redis or get_redis()).pipeline(transaction=False) as pipe:
+            pipe.xadd(key, {"t": frame.event_type or "", "f": str(frame)}, maxlen=WS_EVENT_LOG_MAXLEN, approximate=True)
+            pipe.expire(key, WS_EVENT_LOG_TTL)
+            event_id, _ = await pipe.execute()
+    except Exception as e:
+        logger.error(f"WS event log: append to {key} failed: {e}")
+        return frame
+    return frame.with_event_id(event_id.decode() if isinstance(event_id, bytes) else event_id)
+
+
+async def replay_events(
+    websocket: WebSocket,
+    namespace: str,
+    user_id: int,
+    last_event_id: str,
+    accepts: Optional[Callable[[Optional[str]], bool]] = None
+) -> Optional[int]:
+    """
+    Досылает в сокет события журнала после last_event_id.
+    Если события last_event_id в журнале уже нет (вытеснено MAXLEN, журнал истек или id неизвестен) -
+    часть событий потеряна, клиенту отправляется resync_required и он перезагружает состояние целиком.
+    Возвращает количество досланных событий или None при resync.
+    Событие, пришедшее во время досылки, может быть доставлено дважды - клиент отбрасывает повторы по event_id.
+    """
+    key = event_log_key(namespace, user_id)
+    entries = None
+    try:
+        redis = get_redis()
+        if await redis.xrange(key, last_event_id, last_event_id, count=1):
+            entries = await redis.xrange(key, f"({last_event_id}", "+")
+    except Exception as e:
+        logger.error(f"WS event log: replay from {key} failed: {e}")
+
+    if entries is None:
+        await send_event(websocket, {"type": "resync_required", "last_event_id": last_event_id})
+        return None
+
+    sent = 0
+    for entry_id, fields in entries:
+        event_type = fields.get(b"t", b"").decode() or None
+        if accepts is not None and not accepts(event_type):
+            continue
+        frame = EventFrame(fields[b"f"].decode())
+        frame.event_type = event_type
+        await send_event(websocket, frame.with_event_id(entry_id.decode()))
+        sent += 1
+    return sent
+
+
+async def accept(websocket: WebSocket) -> None:
+    """Принимает соединение, выбирая протокол кадров: msgpack, если клиент его предложил, иначе JSON."""
+    offered = websocket.scope.get("subprotocols") or []
+    subprotocol = MSGPACK_SUBPROTOCOL if msgpack is not None and MSGPACK_SUBPROTOCOL in offered else None
+    await websocket.accept(subprotocol=subprotocol)
+    websocket.state.binary = subprotocol == MSGPACK_SUBPROTOCOL
+
+
+def is_binary(websocket: WebSocket) -> bool:
+    return getattr(websocket.state, "binary", False)
+
+
+async def send_event(websocket: WebSocket, message: Union[dict, str]) -> None:
+    """Отправляет событие одному сокету в его протоколе."""
+    if isinstance(message, EventFrame):
+        frame = message
+    elif isinstance(message, str):
+        frame = EventFrame(message)
+    else:
+        frame = encode_event(message)
+    if is_binary(websocket):
+        await websocket.send_bytes(frame.binary())
+    else:
+        await websocket.send_text(frame)
+
+
+async def receive_event(websocket: WebSocket) -> dict:
+    """
+    Читает кадр клиента: текстовый - JSON, бинарный - msgpack.
+    ValueError - кадр не удалось разобрать; WebSocketDisconnect - клиент отключился.
+    """
+    message = await websocket.receive()
+    if message["type"] == "websocket.disconnect":
+        raise WebSocketDisconnect(message.get("code", 1000), message.get("reason"))
+    try:
+        if message.get("bytes") is not None:
+            if msgpack is None:
+                raise ValueError("binary frames are not supported")
+            data = msgpack.unpackb(message["bytes"])
+        else:
+            data = json.loads(message.get("text") or "")
+    except Exception as e:
+        raise ValueError(f"malformed frame: {e}") from e
+    if not isinstance(data, dict):
+        raise ValueError("frame must be an object")
+    return data
+
+
+# Топики мультиплексированного сокета /ws/stream
+TOPICS = ("chat", "presence", "orders", "social")
+
+EVENT_TOPICS = {
+    "new_message": "chat",
+    "message_deleted": "chat",
+    "message_updated": "chat",
+    "messages_read": "chat",
+    "your_messages_read": "chat",
+    "typing": "chat",
+    "upload_progress": "chat",
+    "unread_counts": "chat",
+    "user_status": "presence",
+    "new_order": "orders",
+    "order_status_changed": "orders",
+    "new_review": "orders",
+    "review_reaction": "orders",
+}
+
+
+def event_topic(event_type: Optional[str]) -> str:
+    """Топик события; все, что не относится к чату, присутствию и заказам - social (друзья, новости, фото)."""
+    return EVENT_TOPICS.get(event_type, "social")
+
+
+class LocalBackend:
+    """Доставка событий только в сокеты текущего процесса."""
+
+    def __init__(self):
+        self._handlers: Dict[str, DeliveryHandler] = {}
+
+    def register(self, namespace: str, handler: DeliveryHandler) -> None:
+        self._handlers[namespace] = handler
+
+    async def subscribe(self, namespace: str, user_id: int) -> None:
+        pass
+
+    async def unsubscribe(self, namespace: str, user_id: int) -> None:
+        pass
+
+    async def publish(self, namespace: str, user_id: int, frame: str) -> None:
+        await self._deliver(namespace, user_id, frame)
+
+    async def broadcast(self, namespace: str, frame: str) -> None:
+        await self._deliver(namespace, None, frame)
+
+    async def _deliver(self, namespace: str, user_id: Optional[int], frame: str) -> None:
+        handler = self._handlers.get(namespace)
+        if handler is not None:
+            await handler(user_id, frame)
+
+
+class RedisBackend(LocalBackend):
+    """
+    Доставка событий через Redis pub/sub.
+    Каждое событие публикуется в канал пользователя ws:{namespace}:user:{user_id};
+    воркер подписан только на каналы пользователей, чьи сокеты подключены к нему,
+    и доставляет событие в свои локальные соединения.
+    """
+
+    RECONNECT_DELAY = 2
+
+    def __init__(self):
+        super().__init__()
+        self._pubsub = None
+        self._reader_task: Optional[asyncio.Task] = None
+        self._channels: Set[str] = set()
+        self._lock = asyncio.Lock()
+
+    @staticmethod
+    def _user_channel(namespace: str, user_id: int) -> str:
+        return f"ws:{namespace}:user:{user_id}"
+
+    @staticmethod
+    def _broadcast_channel(namespace: str) -> str:
+        return f"ws:{namespace}:broadcast"
+
+    async def _ensure_started(self) -> None:
+        if self._reader_task is not None and not self._reader_task.done():
+            return
+        async with self._lock:
+            if self._reader_task is not None and not self._reader_task.done():
+                return
+            for namespace in self._handlers:
+                self._channels.add(self._broadcast_channel(namespace))
+            self._pubsub = get_redis().pubsub(ignore_subscribe_messages=True)
+            await self._pubsub.subscribe(*self._channels)
+            self._reader_task = asyncio.create_task(self._reader())
+
+    async def _reader(self) -> None:
+        while True:
+            try:
+                async for raw in self._pubsub.listen():
+                    if raw.get("type") != "message":
+                        continue
+                    await self._on_message(raw["channel"], raw["data"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"WS RedisBackend: pub/sub reader failed: {e}. Reconnecting in {self.RECONNECT_DELAY}s")
+                await asyncio.sleep(self.RECONNECT_DELAY)
+                try:
+                    await self._pubsub.aclose()
+                except Exception:
+                    pass
+                self._pubsub = get_redis().pubsub(ignore_subscribe_messages=True)
+                try:
+                    await self._pubsub.subscribe(*self._channels)
+                except Exception as sub_err:
+                    logger.error(f"WS RedisBackend: resubscribe failed: {sub_err}")
+
+    async def _on_message(self, channel: bytes, data: bytes) -> None:
+        try:
+            # ws:{namespace}:user:{user_id} | ws:{namespace}:broadcast
+            parts = channel.decode().split(":")
+            namespace = parts[1]
+            user_id = int(parts[3]) if parts[2] == "user" else None
+            # В канале уже лежит готовый кадр - повторно не декодируем и не кодируем
+            frame = EventFrame(data.decode())
+        except Exception as e:
+            logger.error(f"WS RedisBackend: malformed pub/sub message on {channel!r}: {e}")
+            return
+        try:
+            await self._deliver(namespace, user_id, frame)
+        except Exception as e:
+            logger.error(f"WS RedisBackend: local delivery failed for {channel!r}: {e}")
+
+    async def subscribe(self, namespace: str, user_id: int) -> None:
+        channel = self._user_channel(namespace, user_id)
+        self._channels.add(channel)
+        try:
+            await self._ensure_started()
+            await self._pubsub.subscribe(channel)
+        except Exception as e:
+            logger.error(f"WS RedisBackend: subscribe {channel} failed: {e}")
+
+    async def unsubscribe(self, namespace: str, user_id: int) -> None:
+        channel = self._user_channel(namespace, user_id)
+        self._channels.discard(channel)
+        if self._pubsub is None:
+            return
+        try:
+            await self._pubsub.unsubscribe(channel)
+        except Exception as e:
+            logger.error(f"WS RedisBackend: unsubscribe {channel} failed: {e}")
+
+    async def _publish(self, channel: str, namespace: str, user_id: Optional[int], frame: str) -> None:
+        try:
+            await get_redis().publish(channel, frame)
+        except Exception as e:
+            # Redis недоступен - доставляем хотя бы в сокеты этого воркера
+            logger.error(f"WS RedisBackend: publish to {channel} failed: {e}. Falling back to local delivery")
+            await self._deliver(namespace, user_id, frame)
+
+    async def publish(self, namespace: str, user_id: int, frame: str) -> None:
+        await self._publish(self._user_channel(namespace, user_id), namespace, user_id, frame)
+
+    async def broadcast(self, namespace: str, frame: str) -> None:
+        await self._publish(self._broadcast_channel(namespace), namespace, None, frame)
+
+
+def create_backend(name: str) -> LocalBackend:
+    if name == "redis":
+        return RedisBackend()
+    return LocalBackend()
+
+
+backend = create_backend(WS_BACKEND)
+
+
+class SocketWriter:
+    """
+    Очередь отправки одного сокета.
+    Отправители только кладут событие в ограниченную очередь и сразу возвращаются,
+    запись в сокет выполняет отдельная задача - медленный клиент не задерживает отправителя.
+    """
+
+    # WebSocket close code 1013 - Try Again Later
+    SLOW_CONSUMER_CLOSE_CODE = 1013
+
+    def __init__(self, websocket: WebSocket, namespace: str, on_failure: Callable[["SocketWriter", Exception], None]):
+        self.websocket = websocket
+        self.namespace = namespace
+        self._on_failure = on_failure
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=WS_SEND_QUEUE_SIZE)
+        self._task = asyncio.create_task(self._run())
+
+    def put(self, frame: str) -> bool:
+        """Ставит кадр в очередь. False - очередь переполнена и сокет нужно закрыть."""
+        try:
+            self._queue.put_nowait(frame)
+        except asyncio.QueueFull:
+            WS_SEND_DROPPED.labels(self.namespace).inc()
+            if WS_SEND_OVERFLOW != "drop":
+                return False
+            # Выбрасываем самое старое событие, новое важнее
+            self._queue.get_nowait()
+            self._queue.put_nowait(frame)
+            return True
+        WS_SEND_QUEUE_DEPTH.labels(self.namespace).inc()
+        return True
+
+    async def _run(self):
+        while True:
+            frame = await self._queue.get()
+            WS_SEND_QUEUE_DEPTH.labels(self.namespace).dec()
+            try:
+                await asyncio.wait_for(send_event(self.websocket, frame), WS_SEND_TIMEOUT)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self._on_failure(self, e)
+                return
+
+    def stop(self):
+        """Останавливает задачу записи; неотправленные события отбрасываются."""
+        WS_SEND_QUEUE_DEPTH.labels(self.namespace).dec(self._queue.qsize())
+        self._queue = asyncio.Queue(maxsize=WS_SEND_QUEUE_SIZE)
+        if asyncio.current_task() is not self._task:
+            self._task.cancel()
+
+    async def close(self):
+        try:
+            await self.websocket.close(code=self.SLOW_CONSUMER_CLOSE_CODE)
+        except Exception:
+            pass
+
+
+class EventCoalescer:
+    """
+    Ограничение частоты эфемерных событий (typing, upload_progress).
+    Для каждого ключа (отправитель, получатель, тип[, upload_id]) первое событие уходит сразу,
+    следующие в пределах интервала схлопываются: по окончании интервала отправляется только последнее значение.
+    Состояние локально для процесса и живет, пока по ключу идут события.
+    """
+
+    INTERVALS = {
+        "typing": WS_TYPING_INTERVAL,
+        "upload_progress": WS_UPLOAD_PROGRESS_INTERVAL,
+    }
+
+    def __init__(self):
+        # ключ -> отложенная отправка последнего значения (None - в этом интервале новых значений не было)
+        self._pending: Dict[tuple, Optional[Callable[[], Awaitable[None]]]] = {}
+        self._timers: Dict[tuple, asyncio.Task] = {}
+
+    async def submit(self, event_type: str, key: tuple, send: Callable[[], Awaitable[None]], force: bool = False):
+        """
+        send - корутина-функция, отправляющая событие.
+        force=True - отправить сразу, отбросив ожидающее значение (например, is_typing=False или 100% загрузки).
+        """
+        key = (event_type,) + key
+        if key not in self._timers:
+            self._pending[key] = None
+            self._timers[key] = asyncio.create_task(self._cooldown(key, self.INTERVALS.get(event_type, 1.0)))
+            await send()
+            return
+        if self._pending.get(key) is not None:
+            WS_EVENTS_COALESCED.labels(event_type).inc()
+        if force:
+            self._pending[key] = None
+            await send()
+        else:
+            self._pending[key] = send
+
+    async def _cooldown(self, key: tuple, interval: float):
+        try:
+            while True:
+                await asyncio.sleep(interval)
+                send = self._pending.get(key)
+                if send is None:
+                    return
+                self._pending[key] = None
+                try:
+                    await send()
+                except Exception as e:
+                    logger.error(f"EventCoalescer: delayed send for {key[0]} failed: {e}")
+        finally:
+            self._pending.pop(key, None)
+            self._timers.pop(key, None)
+
+
+class WebSocketManager:
+    """
+    Базовый менеджер WebSocket-соединений.
+    Хранит локальные сокеты процесса, а отправку выполняет через общий backend,
+    чтобы событие дошло до пользователя, подключенного к любому воркеру.
+    """
+
+    namespace = "default"
+    log_name = "WebSocketManager"
+    # Дублировать события в мультиплексированный сокет /ws/stream
+    mirror_to_stream = True
+
+    def __init__(self):
+        # user_id -> list of websockets (только соединения этого процесса)
+        self.active_connections: Dict[int, List[WebSocket]] = {}
+        self._writers: Dict[WebSocket, SocketWriter] = {}
+        self._register()
+
+    def _register(self):
+        backend.register(self.namespace, self._deliver_local)
+
+    async def _subscribe(self, user_id: int):
+        await backend.subscribe(self.namespace, user_id)
+
+    async def _unsubscribe(self, user_id: int):
+        await backend.unsubscribe(self.namespace, user_id)
+
+    async def connect(self, websocket: WebSocket, user_id: int):
+        if user_id not in self.active_connections:
+            self.active_connections[user_id] = []
+            await self._subscribe(user_id)
+        self.active_connections[user_id].append(websocket)
+        self._writers[websocket] = SocketWriter(websocket, self.namespace, lambda writer, error: self._on_send_failure(user_id, writer, error))
+        WS_CONNECTIONS.labels(self.namespace).inc()
+        logger.debug(f"{self.log_name}: User {user_id} connected. Active sockets: {len(self.active_connections[user_id])}")
+
+    def disconnect(self, websocket: WebSocket, user_id: int):
+        if user_id in self.active_connections:
+            try:
+                self.active_connections[user_id].remove(websocket)
+            except ValueError:
+                return
+            writer = self._writers.pop(websocket, None)
+            if writer is not None:
+                writer.stop()
+            WS_CONNECTIONS.labels(self.namespace).dec()
+            self._drop_if_empty(user_id)
+            logger.debug(f"{self.log_name}: User {user_id} disconnected. Remaining sockets: {len(self.active_connections.get(user_id, []))}")
+
+    def _drop_if_empty(self, user_id: int):
+        if user_id in self.active_connections and not self.active_connections[user_id]:
+            del self.active_connections[user_id]
+            asyncio.create_task(self._unsubscribe_if_idle(user_id))
+
+    async def _unsubscribe_if_idle(self, user_id: int):
+        # Пользователь мог переподключиться, пока задача ждала своей очереди
+        if user_id not in self.active_connections:
+            await self._unsubscribe(user_id)
+
+    async def send_personal_message(self, message: Union[dict, EventFrame], user_id: int, stream: bool = True):
+        """
+        message - событие или кадр, уже закодированный через encode_event (при отправке одного события нескольким получателям).
+        stream=False - не дублировать событие в /ws/stream: так делают, когда то же событие тому же пользователю
+        уже отправлено через другой менеджер, чтобы сокет stream получил его ровно один раз.
+        """
+        frame = message if isinstance(message, EventFrame) else encode_event(message)
+        await backend.publish(self.namespace, user_id, await log_event(self.namespace, user_id, frame))
+        if stream and self.mirror_to_stream:
+            await stream_manager.send_personal_message(frame, user_id)
+
+    async def broadcast(self, message: Union[dict, EventFrame], stream: bool = True):
+        # Broadcast-события в журналы пользователей не пишутся
+        frame = message if isinstance(message, EventFrame) else encode_event(message)
+        await backend.broadcast(self.namespace, frame)
+        if stream and self.mirror_to_stream:
+            await stream_manager.broadcast(frame)
+
+    async def replay(self, websocket: WebSocket, user_id: int, last_event_id: str) -> Optional[int]:
+        """Досылает события, пропущенные сокетом с момента last_event_id (см. replay_events)."""
+        return await replay_events(websocket, self.namespace, user_id, last_event_id)
+
+    async def _deliver_local(self, user_id: Optional[int], frame: str, accepts: Optional[Callable[[WebSocket], bool]] = None):
+        if user_id is None:
+            targets = [(uid, ws) for uid, conns in self.active_connections.items() for ws in conns]
+        elif user_id in self.active_connections:
+            targets = [(user_id, ws) for ws in self.active_connections[user_id]]
+        else:
+            logger.debug(f"{self.log_name}: User {user_id} NOT found in local active connections.")
+            return
+
+        for uid, ws in targets:
+            if accepts is not None and not accepts(ws):
+                continue
+            writer = self._writers.get(ws)
+            if writer is not None and not writer.put(frame):
+                logger.warning(f"{self.log_name}: Send queue overflow for user {uid}, closing slow socket")
+                self._evict(uid, writer)
+
+    def _on_send_failure(self, user_id: int, writer: SocketWriter, error: Exception):
+        logger.error(f"{self.log_name}: Failed to send to user {user_id}: {error!r}")
+        # Remove broken connection
+        self._evict(user_id, writer)
+
+    def _evict(self, user_id: int, writer: SocketWriter):
+        WS_SLOW_CONSUMER_EVICTIONS.labels(self.namespace).inc()
+        self.disconnect(writer.websocket, user_id)
+        asyncio.create_task(writer.close())
+
+
+class StreamManager(WebSocketManager):
+    """
+    Мультиплексированный сокет: чат, присутствие, заказы и социальные уведомления в одном соединении.
+    Каждый топик - отдельный канал backend-а (ws:stream.{topic}:user:{id}), сокет получает
+    только события топиков, на которые подписан.
+    """
+
+    namespace = "stream"
+    log_name = "StreamManager"
+    mirror_to_stream = False
+
+    def __init__(self):
+        # websocket -> топики, на которые подписан сокет
+        self.topics: Dict[WebSocket, Set[str]] = {}
+        super().__init__()
+
+    @staticmethod
+    def _topic_namespace(topic: str) -> str:
+        return f"stream.{topic}"
+
+    def _register(self):
+        for topic in TOPICS:
+            backend.register(self._topic_namespace(topic), partial(self._deliver_topic, topic))
+
+    async def _subscribe(self, user_id: int):
+        for topic in TOPICS:
+            await backend.subscribe(self._topic_namespace(topic), user_id)
+
+    async def _unsubscribe(self, user_id: int):
+        for topic in TOPICS:
+            await backend.unsubscribe(self._topic_namespace(topic), user_id)
+
+    async def connect(self, websocket: WebSocket, user_id: int, topics: Optional[Set[str]] = None):
+        self.set_topics(websocket, topics)
+        await super().connect(websocket, user_id)
+
+    def disconnect(self, websocket: WebSocket, user_id: int):
+        super().disconnect(websocket, user_id)
+        self.topics.pop(websocket, None)
+
+    def set_topics(self, websocket: WebSocket, topics: Optional[Set[str]]):
+        """Заменяет подписки сокета; неизвестные топики игнорируются, None - все топики."""
+        self.topics[websocket] = set(TOPICS) if topics is None else set(topics) & set(TOPICS)
+
+    async def send_personal_message(self, message: Union[dict, EventFrame], user_id: int, stream: bool = True):
+        frame = message if isinstance(message, EventFrame) else encode_event(message)
+        frame = await log_event(self.namespace, user_id, frame)
+        await backend.publish(self._topic_namespace(event_topic(frame.event_type)), user_id, frame)
+
+    async def broadcast(self, message: Union[dict, EventFrame], stream: bool = True):
+        frame = message if isinstance(message, EventFrame) else encode_event(message)
+        await backend.broadcast(self._topic_namespace(event_topic(frame.event_type)), frame)
+
+    async def replay(self, websocket: WebSocket, user_id: int, last_event_id: str) -> Optional[int]:
+        return await replay_events(
+            websocket, self.namespace, user_id, last_event_id,
+            accepts=lambda event_type: event_topic(event_type) in self.topics.get(websocket, ())
+        )
+
+    async def _deliver_topic(self, topic: str, user_id: Optional[int], frame: str):
+        await self._deliver_local(user_id, frame, accepts=lambda ws: topic in self.topics.get(ws, ()))
+
+
+stream_manager = StreamManager()
+coalescer = EventCoalescer()
@@ -0,0 +1,34 @@
+"""add S3 multipart state to file_upload_sessions
+
+Revision ID: a3d5f7b9c1e2
+Revises: f2c9a4e7b318
+Create Date: 2026-10-17 18:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'a3d5f7b9c1e2'
+down_revision: Union[str, Sequence[str], None] = 'f2c9a4e7b318'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    with op.batch_alter_table('file_upload_sessions', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('storage_key', sa.String(), nullable=True))
+        batch_op.add_column(sa.Column('multipart_upload_id', sa.String(), nullable=True))
+        batch_op.add_column(sa.Column('multipart_parts', sa.String(), nullable=True))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    with op.batch_alter_table('file_upload_sessions', schema=None) as batch_op:
+        batch_op.drop_column('multipart_parts')
+        batch_op.drop_column('multipart_upload_id')
+        batch_op.drop_column('storage_key')
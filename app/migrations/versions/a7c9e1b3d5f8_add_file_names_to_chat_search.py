@@ -0,0 +1,83 @@
+"""add file names to the chat full-text search index
+
+Revision ID: a7c9e1b3d5f8
+Revises: f4a6c8e0b2d7
+Create Date: 2026-10-17 23:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'a7c9e1b3d5f8'
+down_revision: Union[str, Sequence[str], None] = 'f4a6c8e0b2d7'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# Выражение совпадает с chat_search.PG_TSVECTOR: текст сообщения и имена файлов из file_path без каталогов
+PG_SEARCH_TSVECTOR = (
+    "to_tsvector('simple', coalesce(message, '') || ' ' || regexp_replace("
+    "regexp_replace(coalesce(file_path, ''), '[^ \"]*/', '', 'g'), '[^[:alnum:]]+', ' ', 'g'))"
+)
+
+
+def _sqlite_fts(columns: str) -> None:
+    values = ", ".join(f"new.{c}" for c in columns.split(", "))
+    old_values = ", ".join(f"old.{c}" for c in columns.split(", "))
+    op.execute(
+        f"CREATE VIRTUAL TABLE chat_messages_fts USING fts5("
+        f"{columns}, content='chat_messages', content_rowid='id', tokenize='unicode61')"
+    )
+    op.execute(
+        f"CREATE TRIGGER chat_messages_fts_ai AFTER INSERT ON chat_messages BEGIN "
+        f"INSERT INTO chat_messages_fts(rowid, {columns}) VALUES (new.id, {values}); END"
+    )
+    op.execute(
+        f"CREATE TRIGGER chat_messages_fts_ad AFTER DELETE ON chat_messages BEGIN "
+        f"INSERT INTO chat_messages_fts(chat_messages_fts, rowid, {columns}) VALUES ('delete', old.id, {old_values}); END"
+    )
+    op.execute(
+        f"CREATE TRIGGER chat_messages_fts_au AFTER UPDATE OF {columns} ON chat_messages BEGIN "
+        f"INSERT INTO chat_messages_fts(chat_messages_fts, rowid, {columns}) VALUES ('delete', old.id, {old_values}); "
+        f"INSERT INTO chat_messages_fts(rowid, {columns}) VALUES (new.id, {values}); END"
+    )
+    op.execute("INSERT INTO chat_messages_fts(chat_messages_fts) VALUES ('rebuild')")
+
+
+def _sqlite_drop_fts() -> None:
+    op.execute("DROP TRIGGER IF EXISTS chat_messages_fts_au")
+    op.execute("DROP TRIGGER IF EXISTS chat_messages_fts_ad")
+    op.execute("DROP TRIGGER IF EXISTS chat_messages_fts_ai")
+    op.execute("DROP TABLE IF EXISTS chat_messages_fts")
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    dialect = op.get_bind().dialect.name
+
+    if dialect == 'postgresql':
+        # chat_messages секционирована (e5b7d9f1a3c6): CONCURRENTLY для нее недоступен
+        op.execute(f"CREATE INDEX ix_chat_messages_search_tsv ON chat_messages USING gin ({PG_SEARCH_TSVECTOR})")
+        op.execute("DROP INDEX IF EXISTS ix_chat_messages_message_tsv")
+    elif dialect == 'sqlite':
+        # Колонки внешней FTS5-таблицы должны совпадать с колонками chat_messages - таблица пересоздается;
+        # unicode61 сам делит путь файла на слова
+        _sqlite_drop_fts()
+        _sqlite_fts("message, file_path")
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    dialect = op.get_bind().dialect.name
+
+    if dialect == 'postgresql':
+        op.execute(
+            "CREATE INDEX ix_chat_messages_message_tsv ON chat_messages "
+            "USING gin (to_tsvector('simple', coalesce(message, '')))"
+        )
+        op.execute("DROP INDEX IF EXISTS ix_chat_messages_search_tsv")
+    elif dialect == 'sqlite':
+        _sqlite_drop_fts()
+        _sqlite_fts("message")
@@ -0,0 +1,36 @@
+"""add kind, tus concatenation and result columns to file_upload_sessions
+
+Revision ID: b8e4c2d6f0a1
+Revises: a3d5f7b9c1e2
+Create Date: 2026-10-17 19:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b8e4c2d6f0a1'
+down_revision: Union[str, Sequence[str], None] = 'a3d5f7b9c1e2'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    with op.batch_alter_table('file_upload_sessions', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('kind', sa.String(), nullable=False, server_default='chat'))
+        batch_op.add_column(sa.Column('concat', sa.String(), nullable=True))
+        batch_op.add_column(sa.Column('upload_metadata', sa.String(), nullable=True))
+        batch_op.add_column(sa.Column('result_url', sa.String(), nullable=True))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    with op.batch_alter_table('file_upload_sessions', schema=None) as batch_op:
+        batch_op.drop_column('result_url')
+        batch_op.drop_column('upload_metadata')
+        batch_op.drop_column('concat')
+        batch_op.drop_column('kind')
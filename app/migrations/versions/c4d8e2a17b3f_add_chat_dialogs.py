@@ -0,0 +1,85 @@
+"""add chat_dialogs summary table
+
+Revision ID: c4d8e2a17b3f
+Revises: 0c1d2e3f4a5b
+Create Date: 2026-10-17 10:00:00.000000
+
+"""
+from datetime import datetime, timedelta
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c4d8e2a17b3f'
+down_revision: Union[str, Sequence[str], None] = '0c1d2e3f4a5b'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    chat_dialogs = op.create_table('chat_dialogs',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('partner_id', sa.Integer(), nullable=False),
+    sa.Column('last_message_id', sa.Integer(), nullable=True),
+    sa.Column('last_message_preview', sa.String(), nullable=True),
+    sa.Column('last_message_time', sa.DateTime(), nullable=True),
+    sa.Column('unread_count', sa.Integer(), nullable=False, server_default='0'),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], name=op.f('fk_chat_dialogs_user_id_users'), ondelete='CASCADE'),
+    sa.ForeignKeyConstraint(['partner_id'], ['users.id'], name=op.f('fk_chat_dialogs_partner_id_users'), ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('id', name=op.f('pk_chat_dialogs')),
+    sa.UniqueConstraint('user_id', 'partner_id', name=op.f('uq_chat_dialogs_user_id'))
+    )
+    op.create_index('ix_chat_dialogs_user_id_last_message_time', 'chat_dialogs', ['user_id', 'last_message_time'], unique=False)
+
+    # Backfill: один проход по chat_messages в хронологическом порядке,
+    # в памяти держим только сводку по каждой паре (user_id, partner_id)
+    conn = op.get_bind()
+    stale_limit = datetime.utcnow() - timedelta(hours=1)
+    rows = conn.execute(sa.text(
+        "SELECT id, sender_id, receiver_id, message, timestamp, is_read, "
+        "deleted_by_sender, deleted_by_receiver, is_uploading "
+        "FROM chat_messages ORDER BY timestamp, id"
+    ).columns(timestamp=sa.DateTime()))
+
+    summary = {}
+
+    def _entry(user_id, partner_id):
+        return summary.setdefault((user_id, partner_id), {
+            "user_id": user_id,
+            "partner_id": partner_id,
+            "last_message_id": None,
+            "last_message_preview": None,
+            "last_message_time": None,
+            "unread_count": 0,
+        })
+
+    for row in rows:
+        is_stale_placeholder = bool(row.is_uploading) and row.timestamp is not None and row.timestamp < stale_limit
+        preview = row.message or "[Файл]"
+        sides = []
+        if not row.deleted_by_sender:
+            sides.append((row.sender_id, row.receiver_id))
+        if not row.deleted_by_receiver and row.receiver_id != row.sender_id:
+            sides.append((row.receiver_id, row.sender_id))
+            if not row.is_read:
+                _entry(row.receiver_id, row.sender_id)["unread_count"] += 1
+        for user_id, partner_id in sides:
+            entry = _entry(user_id, partner_id)
+            if not is_stale_placeholder:
+                entry["last_message_id"] = row.id
+                entry["last_message_preview"] = preview
+                entry["last_message_time"] = row.timestamp
+
+    if summary:
+        op.bulk_insert(chat_dialogs, list(summary.values()))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_chat_dialogs_user_id_last_message_time', table_name='chat_dialogs')
+    op.drop_table('chat_dialogs')
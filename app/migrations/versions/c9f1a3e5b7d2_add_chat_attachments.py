@@ -0,0 +1,88 @@
+"""add chat_attachments table
+
+Revision ID: c9f1a3e5b7d2
+Revises: b8e4c2d6f0a1
+Create Date: 2026-10-17 20:00:00.000000
+
+"""
+import json
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c9f1a3e5b7d2'
+down_revision: Union[str, Sequence[str], None] = 'b8e4c2d6f0a1'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+BATCH_SIZE = 1000
+
+
+def _number(value, cast):
+    try:
+        return cast(value) if value is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    chat_attachments = op.create_table('chat_attachments',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('message_id', sa.Integer(), nullable=False),
+    sa.Column('position', sa.Integer(), nullable=False, server_default='0'),
+    sa.Column('url', sa.String(), nullable=False),
+    sa.Column('type', sa.String(), nullable=False),
+    sa.Column('size', sa.BigInteger(), nullable=True),
+    sa.Column('width', sa.Integer(), nullable=True),
+    sa.Column('height', sa.Integer(), nullable=True),
+    sa.Column('duration', sa.Float(), nullable=True),
+    sa.Column('thumbnail', sa.String(), nullable=True),
+    sa.ForeignKeyConstraint(['message_id'], ['chat_messages.id'], name=op.f('fk_chat_attachments_message_id_chat_messages'), ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('id', name=op.f('pk_chat_attachments'))
+    )
+    op.create_index(op.f('ix_chat_attachments_message_id'), 'chat_attachments', ['message_id'], unique=False)
+
+    # Backfill: JSON-списки вложений media_group из chat_messages.file_path
+    conn = op.get_bind()
+    rows = conn.execute(sa.text(
+        "SELECT id, file_path FROM chat_messages "
+        "WHERE message_type = 'media_group' AND file_path IS NOT NULL ORDER BY id"
+    )).all()
+    batch = []
+    for row in rows:
+        try:
+            attachments = json.loads(row.file_path)
+        except ValueError:
+            continue
+        position = 0
+        for att in attachments if isinstance(attachments, list) else []:
+            url = att.get("file_path") or att.get("url") if isinstance(att, dict) else None
+            if not url:
+                continue
+            batch.append({
+                "message_id": row.id,
+                "position": position,
+                "url": url,
+                "type": att.get("type") or "file",
+                "size": _number(att.get("size"), int),
+                "width": _number(att.get("width"), int),
+                "height": _number(att.get("height"), int),
+                "duration": _number(att.get("duration"), float),
+                "thumbnail": att.get("thumbnail") or att.get("thumbnail_url"),
+            })
+            position += 1
+        if len(batch) >= BATCH_SIZE:
+            op.bulk_insert(chat_attachments, batch)
+            batch = []
+    if batch:
+        op.bulk_insert(chat_attachments, batch)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index(op.f('ix_chat_attachments_message_id'), table_name='chat_attachments')
+    op.drop_table('chat_attachments')
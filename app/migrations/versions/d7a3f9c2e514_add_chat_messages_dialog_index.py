@@ -0,0 +1,28 @@
+"""add composite index for chat history keyset pagination
+
+Revision ID: d7a3f9c2e514
+Revises: c4d8e2a17b3f
+Create Date: 2026-10-17 12:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'd7a3f9c2e514'
+down_revision: Union[str, Sequence[str], None] = 'c4d8e2a17b3f'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_index('ix_chat_messages_dialog_timestamp', 'chat_messages', ['sender_id', 'receiver_id', 'timestamp', 'id'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_chat_messages_dialog_timestamp', table_name='chat_messages')
@@ -0,0 +1,38 @@
+"""add read watermark to chat_dialogs
+
+Revision ID: e1b6c8d4a927
+Revises: d7a3f9c2e514
+Create Date: 2026-10-17 14:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e1b6c8d4a927'
+down_revision: Union[str, Sequence[str], None] = 'd7a3f9c2e514'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    with op.batch_alter_table('chat_dialogs', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('last_read_message_id', sa.Integer(), nullable=False, server_default='0'))
+
+    # Отметка прочтения = последнее входящее сообщение, уже помеченное is_read
+    op.execute(
+        "UPDATE chat_dialogs SET last_read_message_id = COALESCE(("
+        "SELECT MAX(m.id) FROM chat_messages m "
+        "WHERE m.sender_id = chat_dialogs.partner_id AND m.receiver_id = chat_dialogs.user_id AND m.is_read = 1"
+        "), 0)"
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    with op.batch_alter_table('chat_dialogs', schema=None) as batch_op:
+        batch_op.drop_column('last_read_message_id')
@@ -0,0 +1,157 @@
+"""partition chat_messages by month and add chat_archives
+
+Revision ID: e5b7d9f1a3c6
+Revises: c9f1a3e5b7d2
+Create Date: 2026-10-17 21:00:00.000000
+
+"""
+from datetime import datetime
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e5b7d9f1a3c6'
+down_revision: Union[str, Sequence[str], None] = 'c9f1a3e5b7d2'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# Сколько секций вперед создается сразу (дальше их создает задача maintain_chat_partitions)
+PREMAKE_MONTHS = 3
+
+
+def _month_start(value: datetime) -> datetime:
+    return datetime(value.year, value.month, 1)
+
+
+def _next_month(value: datetime) -> datetime:
+    return datetime(value.year + value.month // 12, value.month % 12 + 1, 1)
+
+
+def _partition_name(start: datetime) -> str:
+    return f"chat_messages_y{start.year}m{start.month:02d}"
+
+
+def _create_indexes() -> None:
+    op.execute(
+        'CREATE INDEX ix_chat_messages_dialog_timestamp ON chat_messages (sender_id, receiver_id, "timestamp", id)'
+    )
+    op.execute(
+        "CREATE INDEX ix_chat_messages_message_tsv ON chat_messages "
+        "USING gin (to_tsvector('simple', coalesce(message, '')))"
+    )
+    op.execute(
+        "ALTER TABLE chat_messages ADD CONSTRAINT fk_chat_messages_sender_id_users "
+        "FOREIGN KEY (sender_id) REFERENCES users (id) ON DELETE CASCADE"
+    )
+    op.execute(
+        "ALTER TABLE chat_messages ADD CONSTRAINT fk_chat_messages_receiver_id_users "
+        "FOREIGN KEY (receiver_id) REFERENCES users (id) ON DELETE CASCADE"
+    )
+
+
+def _column_names(conn, table: str) -> list:
+    return [c["name"] for c in sa.inspect(conn).get_columns(table)]
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table('chat_archives',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('partition', sa.String(), nullable=False),
+    sa.Column('period_start', sa.DateTime(), nullable=False),
+    sa.Column('period_end', sa.DateTime(), nullable=False),
+    sa.Column('location', sa.String(), nullable=False),
+    sa.Column('row_count', sa.Integer(), nullable=False, server_default='0'),
+    sa.Column('size_bytes', sa.BigInteger(), nullable=False, server_default='0'),
+    sa.Column('min_message_id', sa.Integer(), nullable=True),
+    sa.Column('max_message_id', sa.Integer(), nullable=True),
+    sa.Column('created_at', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('id', name=op.f('pk_chat_archives')),
+    sa.UniqueConstraint('partition', name=op.f('uq_chat_archives_partition'))
+    )
+    op.create_index(op.f('ix_chat_archives_period_start'), 'chat_archives', ['period_start'], unique=False)
+
+    bind = op.get_bind()
+    if bind.dialect.name != 'postgresql':
+        # Секционирование - только PostgreSQL; в SQLite (тесты, разработка) таблица остается обычной
+        return
+
+    # Секционированная таблица не может иметь уникальный ключ без ключа секционирования:
+    # первичный ключ становится (id, timestamp), внешние ключи на chat_messages.id
+    # (reply_to_id, chat_attachments.message_id) удаляются вместе со старой таблицей
+    op.execute("ALTER TABLE chat_messages RENAME TO chat_messages_unpartitioned")
+    sequence = bind.execute(sa.text("SELECT pg_get_serial_sequence('chat_messages_unpartitioned', 'id')")).scalar()
+    op.execute(f"ALTER SEQUENCE {sequence} OWNED BY NONE")
+    op.execute(
+        "CREATE TABLE chat_messages (LIKE chat_messages_unpartitioned INCLUDING DEFAULTS) "
+        'PARTITION BY RANGE ("timestamp")'
+    )
+    op.execute('ALTER TABLE chat_messages ALTER COLUMN "timestamp" SET NOT NULL')
+
+    now = datetime.utcnow()
+    first = bind.execute(sa.text('SELECT min("timestamp") FROM chat_messages_unpartitioned')).scalar() or now
+    start = _month_start(first)
+    last = _month_start(now)
+    for _ in range(PREMAKE_MONTHS):
+        last = _next_month(last)
+    while start <= last:
+        end = _next_month(start)
+        op.execute(
+            f"CREATE TABLE {_partition_name(start)} PARTITION OF chat_messages "
+            f"FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}')"
+        )
+        start = end
+    # Строки вне созданных секций (задача обслуживания не успела создать следующую)
+    op.execute("CREATE TABLE chat_messages_default PARTITION OF chat_messages DEFAULT")
+
+    names = _column_names(bind, 'chat_messages_unpartitioned')
+    columns = ", ".join(f'"{name}"' for name in names)
+    # Ключ секционирования обязателен: сообщения без времени отправки получают время миграции
+    values = ", ".join(
+        """coalesce("timestamp", now() AT TIME ZONE 'utc')""" if name == "timestamp" else f'"{name}"'
+        for name in names
+    )
+    op.execute(f"INSERT INTO chat_messages ({columns}) SELECT {values} FROM chat_messages_unpartitioned")
+    op.execute(f"ALTER SEQUENCE {sequence} OWNED BY chat_messages.id")
+    op.execute("DROP TABLE chat_messages_unpartitioned CASCADE")
+
+    op.execute('ALTER TABLE chat_messages ADD CONSTRAINT pk_chat_messages PRIMARY KEY (id, "timestamp")')
+    _create_indexes()
+
+
+def downgrade() -> None:
+    """Downgrade schema. Сообщения уже выгруженных в архив секций в таблицу не возвращаются."""
+    bind = op.get_bind()
+    if bind.dialect.name == 'postgresql':
+        op.execute("ALTER TABLE chat_messages RENAME TO chat_messages_partitioned")
+        sequence = bind.execute(sa.text("SELECT pg_get_serial_sequence('chat_messages_partitioned', 'id')")).scalar()
+        op.execute(f"ALTER SEQUENCE {sequence} OWNED BY NONE")
+        op.execute("CREATE TABLE chat_messages (LIKE chat_messages_partitioned INCLUDING DEFAULTS)")
+        op.execute('ALTER TABLE chat_messages ALTER COLUMN "timestamp" DROP NOT NULL')
+        columns = ", ".join(f'"{name}"' for name in _column_names(bind, 'chat_messages_partitioned'))
+        op.execute(f"INSERT INTO chat_messages ({columns}) SELECT {columns} FROM chat_messages_partitioned")
+        op.execute(f"ALTER SEQUENCE {sequence} OWNED BY chat_messages.id")
+        op.execute("DROP TABLE chat_messages_partitioned CASCADE")
+
+        op.execute("ALTER TABLE chat_messages ADD CONSTRAINT pk_chat_messages PRIMARY KEY (id)")
+        _create_indexes()
+        # Ответы и вложения, ссылающиеся на выгруженные в архив сообщения, теряют ссылку
+        op.execute(
+            "UPDATE chat_messages SET reply_to_id = NULL "
+            "WHERE reply_to_id IS NOT NULL AND reply_to_id NOT IN (SELECT id FROM chat_messages)"
+        )
+        op.execute("DELETE FROM chat_attachments WHERE message_id NOT IN (SELECT id FROM chat_messages)")
+        op.execute(
+            "ALTER TABLE chat_messages ADD CONSTRAINT fk_chat_messages_reply_to_id "
+            "FOREIGN KEY (reply_to_id) REFERENCES chat_messages (id)"
+        )
+        op.execute(
+            "ALTER TABLE chat_attachments ADD CONSTRAINT fk_chat_attachments_message_id_chat_messages "
+            "FOREIGN KEY (message_id) REFERENCES chat_messages (id) ON DELETE CASCADE"
+        )
+
+    op.drop_index(op.f('ix_chat_archives_period_start'), table_name='chat_archives')
+    op.drop_table('chat_archives')
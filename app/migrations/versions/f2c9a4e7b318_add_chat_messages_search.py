@@ -0,0 +1,66 @@
+"""add full-text search index for chat messages
+
+Revision ID: f2c9a4e7b318
+Revises: e1b6c8d4a927
+Create Date: 2026-10-17 16:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'f2c9a4e7b318'
+down_revision: Union[str, Sequence[str], None] = 'e1b6c8d4a927'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    bind = op.get_bind()
+    dialect = bind.dialect.name
+
+    if dialect == 'postgresql':
+        # CONCURRENTLY не блокирует запись в chat_messages на время построения индекса
+        with op.get_context().autocommit_block():
+            op.execute(
+                "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_chat_messages_message_tsv ON chat_messages "
+                "USING gin (to_tsvector('simple', coalesce(message, '')))"
+            )
+    elif dialect == 'sqlite':
+        op.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS chat_messages_fts USING fts5("
+            "message, content='chat_messages', content_rowid='id', tokenize='unicode61')"
+        )
+        op.execute(
+            "CREATE TRIGGER IF NOT EXISTS chat_messages_fts_ai AFTER INSERT ON chat_messages BEGIN "
+            "INSERT INTO chat_messages_fts(rowid, message) VALUES (new.id, new.message); END"
+        )
+        op.execute(
+            "CREATE TRIGGER IF NOT EXISTS chat_messages_fts_ad AFTER DELETE ON chat_messages BEGIN "
+            "INSERT INTO chat_messages_fts(chat_messages_fts, rowid, message) VALUES ('delete', old.id, old.message); END"
+        )
+        op.execute(
+            "CREATE TRIGGER IF NOT EXISTS chat_messages_fts_au AFTER UPDATE OF message ON chat_messages BEGIN "
+            "INSERT INTO chat_messages_fts(chat_messages_fts, rowid, message) VALUES ('delete', old.id, old.message); "
+            "INSERT INTO chat_messages_fts(rowid, message) VALUES (new.id, new.message); END"
+        )
+        op.execute("INSERT INTO chat_messages_fts(chat_messages_fts) VALUES ('rebuild')")
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    bind = op.get_bind()
+    dialect = bind.dialect.name
+
+    if dialect == 'postgresql':
+        with op.get_context().autocommit_block():
+            op.execute("DROP INDEX CONCURRENTLY IF EXISTS ix_chat_messages_message_tsv")
+    elif dialect == 'sqlite':
+        op.execute("DROP TRIGGER IF EXISTS chat_messages_fts_au")
+        op.execute("DROP TRIGGER IF EXISTS chat_messages_fts_ad")
+        op.execute("DROP TRIGGER IF EXISTS chat_messages_fts_ai")
+        op.execute("DROP TABLE IF EXISTS chat_messages_fts")
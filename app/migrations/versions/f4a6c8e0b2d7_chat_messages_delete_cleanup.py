@@ -0,0 +1,53 @@
+"""clean up attachments and replies after chat_messages deletes
+
+Revision ID: f4a6c8e0b2d7
+Revises: e5b7d9f1a3c6
+Create Date: 2026-10-17 22:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'f4a6c8e0b2d7'
+down_revision: Union[str, Sequence[str], None] = 'e5b7d9f1a3c6'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+
+    # После секционирования (e5b7d9f1a3c6) внешних ключей на chat_messages.id нет: их каскад заменяет триггер.
+    # Он срабатывает при любом удалении строки - из приложения, из админки и каскадом при удалении пользователя
+    op.execute(
+        "CREATE FUNCTION chat_messages_after_delete() RETURNS trigger AS $$\n"
+        "BEGIN\n"
+        "    DELETE FROM chat_attachments WHERE message_id = OLD.id;\n"
+        "    UPDATE chat_messages SET reply_to_id = NULL WHERE reply_to_id = OLD.id;\n"
+        "    RETURN NULL;\n"
+        "END;\n"
+        "$$ LANGUAGE plpgsql"
+    )
+    op.execute(
+        "CREATE TRIGGER chat_messages_after_delete AFTER DELETE ON chat_messages "
+        "FOR EACH ROW EXECUTE FUNCTION chat_messages_after_delete()"
+    )
+    # Первичный ключ (id, timestamp) не помогает запросам по одному id (прочтение, удаление, ответы):
+    # без своего индекса они просматривают все секции
+    op.execute("CREATE INDEX ix_chat_messages_id ON chat_messages (id)")
+    op.execute("CREATE INDEX ix_chat_messages_reply_to_id ON chat_messages (reply_to_id) WHERE reply_to_id IS NOT NULL")
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+    op.execute("DROP INDEX ix_chat_messages_reply_to_id")
+    op.execute("DROP INDEX ix_chat_messages_id")
+    op.execute("DROP TRIGGER chat_messages_after_delete ON chat_messages")
+    op.execute("DROP FUNCTION chat_messages_after_delete()")
@@ -5,7 +5,7 @@ from .news import News, NewsImage, NewsReaction, NewsComment, NewsCommentReactio
 from .products import Product, ProductImage
 from .reviews import Reviews, ReviewReaction
 from .users import User, UserPhoto, AdminPermission, AppVersion, PhotoAlbum, Friendship, UserPhotoComment, UserPhotoReaction, UserPhotoCommentReaction, PhotoAlbumComment, PhotoAlbumReaction, PhotoAlbumCommentReaction
-from .chat import ChatMessage, FileUploadSession
+from .chat import ChatMessage, ChatAttachment, FileUploadSession, ChatDialog, ChatArchive
 
 
 __all__ = ["Category", "Product", "ProductImage", "News", "NewsImage", "NewsReaction", "NewsComment", "NewsCommentReaction",
@@ -14,5 +14,5 @@ __all__ = ["Category", "Product", "ProductImage", "News", "NewsImage", "NewsReac
            'PhotoAlbumComment', 'PhotoAlbumReaction', 'PhotoAlbumCommentReaction',
            'Reviews', 'ReviewReaction', 'CartItem',
            "Order", "OrderItem",
-           "ChatMessage", "FileUploadSession"
+           "ChatMessage", "ChatAttachment", "FileUploadSession", "ChatDialog", "ChatArchive"
            ]
\ No newline at end of file
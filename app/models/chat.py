@@ -1,11 +1,19 @@
-from sqlalchemy import Integer, String, ForeignKey, DateTime, Boolean
+from sqlalchemy import BigInteger, Float, Integer, String, ForeignKey, DateTime, Boolean, UniqueConstraint, Index
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 from datetime import datetime
 
 from app.database import Base
 
 class ChatMessage(Base):
+    # В PostgreSQL таблица разбита на помесячные секции по timestamp (миграция partition_chat_messages):
+    # первичный ключ там (id, timestamp), и внешних ключей на chat_messages.id в БД нет -
+    # ForeignKey ниже описывают связи для ORM. Вложения и ссылки ответов на удаленную строку
+    # чистит триггер chat_messages_after_delete (миграция chat_messages_delete_cleanup)
     __tablename__ = "chat_messages"
+    __table_args__ = (
+        # Keyset-пагинация истории: каждая сторона диалога читается по индексу в порядке (timestamp, id)
+        Index("ix_chat_messages_dialog_timestamp", "sender_id", "receiver_id", "timestamp", "id"),
+    )
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     sender_id: Mapped[int] = mapped_column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
@@ -26,6 +34,26 @@ class ChatMessage(Base):
     sender = relationship("User", foreign_keys=[sender_id])
     receiver = relationship("User", foreign_keys=[receiver_id])
     reply_to = relationship("ChatMessage", remote_side=[id])
+    # Загружаются явно (selectinload) - одним запросом на страницу истории.
+    # Без passive_deletes: каскада БД на chat_attachments в PostgreSQL больше нет, ORM удаляет строки сам
+    attachments = relationship(
+        "ChatAttachment", order_by="ChatAttachment.position", cascade="all, delete-orphan"
+    )
+
+class ChatAttachment(Base):
+    """Вложение сообщения (элемент media_group или файл загрузки) с метаданными для разметки без скачивания."""
+    __tablename__ = "chat_attachments"
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    message_id: Mapped[int] = mapped_column(Integer, ForeignKey("chat_messages.id", ondelete="CASCADE"), nullable=False, index=True)
+    position: Mapped[int] = mapped_column(Integer, default=0, nullable=False)
+    url: Mapped[str] = mapped_column(String, nullable=False)
+    type: Mapped[str] = mapped_column(String, nullable=False, default="file") # image, video, file, ...
+    size: Mapped[int] = mapped_column(BigInteger, nullable=True) # байты
+    width: Mapped[int] = mapped_column(Integer, nullable=True)
+    height: Mapped[int] = mapped_column(Integer, nullable=True)
+    duration: Mapped[float] = mapped_column(Float, nullable=True) # секунды
+    thumbnail: Mapped[str] = mapped_column(String, nullable=True) # URL миниатюры
 
 class FileUploadSession(Base):
     __tablename__ = "file_upload_sessions"
@@ -38,3 +66,48 @@ class FileUploadSession(Base):
     offset: Mapped[int] = mapped_column(Integer, default=0)
     created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
     is_completed: Mapped[bool] = mapped_column(Boolean, default=False)
+    # Потоковая загрузка в S3 (multipart upload): ключ объекта, UploadId и JSON-список отправленных частей
+    storage_key: Mapped[str] = mapped_column(String, nullable=True)
+    multipart_upload_id: Mapped[str] = mapped_column(String, nullable=True)
+    multipart_parts: Mapped[str] = mapped_column(String, nullable=True)
+    # Загрузки (legacy-чанки и tus): назначение файла (chat/app), режим конкатенации tus (partial/final),
+    # метаданные клиента (JSON) и итоговый URL файла после завершения
+    kind: Mapped[str] = mapped_column(String, nullable=False, default="chat", server_default="chat")
+    concat: Mapped[str] = mapped_column(String, nullable=True)
+    upload_metadata: Mapped[str] = mapped_column(String, nullable=True)
+    result_url: Mapped[str] = mapped_column(String, nullable=True)
+
+class ChatDialog(Base):
+    """Денормализованная сводка диалога для списка чатов: одна строка на пару (user_id -> partner_id)."""
+    __tablename__ = "chat_dialogs"
+    __table_args__ = (
+        UniqueConstraint("user_id", "partner_id"),
+        Index("ix_chat_dialogs_user_id_last_message_time", "user_id", "last_message_time"),
+    )
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    user_id: Mapped[int] = mapped_column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
+    partner_id: Mapped[int] = mapped_column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
+    last_message_id: Mapped[int] = mapped_column(Integer, nullable=True) # NULL - видимых сообщений нет
+    last_message_preview: Mapped[str] = mapped_column(String, nullable=True)
+    last_message_time: Mapped[datetime] = mapped_column(DateTime, nullable=True)
+    unread_count: Mapped[int] = mapped_column(Integer, default=0, nullable=False)
+    # id последнего прочитанного входящего сообщения от partner_id; все сообщения с id <= отметки считаются прочитанными
+    last_read_message_id: Mapped[int] = mapped_column(Integer, default=0, server_default="0", nullable=False)
+
+    partner = relationship("User", foreign_keys=[partner_id])
+
+class ChatArchive(Base):
+    """Секция chat_messages, выгруженная в Parquet (одна строка на месяц)."""
+    __tablename__ = "chat_archives"
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    partition: Mapped[str] = mapped_column(String, nullable=False, unique=True) # chat_messages_yYYYYmMM
+    period_start: Mapped[datetime] = mapped_column(DateTime, nullable=False, index=True)
+    period_end: Mapped[datetime] = mapped_column(DateTime, nullable=False)
+    location: Mapped[str] = mapped_column(String, nullable=False) # ключ S3 или путь к файлу
+    row_count: Mapped[int] = mapped_column(Integer, default=0, nullable=False)
+    size_bytes: Mapped[int] = mapped_column(BigInteger, default=0, nullable=False)
+    min_message_id: Mapped[int] = mapped_column(Integer, nullable=True)
+    max_message_id: Mapped[int] = mapped_column(Integer, nullable=True)
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
@@ -49,6 +49,30 @@ class ChatMessageResponse(ChatMessageBase):
     class Config:
         from_attributes = True
 
+class HistoryCursor(BaseModel):
+    before_id: int
+    before_ts: datetime
+
+class ChatHistoryPage(BaseModel):
+    data: list[ChatMessageResponse]
+    next_cursor: Optional[HistoryCursor] = None # None - более старых сообщений нет
+    archive_cursor: Optional[HistoryCursor] = None # Курсор для /archive, когда история в БД закончилась, а архив есть
+
+class ChatSearchResult(BaseModel):
+    id: int
+    timestamp: datetime
+    message: Optional[str] = None
+    file_path: Optional[str] = None
+    sender_id: int
+    receiver_id: int
+    message_type: str
+    snippet: Optional[str] = None # Фрагмент текста с подсвеченными совпадениями (<b>...</b>)
+    rank: float = 0
+
+class ChatSearchPage(BaseModel):
+    data: list[ChatSearchResult]
+    next_offset: Optional[int] = None # None - результатов больше нет
+
 class DialogResponse(BaseModel):
     user_id: int
     email: str
@@ -0,0 +1,176 @@
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Optional, Tuple
+
+from loguru import logger
+from sqlalchemy import and_, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import aliased
+
+from app.models.chat import ChatMessage
+from app.models.users import User as UserModel
+from app.services import chat_attachments, chat_cache, chat_writer
+from app.services.chat_cache import history_item
+from app.services.chat_dialogs import touch_dialogs
+
+# Отправка сообщения, общая для WebSocket и REST. До записи выполняется один SELECT: получатель
+# (FCM-токен), цитируемое сообщение с именем автора и уже созданные сообщения с тем же client_id
+# (placeholder загрузки или повтор отправки). Затем один INSERT (или UPDATE placeholder) и один upsert
+# сводок диалога обоих участников.
+
+# Окно, в котором повтор client_id считается тем же сообщением
+CLIENT_ID_WINDOW = timedelta(hours=24)
+
+
+@dataclass
+class SentMessage:
+    message: ChatMessage
+    # False - обновлено существующее сообщение с тем же client_id (уже учтено в непрочитанных)
+    created: bool
+    reply_to: Optional[dict]
+    receiver_fcm_token: Optional[str]
+
+
+def display_name(first_name: Optional[str], last_name: Optional[str]) -> str:
+    return f"{first_name or ''} {last_name or ''}".strip() or "Пользователь"
+
+
+async def cache_sent_message(msg: ChatMessage, reply_to: Optional[dict]) -> None:
+    """Сообщение после commit - в буфер истории диалога; если данные ответа не собраны, буфер сбрасывается."""
+    if msg.reply_to_id and reply_to is None:
+        await chat_cache.invalidate(msg.sender_id, msg.receiver_id)
+    else:
+        await chat_cache.push(history_item(msg, reply_to))
+
+
+async def send(
+    db: AsyncSession,
+    sender_id: int,
+    receiver_id: int,
+    content: Optional[str],
+    file_path: Optional[str],
+    message_type: str,
+    client_id: Optional[str] = None,
+    duration: Optional[float] = None,
+    reply_to_id: Optional[int] = None,
+    attachments: Optional[list] = None
+) -> Optional[SentMessage]:
+    """
+    Сохраняет сообщение (или завершает placeholder с тем же client_id) и фиксирует транзакцию.
+    attachments - вложения media_group (строки chat_attachments). None - получателя нет.
+    """
+    receiver = aliased(UserModel)
+    reply = aliased(ChatMessage)
+    reply_sender = aliased(UserModel)
+    existing = aliased(ChatMessage, name="existing")
+    stmt = select(
+        receiver.fcm_token,
+        reply.id.label("reply_id"), reply.message.label("reply_message"),
+        reply.message_type.label("reply_message_type"), reply.sender_id.label("reply_sender_id"),
+        reply_sender.first_name.label("reply_first_name"), reply_sender.last_name.label("reply_last_name")
+    ).select_from(receiver)
+    stmt = (
+        stmt.outerjoin(reply, reply.id == (reply_to_id or 0))
+        .outerjoin(reply_sender, reply_sender.id == reply.sender_id)
+        .where(receiver.id == receiver_id)
+    )
+    if client_id:
+        stmt = stmt.add_columns(existing).outerjoin(existing, and_(
+            existing.client_id == client_id,
+            existing.sender_id == sender_id,
+            existing.timestamp >= datetime.utcnow() - CLIENT_ID_WINDOW
+        )).order_by(existing.id)
+    # Сессия сокета живет дольше запроса: placeholder перечитывается, а не берется из identity map
+    rows = (await db.execute(stmt.execution_options(populate_existing=True))).all()
+    if not rows:
+        return None
+    first = rows[0]
+    reply_to = None
+    if first.reply_id is not None:
+        reply_to = {
+            "id": first.reply_id,
+            "message": first.reply_message,
+            "message_type": first.reply_message_type,
+            "sender_id": first.reply_sender_id,
+            "sender_name": display_name(first.reply_first_name, first.reply_last_name)
+        }
+
+    # Если было несколько плейсхолдеров (например, для разных файлов в группе), берем первый для обновления, остальные удалим
+    matches = [row.existing for row in rows if row.existing is not None] if client_id else []
+    msg = matches[0] if matches else None
+    for extra in matches[1:]:
+        await db.delete(extra)
+    if len(matches) > 1:
+        logger.debug(f"Removed {len(matches) - 1} extra placeholders for client_id {client_id}")
+
+    # Ответ на сообщение, которого нет в БД, в пачку не берется: строка не запишется и задержит очередь
+    if msg is None and chat_writer.enabled(db) and not (reply_to_id and reply_to is None):
+        pending = await chat_writer.submit(
+            db, sender_id, receiver_id, content, file_path, message_type, client_id, duration, reply_to_id,
+            attachments=attachments, cached_item=lambda m: history_item(m, reply_to)
+        )
+        if pending is not None:
+            msg, created = pending
+            # Закрываем читающую транзакцию: сообщение запишет пачка
+            await db.commit()
+            if created:
+                await cache_sent_message(msg, reply_to)
+            return SentMessage(message=msg, created=created, reply_to=reply_to, receiver_fcm_token=first.fcm_token)
+
+    if msg is not None:
+        logger.debug(f"Updating existing message {msg.id} with client_id {client_id}")
+        msg.message = content
+        msg.file_path = file_path
+        # Не затираем видео-заметку (кружок) и более точный тип placeholder общим "file"
+        if message_type != "file" and msg.message_type != "video_note":
+            msg.message_type = message_type
+        msg.duration = duration
+        if reply_to_id:
+            msg.reply_to_id = reply_to_id
+        msg.is_uploading = False
+        msg.upload_id = None
+        msg.timestamp = datetime.utcnow()
+        if attachments:
+            await chat_attachments.replace(db, msg.id, attachments)
+    else:
+        msg = ChatMessage(
+            sender_id=sender_id,
+            receiver_id=receiver_id,
+            message=content,
+            file_path=file_path,
+            message_type=message_type,
+            client_id=client_id,
+            duration=duration,
+            reply_to_id=reply_to_id,
+            is_uploading=False,
+            deleted_by_sender=False,
+            deleted_by_receiver=False,
+            timestamp=datetime.utcnow(),
+            attachments=chat_attachments.build(attachments)
+        )
+        db.add(msg)
+
+    await db.flush()
+    await touch_dialogs(db, msg, count_unread=not matches)
+    await db.commit()
+
+    if len(matches) > 1:
+        await chat_cache.invalidate(sender_id, receiver_id)
+    else:
+        await cache_sent_message(msg, reply_to)
+    return SentMessage(message=msg, created=not matches, reply_to=reply_to, receiver_fcm_token=first.fcm_token)
+
+
+async def notify_context(db: AsyncSession, sender_id: int, receiver_id: int) -> Tuple[str, Optional[str], Optional[str]]:
+    """Имя и аватар отправителя и FCM-токен получателя одним запросом: (sender_name, sender_avatar, receiver_fcm_token)."""
+    sender = aliased(UserModel)
+    receiver = aliased(UserModel)
+    row = (await db.execute(
+        select(sender.first_name, sender.last_name, sender.avatar_url, receiver.fcm_token)
+        .select_from(receiver)
+        .outerjoin(sender, sender.id == sender_id)
+        .where(receiver.id == receiver_id)
+    )).first()
+    if row is None:
+        return "Пользователь", None, None
+    return display_name(row.first_name, row.last_name), row.avatar_url, row.fcm_token
@@ -0,0 +1,254 @@
+import json
+import os
+import re
+import tempfile
+from datetime import datetime
+from typing import List, Optional, Tuple
+
+from loguru import logger
+from sqlalchemy import select, text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.core.config import CHAT_ARCHIVE_DIR, CHAT_PARTITION_PREMAKE_MONTHS
+from app.models.chat import ChatArchive
+from app.utils import aiofile, storage, storage_s3
+
+try:
+    import pandas as pd
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # pragma: no cover - без pandas/pyarrow секции не архивируются, а архив не читается
+    pd = pa = pq = None
+
+# Помесячные секции chat_messages (PostgreSQL, см. миграцию partition_chat_messages): chat_messages_yYYYYmMM
+# с диапазоном [начало месяца, начало следующего) и chat_messages_default для строк вне секций.
+# Задача maintain_chat_partitions заранее создает секции на CHAT_PARTITION_PREMAKE_MONTHS месяцев вперед,
+# а секции старше CHAT_ARCHIVE_AFTER_MONTHS выгружает в Parquet (сжатие zstd, строки упорядочены по диалогу,
+# так что статистика групп строк отсекает чужие диалоги при чтении), записывает в chat_archives и удаляет.
+# Архив читается медленным путем истории (/chat/history/{id}/archive); из S3 файл скачивается в CHAT_ARCHIVE_DIR.
+# Вложения сообщения (chat_attachments) пишутся в ту же строку Parquet JSON-списком (колонка attachments)
+# и удаляются из chat_attachments в транзакции архивации: отсоединение секции не запускает триггер удаления строк.
+
+PARTITION_RE = re.compile(r"^chat_messages_y(\d{4})m(\d{2})$")
+ARCHIVE_CATEGORY = "chat-archive"
+# Строк в группе строк Parquet (и в одной порции чтения секции)
+ROW_GROUP_SIZE = 50_000
+
+ARCHIVE_SCHEMA = pa.schema([
+    ("id", pa.int64()),
+    ("sender_id", pa.int64()),
+    ("receiver_id", pa.int64()),
+    ("message", pa.string()),
+    ("file_path", pa.string()),
+    ("message_type", pa.string()),
+    ("client_id", pa.string()),
+    ("duration", pa.float64()),
+    ("timestamp", pa.timestamp("us")),
+    ("is_read", pa.int64()),
+    ("reply_to_id", pa.int64()),
+    ("deleted_by_sender", pa.bool_()),
+    ("deleted_by_receiver", pa.bool_()),
+    ("is_uploading", pa.bool_()),
+    ("upload_id", pa.string()),
+    ("attachments", pa.string()),
+]) if pa is not None else None
+
+_ATTACHMENT_FIELDS = ("position", "url", "type", "size", "width", "height", "duration", "thumbnail")
+
+
+def available() -> bool:
+    return pq is not None
+
+
+def month_start(value: datetime) -> datetime:
+    return datetime(value.year, value.month, 1)
+
+
+def add_months(value: datetime, months: int) -> datetime:
+    index = value.year * 12 + value.month - 1 + months
+    return datetime(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(start: datetime) -> str:
+    return f"chat_messages_y{start.year}m{start.month:02d}"
+
+
+async def list_partitions(db: AsyncSession) -> List[Tuple[str, datetime]]:
+    """Помесячные секции chat_messages: (имя, начало месяца) по возрастанию."""
+    res = await db.execute(text(
+        "SELECT child.relname FROM pg_inherits "
+        "JOIN pg_class parent ON parent.oid = pg_inherits.inhparent "
+        "JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+        "WHERE parent.relname = 'chat_messages'"
+    ))
+    partitions = []
+    for name in res.scalars():
+        match = PARTITION_RE.match(name)
+        if match:
+            partitions.append((name, datetime(int(match.group(1)), int(match.group(2)), 1)))
+    return sorted(partitions, key=lambda p: p[1])
+
+
+async def ensure_partitions(db: AsyncSession, months_ahead: int = CHAT_PARTITION_PREMAKE_MONTHS) -> List[str]:
+    """Создает недостающие секции с текущего месяца на months_ahead вперед. Возвращает имена созданных."""
+    existing = {name for name, _ in await list_partitions(db)}
+    created = []
+    start = month_start(datetime.utcnow())
+    for offset in range(months_ahead + 1):
+        period_start = add_months(start, offset)
+        name = partition_name(period_start)
+        if name in existing:
+            continue
+        try:
+            async with db.begin_nested():
+                await db.execute(text(
+                    f"CREATE TABLE {name} PARTITION OF chat_messages "
+                    f"FOR VALUES FROM ('{period_start.isoformat()}') TO ('{add_months(period_start, 1).isoformat()}')"
+                ))
+            created.append(name)
+        except Exception as e:
+            # Например, в chat_messages_default уже есть строки этого месяца - их нужно перенести вручную
+            logger.error(f"Chat partitions: failed to create {name}: {e}")
+    await db.commit()
+    return created
+
+
+def _attachments_sql(db: AsyncSession) -> str:
+    """Подзапрос: вложения сообщения m JSON-списком по position (NULL, если вложений нет)."""
+    fields = ", ".join(f"'{f}', a.{f}" for f in _ATTACHMENT_FIELDS)
+    if db.bind.dialect.name == "postgresql":
+        return (
+            f"(SELECT json_agg(json_build_object({fields}) ORDER BY a.position)::text "
+            f"FROM chat_attachments a WHERE a.message_id = m.id)"
+        )
+    return (
+        f"(SELECT json_group_array(json_object({fields})) FROM (SELECT * FROM chat_attachments "
+        f"WHERE message_id = m.id ORDER BY position) a HAVING count(*) > 0)"
+    )
+
+
+def _store(path: str, name: str) -> str:
+    """Кладет файл архива в хранилище. Возвращает ключ S3 или путь к файлу."""
+    if storage.MEDIA_STORAGE == "s3":
+        key = f"{ARCHIVE_CATEGORY}/{name}.parquet"
+        with open(path, "rb") as f:
+            storage_s3.upload_fileobj(f, key, "application/vnd.apache.parquet", acl="private")
+        os.remove(path)
+        return key
+    target = os.path.join(CHAT_ARCHIVE_DIR, f"{name}.parquet")
+    os.replace(path, target)
+    return target
+
+
+async def archive_partition(db: AsyncSession, name: str, period_start: datetime) -> ChatArchive:
+    """Выгружает секцию в Parquet, записывает chat_archives, отсоединяет и удаляет секцию (одна транзакция)."""
+    os.makedirs(CHAT_ARCHIVE_DIR, exist_ok=True)
+    fd, path = tempfile.mkstemp(suffix=".parquet", dir=CHAT_ARCHIVE_DIR)
+    os.close(fd)
+    row_count, min_id, max_id = 0, None, None
+    try:
+        columns = ", ".join(f'm."{field.name}"' for field in ARCHIVE_SCHEMA if field.name != "attachments")
+        result = await db.stream(text(
+            f'SELECT {columns}, {_attachments_sql(db)} AS attachments FROM {name} m '
+            f'ORDER BY m.sender_id, m.receiver_id, m."timestamp", m.id'
+        ))
+        with pq.ParquetWriter(path, ARCHIVE_SCHEMA, compression="zstd") as writer:
+            async for rows in result.partitions(ROW_GROUP_SIZE):
+                frame = pd.DataFrame(rows, columns=ARCHIVE_SCHEMA.names)
+                writer.write_table(pa.Table.from_pandas(frame, schema=ARCHIVE_SCHEMA, preserve_index=False))
+                row_count += len(frame)
+                chunk_min, chunk_max = int(frame["id"].min()), int(frame["id"].max())
+                min_id = chunk_min if min_id is None else min(min_id, chunk_min)
+                max_id = chunk_max if max_id is None else max(max_id, chunk_max)
+        size = os.path.getsize(path)
+        location = await aiofile.run("archive_store", _store, path, name)
+    except Exception:
+        if os.path.exists(path):
+            os.remove(path)
+        raise
+
+    archive = ChatArchive(
+        partition=name,
+        period_start=period_start,
+        period_end=add_months(period_start, 1),
+        location=location,
+        row_count=row_count,
+        size_bytes=size,
+        min_message_id=min_id,
+        max_message_id=max_id
+    )
+    db.add(archive)
+    await db.execute(text(f"DELETE FROM chat_attachments WHERE message_id IN (SELECT id FROM {name})"))
+    await db.execute(text(f"ALTER TABLE chat_messages DETACH PARTITION {name}"))
+    await db.execute(text(f"DROP TABLE {name}"))
+    await db.commit()
+    logger.info(f"Chat partitions: archived {name} ({row_count} rows, {size} bytes) to {location}")
+    return archive
+
+
+def _local_path(archive: ChatArchive) -> str:
+    if storage.MEDIA_STORAGE != "s3":
+        return archive.location
+    path = os.path.join(CHAT_ARCHIVE_DIR, f"{archive.partition}.parquet")
+    if not os.path.exists(path):
+        os.makedirs(CHAT_ARCHIVE_DIR, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(suffix=".parquet", dir=CHAT_ARCHIVE_DIR)
+        os.close(fd)
+        storage_s3.download_file(archive.location, tmp)
+        os.replace(tmp, path)
+    return path
+
+
+def _read_dialog(archive: ChatArchive, user_a: int, user_b: int, before_ts: Optional[datetime]) -> List[dict]:
+    time_filter = [("timestamp", "<=", before_ts)] if before_ts is not None else []
+    table = pq.read_table(_local_path(archive), filters=[
+        [("sender_id", "=", user_a), ("receiver_id", "=", user_b), *time_filter],
+        [("sender_id", "=", user_b), ("receiver_id", "=", user_a), *time_filter],
+    ])
+    rows = table.to_pylist()
+    # Архивы, записанные до появления колонки attachments, ее не содержат - ключа в строке нет
+    if "attachments" in table.column_names:
+        for row in rows:
+            row["attachments"] = json.loads(row["attachments"]) if row["attachments"] else []
+    return rows
+
+
+async def read_dialog(
+    db: AsyncSession,
+    user_id: int,
+    other_user_id: int,
+    limit: int,
+    before_ts: Optional[datetime] = None,
+    before_id: Optional[int] = None
+) -> List[dict]:
+    """
+    Видимые user_id сообщения диалога из архивов, новые первыми, строго раньше курсора (before_ts, before_id).
+    Строки - колонки chat_messages и attachments (список строк chat_attachments без id и message_id;
+    ключа нет у архивов старого формата). Пустой список, если архивов нет или pandas/pyarrow не установлены.
+    """
+    if not available():
+        logger.warning("Chat archive: pandas/pyarrow are not installed, archived history is unavailable")
+        return []
+    stmt = select(ChatArchive).order_by(ChatArchive.period_start.desc())
+    if before_ts is not None:
+        stmt = stmt.where(ChatArchive.period_start <= before_ts)
+    archives = (await db.execute(stmt)).scalars().all()
+
+    found: List[dict] = []
+    for archive in archives:
+        rows = await aiofile.run("archive_read", _read_dialog, archive, user_id, other_user_id, before_ts)
+        for row in rows:
+            if before_ts is not None and (row["timestamp"], row["id"]) >= (before_ts, before_id or 0):
+                continue
+            deleted = row["deleted_by_sender"] if row["sender_id"] == user_id else row["deleted_by_receiver"]
+            if not deleted:
+                found.append(row)
+        if len(found) >= limit:
+            break
+    found.sort(key=lambda row: (row["timestamp"], row["id"]), reverse=True)
+    return found[:limit]
+
+
+async def has_archives(db: AsyncSession) -> Optional[datetime]:
+    """Конец самого нового архива или None, если архивов нет."""
+    return (await db.execute(select(ChatArchive.period_end).order_by(ChatArchive.period_end.desc()).limit(1))).scalar()
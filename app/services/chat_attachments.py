@@ -0,0 +1,101 @@
+import json
+from typing import Any, Iterable, List, Optional
+
+from sqlalchemy import delete, inspect
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm.base import NO_VALUE
+
+from app.models.chat import ChatAttachment, ChatMessage
+
+# Вложения сообщений хранятся в chat_attachments (одна строка на файл). file_path у media_group
+# по-прежнему содержит JSON-список - для старых клиентов и очистки файлов при удалении сообщения.
+# В ответах API вложение - {file_path, type, size, width, height, duration, thumbnail}.
+
+
+def _int(value: Any) -> Optional[int]:
+    try:
+        return int(value) if value is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+def _float(value: Any) -> Optional[float]:
+    try:
+        return float(value) if value is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+def normalize(raw: Optional[Iterable]) -> List[dict]:
+    """Вложения от клиента ({file_path|url, type, ...}) в виде строк chat_attachments; элементы без URL отбрасываются."""
+    rows = []
+    for att in raw or []:
+        if not isinstance(att, dict):
+            continue
+        url = att.get("file_path") or att.get("url")
+        if not url:
+            continue
+        rows.append({
+            "position": len(rows),
+            "url": url,
+            "type": att.get("type") or "file",
+            "size": _int(att.get("size")),
+            "width": _int(att.get("width")),
+            "height": _int(att.get("height")),
+            "duration": _float(att.get("duration")),
+            "thumbnail": att.get("thumbnail") or att.get("thumbnail_url"),
+        })
+    return rows
+
+
+def build(raw: Optional[Iterable]) -> List[ChatAttachment]:
+    return [ChatAttachment(**row) for row in normalize(raw)]
+
+
+def _loaded(m: ChatMessage) -> Optional[List[ChatAttachment]]:
+    # Коллекция читается только если уже загружена (selectinload или задана при создании) - без ленивого SELECT
+    value = inspect(m).attrs.attachments.loaded_value
+    return None if value is NO_VALUE else value
+
+
+def items(rows: Iterable[ChatAttachment]) -> List[dict]:
+    return [
+        {
+            "file_path": a.url,
+            "type": a.type,
+            "size": a.size,
+            "width": a.width,
+            "height": a.height,
+            "duration": a.duration,
+            "thumbnail": a.thumbnail,
+        }
+        for a in rows
+    ]
+
+
+def attachment_items(m: ChatMessage) -> Optional[List[dict]]:
+    """Вложения для ответа API. Если строки не загружены, media_group читается из JSON в file_path."""
+    rows = _loaded(m)
+    if rows:
+        return items(rows)
+    if m.message_type == "media_group" and m.file_path:
+        try:
+            return json.loads(m.file_path)
+        except Exception:
+            return []
+    return None
+
+
+async def replace(db: AsyncSession, message_id: int, raw: Optional[Iterable]) -> List[ChatAttachment]:
+    """Заменяет вложения сохраненного сообщения (placeholder, получивший файлы)."""
+    await db.execute(delete(ChatAttachment).where(ChatAttachment.message_id == message_id))
+    rows = [ChatAttachment(message_id=message_id, **row) for row in normalize(raw)]
+    db.add_all(rows)
+    return rows
+
+
+async def delete_for_messages(db: AsyncSession, message_ids: Iterable[int]) -> None:
+    """Удаляет вложения сообщений, файлы которых удалены вместе с контентом."""
+    message_ids = list(message_ids)
+    if message_ids:
+        await db.execute(delete(ChatAttachment).where(ChatAttachment.message_id.in_(message_ids)))
@@ -0,0 +1,250 @@
+import json
+import time
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+from loguru import logger
+
+from app.core.config import CHAT_HISTORY_CACHE_DIALOGS, CHAT_HISTORY_CACHE_SIZE, CHAT_HISTORY_CACHE_TTL
+from app.core.redis import get_redis
+from app.models.chat import ChatMessage
+from app.services.chat_attachments import attachment_items
+
+# Кольцевой буфер последних сообщений диалога в Redis - из него отдается первая страница истории:
+#   chat:recent:{a}:{b}        - zset id сообщения -> время отправки (в микросекундах)
+#   chat:recent:{a}:{b}:items  - hash id -> сообщение в JSON и поле complete (1 - в буфере весь диалог)
+#   chat:recent:{a}:{b}:v      - версия диалога, растет при каждой записи
+#   chat:recent:lru            - zset диалог -> время последнего чтения (для вытеснения по LRU)
+# где a < b - id участников. Буфер не зависит от того, кто читает: флаги удаления хранятся в сообщении,
+# а is_read и прогресс загрузок вычисляются при чтении. Новые сообщения дописываются в буфер,
+# обновления правят его, удаления сбрасывают (буфер заново заполняется из БД при следующем чтении).
+# Источник истины - БД: при недоступности Redis история читается из БД.
+
+LRU_KEY = "chat:recent:lru"
+
+
+def dialog_id(user_a: int, user_b: int) -> str:
+    return f"{min(user_a, user_b)}:{max(user_a, user_b)}"
+
+
+def _keys(user_a: int, user_b: int) -> Tuple[str, str, str]:
+    base = f"chat:recent:{dialog_id(user_a, user_b)}"
+    return base, f"{base}:items", f"{base}:v"
+
+
+def _score(ts: datetime) -> int:
+    # Порядок буфера совпадает с порядком истории в БД (timestamp); id различает сообщения одной микросекунды
+    return int(ts.timestamp() * 1_000_000) if ts else 0
+
+
+# Читает буфер целиком (новые первыми) и отмечает обращение к диалогу в LRU; false - буфера нет
+_READ_SCRIPT = """
+local complete = redis.call('HGET', KEYS[2], 'complete')
+if not complete then
+    return false
+end
+local ids = redis.call('ZREVRANGE', KEYS[1], 0, -1)
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+redis.call('EXPIRE', KEYS[2], ARGV[1])
+redis.call('ZADD', KEYS[3], ARGV[2], ARGV[3])
+if #ids == 0 then
+    return {complete}
+end
+return {complete, unpack(redis.call('HMGET', KEYS[2], unpack(ids)))}
+"""
+
+# Заполняет буфер из БД, если версия диалога не менялась с начала чтения из БД (иначе снимок устарел),
+# и вытесняет самые давно читавшиеся диалоги сверх лимита
+_FILL_SCRIPT = """
+if (redis.call('GET', KEYS[3]) or '0') ~= ARGV[6] then
+    return 0
+end
+redis.call('DEL', KEYS[1], KEYS[2])
+redis.call('HSET', KEYS[2], 'complete', ARGV[7])
+for i = 8, #ARGV, 3 do
+    redis.call('ZADD', KEYS[1], ARGV[i], ARGV[i + 1])
+    redis.call('HSET', KEYS[2], ARGV[i + 1], ARGV[i + 2])
+end
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+redis.call('EXPIRE', KEYS[2], ARGV[1])
+redis.call('ZADD', KEYS[4], ARGV[4], ARGV[5])
+local excess = redis.call('ZCARD', KEYS[4]) - tonumber(ARGV[3])
+if excess > 0 then
+    local victims = redis.call('ZRANGE', KEYS[4], 0, excess - 1)
+    redis.call('ZREMRANGEBYRANK', KEYS[4], 0, excess - 1)
+    for _, victim in ipairs(victims) do
+        redis.call('DEL', 'chat:recent:' .. victim, 'chat:recent:' .. victim .. ':items')
+    end
+end
+return 1
+"""
+
+# Добавляет или заменяет сообщение в существующем буфере и обрезает его до размера кольца
+_PUSH_SCRIPT = """
+redis.call('INCR', KEYS[3])
+redis.call('EXPIRE', KEYS[3], ARGV[1])
+if redis.call('EXISTS', KEYS[2]) == 0 then
+    return 0
+end
+redis.call('ZADD', KEYS[1], ARGV[3], ARGV[4])
+redis.call('HSET', KEYS[2], ARGV[4], ARGV[5])
+local excess = redis.call('ZCARD', KEYS[1]) - tonumber(ARGV[2])
+if excess > 0 then
+    local old = redis.call('ZRANGE', KEYS[1], 0, excess - 1)
+    redis.call('ZREMRANGEBYRANK', KEYS[1], 0, excess - 1)
+    redis.call('HDEL', KEYS[2], unpack(old))
+    redis.call('HSET', KEYS[2], 'complete', '0')
+end
+return 1
+"""
+
+# Меняет поля сообщения, если оно есть в буфере
+_PATCH_SCRIPT = """
+redis.call('INCR', KEYS[3])
+redis.call('EXPIRE', KEYS[3], ARGV[1])
+local raw = redis.call('HGET', KEYS[2], ARGV[2])
+if not raw then
+    return 0
+end
+local item = cjson.decode(raw)
+for key, value in pairs(cjson.decode(ARGV[3])) do
+    item[key] = value
+end
+redis.call('HSET', KEYS[2], ARGV[2], cjson.encode(item))
+return 1
+"""
+
+
+def history_item(m: ChatMessage, reply_to: Optional[dict]) -> dict:
+    """Сообщение в виде элемента истории без полей, зависящих от читающего (is_read) и от хода загрузки."""
+    item = {
+        "id": m.id,
+        "sender_id": m.sender_id,
+        "receiver_id": m.receiver_id,
+        "message": m.message,
+        "file_path": m.file_path,
+        "message_type": m.message_type,
+        "client_id": m.client_id,
+        "duration": m.duration,
+        "timestamp": m.timestamp,
+        "reply_to_id": m.reply_to_id,
+        "reply_to": reply_to,
+        "is_uploading": bool(m.is_uploading),
+        "upload_id": m.upload_id,
+        "deleted_by_sender": bool(m.deleted_by_sender),
+        "deleted_by_receiver": bool(m.deleted_by_receiver),
+    }
+    attachments = attachment_items(m)
+    if attachments is not None:
+        item["attachments"] = attachments
+    return item
+
+
+def visible_to(item: dict, user_id: int) -> bool:
+    if item["sender_id"] == user_id:
+        return not item["deleted_by_sender"]
+    return not item["deleted_by_receiver"]
+
+
+def _dump(item: dict) -> str:
+    return json.dumps({**item, "timestamp": item["timestamp"].isoformat() if item["timestamp"] else None})
+
+
+def _load(raw: bytes) -> dict:
+    item = json.loads(raw)
+    item["timestamp"] = datetime.fromisoformat(item["timestamp"]) if item["timestamp"] else None
+    return item
+
+
+async def read(user_a: int, user_b: int, redis=None) -> Optional[Tuple[List[dict], bool]]:
+    """
+    Сообщения из буфера диалога, новые первыми, и признак того, что в буфере весь диалог.
+    None - буфера нет или Redis недоступен.
+    """
+    redis = redis or get_redis()
+    zset_key, items_key, _ = _keys(user_a, user_b)
+    try:
+        res = await redis.eval(
+            _READ_SCRIPT, 3, zset_key, items_key, LRU_KEY,
+            CHAT_HISTORY_CACHE_TTL, time.time(), dialog_id(user_a, user_b)
+        )
+    except Exception as e:
+        logger.error(f"Chat history cache: read of {dialog_id(user_a, user_b)} failed: {e}")
+        return None
+    if not res:
+        return None
+    items = [_load(raw) for raw in res[1:] if raw]
+    items.sort(key=lambda item: (item["timestamp"], item["id"]), reverse=True)
+    return items, res[0] in (b"1", "1")
+
+
+async def version(user_a: int, user_b: int, redis=None) -> Optional[str]:
+    """Версия диалога перед чтением из БД; передается в fill. None - Redis недоступен."""
+    redis = redis or get_redis()
+    try:
+        value = await redis.get(_keys(user_a, user_b)[2])
+    except Exception as e:
+        logger.error(f"Chat history cache: version of {dialog_id(user_a, user_b)} failed: {e}")
+        return None
+    return value.decode() if isinstance(value, bytes) else (value or "0")
+
+
+async def fill(user_a: int, user_b: int, items: List[dict], complete: bool, expected_version: str, redis=None) -> bool:
+    """Заполняет буфер последними сообщениями диалога из БД (не больше CHAT_HISTORY_CACHE_SIZE)."""
+    redis = redis or get_redis()
+    zset_key, items_key, version_key = _keys(user_a, user_b)
+    args = []
+    for item in items[:CHAT_HISTORY_CACHE_SIZE]:
+        args.extend((_score(item["timestamp"]), item["id"], _dump(item)))
+    try:
+        return bool(await redis.eval(
+            _FILL_SCRIPT, 4, zset_key, items_key, version_key, LRU_KEY,
+            CHAT_HISTORY_CACHE_TTL, CHAT_HISTORY_CACHE_SIZE, CHAT_HISTORY_CACHE_DIALOGS,
+            time.time(), dialog_id(user_a, user_b), expected_version,
+            "1" if complete and len(items) <= CHAT_HISTORY_CACHE_SIZE else "0", *args
+        ))
+    except Exception as e:
+        logger.error(f"Chat history cache: fill of {dialog_id(user_a, user_b)} failed: {e}")
+        return False
+
+
+async def push(item: dict, redis=None) -> None:
+    """Новое или замененное сообщение (после commit). Буфер есть только у читаемых диалогов - остальные не создаются."""
+    redis = redis or get_redis()
+    zset_key, items_key, version_key = _keys(item["sender_id"], item["receiver_id"])
+    try:
+        await redis.eval(
+            _PUSH_SCRIPT, 3, zset_key, items_key, version_key,
+            CHAT_HISTORY_CACHE_TTL, CHAT_HISTORY_CACHE_SIZE, _score(item["timestamp"]), item["id"], _dump(item)
+        )
+    except Exception as e:
+        logger.error(f"Chat history cache: push of message {item['id']} failed, dropping dialog: {e}")
+        await invalidate(item["sender_id"], item["receiver_id"], redis=redis)
+
+
+async def patch(user_a: int, user_b: int, message_id: int, fields: Dict, redis=None) -> None:
+    """Обновляет поля сообщения в буфере (после commit)."""
+    redis = redis or get_redis()
+    zset_key, items_key, version_key = _keys(user_a, user_b)
+    try:
+        await redis.eval(
+            _PATCH_SCRIPT, 3, zset_key, items_key, version_key,
+            CHAT_HISTORY_CACHE_TTL, message_id, json.dumps(fields)
+        )
+    except Exception as e:
+        logger.error(f"Chat history cache: patch of message {message_id} failed, dropping dialog: {e}")
+        await invalidate(user_a, user_b, redis=redis)
+
+
+async def invalidate(user_a: int, user_b: int, redis=None) -> None:
+    """Сбрасывает буфер диалога (удаления, правки нескольких сообщений); следующее чтение заполнит его из БД."""
+    redis = redis or get_redis()
+    zset_key, items_key, version_key = _keys(user_a, user_b)
+    try:
+        async with redis.pipeline(transaction=True) as pipe:
+            pipe.incr(version_key)
+            pipe.expire(version_key, CHAT_HISTORY_CACHE_TTL)
+            pipe.delete(zset_key, items_key)
+            await pipe.execute()
+    except Exception as e:
+        logger.error(f"Chat history cache: invalidation of {dialog_id(user_a, user_b)} failed: {e}")
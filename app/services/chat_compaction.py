@@ -0,0 +1,125 @@
+import json
+from typing import Iterable, List, Optional, Set, Tuple
+
+from loguru import logger
+from sqlalchemy import delete, or_, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import selectinload
+
+from app.models.chat import ChatAttachment, ChatMessage
+from app.services import chat_attachments
+from app.utils import aiofile
+
+# Сообщение, удаленное обоими участниками (deleted_by_sender и deleted_by_receiver), никому не показывается:
+# строка удаляется из chat_messages вместе со строками chat_attachments, ответы на него теряют reply_to_id,
+# а файлы удаляются из хранилища после фиксации транзакции. Плейсхолдеры идущих загрузок не трогаются -
+# их убирает collect_abandoned_uploads. Сообщения, уже выгруженные в архив (chat_archive), остаются в Parquet.
+#
+# URL файлов сообщения присылает клиент, поэтому удаляются только файлы категории чата (ключ S3 "chat/..."
+# или /media/chat/...), на которые больше не ссылается ни одно сообщение или вложение.
+
+MEDIA_CATEGORY = "chat"
+
+
+def file_path_urls(file_path: Optional[str], message_type: Optional[str]) -> List[str]:
+    """URL из file_path сообщения: сам путь или элементы JSON-списка media_group."""
+    if not file_path:
+        return []
+    if message_type != "media_group":
+        return [file_path]
+    try:
+        attachments = json.loads(file_path)
+    except ValueError:
+        return []
+    urls = []
+    for att in attachments if isinstance(attachments, list) else []:
+        if isinstance(att, dict):
+            urls.extend(att.get(key) for key in ("file_path", "url", "thumbnail", "thumbnail_url"))
+    return [url for url in urls if isinstance(url, str) and url]
+
+
+def media_urls(m: ChatMessage) -> List[str]:
+    """URL файлов сообщения: file_path (или JSON-список media_group) и строки chat_attachments с миниатюрами."""
+    urls = file_path_urls(m.file_path, m.message_type)
+    for att in m.attachments:
+        urls.extend((att.url, att.thumbnail))
+    return list(dict.fromkeys(url for url in urls if isinstance(url, str) and url))
+
+
+async def attachment_urls(db: AsyncSession, message_ids: Iterable[int]) -> List[str]:
+    """URL файлов и миниатюр из chat_attachments сообщений (до удаления строк)."""
+    message_ids = list(message_ids)
+    if not message_ids:
+        return []
+    res = await db.execute(
+        select(ChatAttachment.url, ChatAttachment.thumbnail).where(ChatAttachment.message_id.in_(message_ids))
+    )
+    return [url for row in res.all() for url in row if url]
+
+
+async def unreferenced(db: AsyncSession, urls: Iterable[str]) -> List[str]:
+    """URL, на которые не ссылаются ни chat_messages.file_path, ни chat_attachments (url или thumbnail)."""
+    urls = list(dict.fromkeys(urls))
+    if not urls:
+        return []
+    used = set((await db.execute(
+        select(ChatMessage.file_path).where(ChatMessage.file_path.in_(urls))
+    )).scalars().all())
+    res = await db.execute(
+        select(ChatAttachment.url, ChatAttachment.thumbnail)
+        .where(or_(ChatAttachment.url.in_(urls), ChatAttachment.thumbnail.in_(urls)))
+    )
+    used.update(url for row in res.all() for url in row)
+    return [url for url in urls if url not in used]
+
+
+async def delete_media(db: AsyncSession, urls: Iterable[str]) -> Tuple[int, int]:
+    """
+    Удаляет из хранилища файлы чата, на которые больше нет ссылок (вызывать после фиксации удаления).
+    Возвращает (число удаленных файлов, освобожденные байты).
+    """
+    files = reclaimed = 0
+    for url in await unreferenced(db, urls):
+        try:
+            size = await aiofile.delete_url(url, MEDIA_CATEGORY)
+        except Exception as e:
+            logger.error(f"Chat media: failed to delete {url}: {e}")
+            continue
+        if size:
+            files += 1
+            reclaimed += size
+    return files, reclaimed
+
+
+async def compact_batch(db: AsyncSession, limit: int) -> Tuple[int, Set[Tuple[int, int]], List[str]]:
+    """
+    Удаляет до limit сообщений, скрытых у обоих участников, и фиксирует транзакцию.
+    Возвращает (число строк, пары диалогов (min_id, max_id), URL файлов для delete_media).
+    """
+    res = await db.execute(
+        select(ChatMessage)
+        .options(selectinload(ChatMessage.attachments))
+        .where(
+            ChatMessage.deleted_by_sender == True,
+            ChatMessage.deleted_by_receiver == True,
+            ChatMessage.is_uploading.isnot(True)
+        )
+        .order_by(ChatMessage.id)
+        .limit(limit)
+    )
+    messages = res.scalars().all()
+    if not messages:
+        return 0, set(), []
+
+    ids = [m.id for m in messages]
+    pairs = {(min(m.sender_id, m.receiver_id), max(m.sender_id, m.receiver_id)) for m in messages}
+    urls = [url for m in messages for url in media_urls(m)]
+
+    await chat_attachments.delete_for_messages(db, ids)
+    await db.execute(
+        update(ChatMessage).where(ChatMessage.reply_to_id.in_(ids)).values(reply_to_id=None)
+        .execution_options(synchronize_session=False)
+    )
+    await db.execute(delete(ChatMessage).where(ChatMessage.id.in_(ids)).execution_options(synchronize_session=False))
+    await db.commit()
+    return len(ids), pairs, urls
@@ -0,0 +1,229 @@
+from collections import defaultdict
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import select, update, func, or_, and_, text
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.models.chat import ChatMessage, ChatDialog
+
+
+def message_preview(msg: ChatMessage) -> str:
+    """Текст, который показывается в списке диалогов для последнего сообщения."""
+    return msg.message if msg and msg.message else "[Файл]"
+
+
+def _insert(db: AsyncSession):
+    return pg_insert if db.bind.dialect.name == "postgresql" else sqlite_insert
+
+
+async def _upsert_dialog(db: AsyncSession, user_id: int, partner_id: int, values: dict, increment_unread: int = 0):
+    """increment_unread - на сколько увеличить счетчик непрочитанных (True - на 1)."""
+    stmt = _insert(db)(ChatDialog).values(
+        user_id=user_id,
+        partner_id=partner_id,
+        unread_count=int(increment_unread) if increment_unread else values.get("unread_count", 0),
+        **{k: v for k, v in values.items() if k != "unread_count"},
+    )
+    set_ = dict(values)
+    if increment_unread:
+        set_["unread_count"] = ChatDialog.unread_count + int(increment_unread)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[ChatDialog.user_id, ChatDialog.partner_id],
+        set_=set_,
+    )
+    await db.execute(stmt)
+
+
+async def _touch_rows(db: AsyncSession, rows: List[dict]):
+    """
+    Сводки диалогов после новых сообщений одним многострочным upsert-ом. В строке unread_count -
+    на сколько увеличить счетчик непрочитанных (для новой сводки - его начальное значение).
+    """
+    if not rows:
+        return
+    stmt = _insert(db)(ChatDialog).values(rows)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[ChatDialog.user_id, ChatDialog.partner_id],
+        set_={
+            "last_message_id": stmt.excluded.last_message_id,
+            "last_message_preview": stmt.excluded.last_message_preview,
+            "last_message_time": stmt.excluded.last_message_time,
+            "unread_count": ChatDialog.unread_count + stmt.excluded.unread_count,
+        },
+    )
+    await db.execute(stmt)
+
+
+async def touch_dialogs(db: AsyncSession, msg: ChatMessage, count_unread: bool = True):
+    """
+    Обновляет сводки диалога у обоих участников после отправки сообщения (один upsert на обе строки).
+    Сообщение должно уже иметь id (после flush). count_unread=False - для обновления
+    существующего сообщения (например, плейсхолдера), которое уже учтено в счетчике.
+    """
+    values = {
+        "last_message_id": msg.id,
+        "last_message_preview": message_preview(msg),
+        "last_message_time": msg.timestamp or datetime.utcnow(),
+    }
+    sender_id, receiver_id = int(msg.sender_id), int(msg.receiver_id)
+    rows = [{"user_id": sender_id, "partner_id": receiver_id, "unread_count": 0, **values}]
+    if receiver_id != sender_id:
+        rows.append({"user_id": receiver_id, "partner_id": sender_id, "unread_count": int(count_unread), **values})
+    await _touch_rows(db, rows)
+
+
+async def touch_dialogs_batch(db: AsyncSession, messages: List[ChatMessage]):
+    """
+    touch_dialogs для пачки новых сообщений (запись с отложенной фиксацией, chat_writer):
+    один upsert на всю пачку независимо от числа сообщений и диалогов в ней.
+    """
+    by_dialog = defaultdict(list)
+    for msg in messages:
+        by_dialog[frozenset((int(msg.sender_id), int(msg.receiver_id)))].append(msg)
+    rows = []
+    for participants, dialog_messages in by_dialog.items():
+        last = max(dialog_messages, key=lambda m: (m.timestamp, m.id))
+        values = {
+            "last_message_id": last.id,
+            "last_message_preview": message_preview(last),
+            "last_message_time": last.timestamp,
+        }
+        for user_id in participants:
+            partner_id = next(iter(participants - {user_id}), user_id)
+            received = sum(1 for m in dialog_messages if m.receiver_id == user_id and m.sender_id != user_id)
+            rows.append({"user_id": user_id, "partner_id": partner_id, "unread_count": received, **values})
+    await _touch_rows(db, rows)
+
+
+def _read_watermark(user_id: int, partner_id: int):
+    """Подзапрос: id последнего прочитанного user_id сообщения от partner_id (0, если диалог еще не читался)."""
+    return func.coalesce(
+        select(ChatDialog.last_read_message_id)
+        .where(ChatDialog.user_id == user_id, ChatDialog.partner_id == partner_id)
+        .scalar_subquery(),
+        0
+    )
+
+
+async def refresh_dialog(db: AsyncSession, user_id: int, partner_id: int):
+    """
+    Пересчитывает сводку диалога user_id -> partner_id по таблице сообщений.
+    Используется после удаления сообщений, когда последнее сообщение могло измениться.
+    """
+    last_msg_res = await db.execute(
+        select(ChatMessage).where(
+            or_(
+                and_(ChatMessage.sender_id == user_id, ChatMessage.receiver_id == partner_id, ChatMessage.deleted_by_sender == False),
+                and_(ChatMessage.sender_id == partner_id, ChatMessage.receiver_id == user_id, ChatMessage.deleted_by_receiver == False)
+            )
+        )
+        .order_by(ChatMessage.timestamp.desc()).limit(1)
+    )
+    last_msg = last_msg_res.scalar_one_or_none()
+
+    # Непрочитанные - все входящие после отметки прочтения (диапазон по id внутри индекса диалога)
+    unread_res = await db.execute(
+        select(func.count(ChatMessage.id)).where(
+            ChatMessage.sender_id == partner_id,
+            ChatMessage.receiver_id == user_id,
+            ChatMessage.id > _read_watermark(user_id, partner_id),
+            ChatMessage.deleted_by_receiver == False
+        )
+    )
+
+    await _upsert_dialog(db, user_id, partner_id, {
+        "last_message_id": last_msg.id if last_msg else None,
+        "last_message_preview": message_preview(last_msg) if last_msg else None,
+        "last_message_time": last_msg.timestamp if last_msg else None,
+        "unread_count": unread_res.scalar() or 0,
+    })
+
+
+async def refresh_dialog_pair(db: AsyncSession, user_a: int, user_b: int):
+    """Пересчитывает сводки диалога у обоих участников."""
+    await refresh_dialog(db, user_a, user_b)
+    if user_a != user_b:
+        await refresh_dialog(db, user_b, user_a)
+
+
+def _issued_id_cap(db: AsyncSession):
+    """Наибольший выданный id сообщения: на PostgreSQL - последнее значение последовательности chat_messages."""
+    if db.bind.dialect.name == "postgresql":
+        return func.coalesce(
+            func.pg_sequence_last_value(text("pg_get_serial_sequence('chat_messages', 'id')::regclass")), 0
+        )
+    return func.coalesce(select(func.max(ChatMessage.id)).scalar_subquery(), 0)
+
+
+async def mark_dialog_read(db: AsyncSession, user_id: int, partner_id: int, last_seen_id: Optional[int] = None):
+    """
+    Отмечает диалог user_id -> partner_id прочитанным одним upsert-ом:
+    сдвигает last_read_message_id до последнего входящего сообщения и обнуляет счетчик.
+    Сами строки chat_messages не обновляются.
+    last_seen_id - последнее сообщение, которое видел клиент. При записи с отложенной фиксацией (chat_writer)
+    доставленные сообщения могут еще не быть в БД: отметка сдвигается и до last_seen_id, но не дальше
+    уже выданных id. Отметка не уменьшается.
+    """
+    greatest = func.greatest if db.bind.dialect.name == "postgresql" else func.max
+    least = func.least if db.bind.dialect.name == "postgresql" else func.min
+    last_incoming = (
+        select(func.max(ChatMessage.id))
+        .where(ChatMessage.sender_id == partner_id, ChatMessage.receiver_id == user_id)
+        .scalar_subquery()
+    )
+    watermark = func.coalesce(last_incoming, 0)
+    if last_seen_id:
+        watermark = greatest(watermark, least(int(last_seen_id), _issued_id_cap(db)))
+    stmt = _insert(db)(ChatDialog).values(
+        user_id=user_id,
+        partner_id=partner_id,
+        unread_count=0,
+        last_read_message_id=watermark,
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[ChatDialog.user_id, ChatDialog.partner_id],
+        set_={
+            "unread_count": 0,
+            "last_read_message_id": greatest(func.coalesce(ChatDialog.last_read_message_id, 0), watermark),
+        },
+    )
+    await db.execute(stmt)
+
+
+async def get_read_marks(db: AsyncSession, pairs: Iterable[Tuple[int, int]]) -> Dict[Tuple[int, int], int]:
+    """Отметки прочтения для пар (получатель, отправитель): {(user_id, partner_id): last_read_message_id}."""
+    pairs = set(pairs)
+    if not pairs:
+        return {}
+    res = await db.execute(
+        select(ChatDialog.user_id, ChatDialog.partner_id, ChatDialog.last_read_message_id).where(
+            or_(*(and_(ChatDialog.user_id == user_id, ChatDialog.partner_id == partner_id) for user_id, partner_id in pairs))
+        )
+    )
+    return {(row.user_id, row.partner_id): row.last_read_message_id or 0 for row in res}
+
+
+async def get_read_watermarks(db: AsyncSession, user_id: int, partner_id: int) -> tuple[int, int]:
+    """
+    Возвращает (прочитано user_id, прочитано partner_id) - отметки прочтения обеих сторон диалога.
+    Сообщение считается прочитанным, если его id не больше отметки получателя.
+    """
+    res = await db.execute(
+        select(ChatDialog.user_id, ChatDialog.last_read_message_id).where(
+            or_(
+                and_(ChatDialog.user_id == user_id, ChatDialog.partner_id == partner_id),
+                and_(ChatDialog.user_id == partner_id, ChatDialog.partner_id == user_id)
+            )
+        )
+    )
+    marks = {row.user_id: row.last_read_message_id or 0 for row in res}
+    return marks.get(user_id, 0), marks.get(partner_id, 0)
+
+
+def is_read_by_receiver(msg_id: int, receiver_id: int, user_id: int, read_by_user: int, read_by_partner: int) -> int:
+    """Вычисляет флаг is_read для ответа API по отметкам прочтения (1 - прочитано получателем)."""
+    watermark = read_by_user if receiver_id == user_id else read_by_partner
+    return 1 if msg_id <= watermark else 0
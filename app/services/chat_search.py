@@ -0,0 +1,135 @@
+import re
+from typing import List, Optional, Tuple
+
+from sqlalchemy import select, or_, and_, func, literal_column, text, table, column
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.models.chat import ChatMessage
+
+# Маркеры подсветки совпадений в snippet
+HIGHLIGHT_START = "<b>"
+HIGHLIGHT_END = "</b>"
+SNIPPET_WORDS = 12
+
+# Индексы (см. миграции add_chat_messages_search и add_file_names_to_chat_search):
+#   PostgreSQL - GIN по to_tsvector('simple', текст сообщения и имена файлов из file_path)
+#   SQLite     - FTS5-таблица chat_messages_fts (message, file_path), синхронизируется триггерами
+# Имена файлов ищутся по словам: каталоги и адрес хранилища отбрасываются, знаки препинания - разделители.
+# У media_group file_path - JSON-список вложений, так что в поиск попадают имена всех файлов группы.
+# Выражение должно совпадать с выражением индекса буквально (без bind-параметров), иначе планировщик его не использует
+PG_FILE_NAMES = func.regexp_replace(
+    func.regexp_replace(
+        func.coalesce(ChatMessage.file_path, literal_column("''")),
+        literal_column("'[^ \"]*/'"), literal_column("''"), literal_column("'g'")
+    ),
+    literal_column("'[^[:alnum:]]+'"), literal_column("' '"), literal_column("'g'")
+)
+PG_TSVECTOR = func.to_tsvector(
+    literal_column("'simple'"),
+    func.coalesce(ChatMessage.message, literal_column("''")).op("||")(literal_column("' '")).op("||")(PG_FILE_NAMES)
+)
+FTS_TABLE = table("chat_messages_fts", column("rowid"))
+FTS_REF = literal_column("chat_messages_fts")
+
+
+def _terms(query: str) -> List[str]:
+    """Разбивает запрос на слова; спецсимволы синтаксиса tsquery/FTS5 отбрасываются."""
+    return re.findall(r"\w+", query.lower())
+
+
+def _dialog_filter(user_id: int, other_user_id: int):
+    return or_(
+        and_(ChatMessage.sender_id == user_id, ChatMessage.receiver_id == other_user_id, ChatMessage.deleted_by_sender == False),
+        and_(ChatMessage.sender_id == other_user_id, ChatMessage.receiver_id == user_id, ChatMessage.deleted_by_receiver == False)
+    )
+
+
+def _postgres_stmt(terms: List[str]):
+    # Префиксный поиск по каждому слову: поиск работает по мере набора
+    ts_query = func.to_tsquery(literal_column("'simple'"), " & ".join(f"{t}:*" for t in terms))
+    rank = func.ts_rank_cd(PG_TSVECTOR, ts_query)
+    snippet = func.ts_headline(
+        literal_column("'simple'"),
+        func.coalesce(ChatMessage.message, literal_column("''")),
+        ts_query,
+        f"StartSel={HIGHLIGHT_START}, StopSel={HIGHLIGHT_END}, MaxWords={SNIPPET_WORDS}, MinWords=3"
+    )
+    return (
+        select(ChatMessage, rank.label("rank"), snippet.label("snippet"))
+        .where(PG_TSVECTOR.op("@@")(ts_query))
+        .order_by(rank.desc(), ChatMessage.timestamp.desc())
+    )
+
+
+def _sqlite_stmt(terms: List[str]):
+    match = " ".join(f'"{t}"*' for t in terms)
+    # bm25 возвращает отрицательные значения: чем меньше, тем релевантнее
+    rank = func.bm25(FTS_REF)
+    snippet = func.snippet(FTS_REF, 0, HIGHLIGHT_START, HIGHLIGHT_END, "…", SNIPPET_WORDS)
+    return (
+        select(ChatMessage, (-rank).label("rank"), snippet.label("snippet"))
+        .select_from(FTS_TABLE)
+        .join(ChatMessage, ChatMessage.id == FTS_TABLE.c.rowid)
+        .where(text("chat_messages_fts MATCH :fts_query").bindparams(fts_query=match))
+        .order_by(rank, ChatMessage.timestamp.desc())
+    )
+
+
+def _fallback_stmt(terms: List[str]):
+    conditions = [
+        or_(func.lower(ChatMessage.message).contains(t), func.lower(ChatMessage.file_path).contains(t))
+        for t in terms
+    ]
+    return (
+        select(ChatMessage, literal_column("0").label("rank"), ChatMessage.message.label("snippet"))
+        .where(and_(*conditions))
+        .order_by(ChatMessage.timestamp.desc())
+    )
+
+
+async def search_messages(
+    db: AsyncSession,
+    user_id: int,
+    other_user_id: int,
+    query: str,
+    limit: int = 20,
+    offset: int = 0
+) -> Tuple[List[dict], Optional[int]]:
+    """
+    Полнотекстовый поиск по диалогу user_id <-> other_user_id.
+    Возвращает (результаты по убыванию релевантности, next_offset или None, если это последняя страница).
+    """
+    terms = _terms(query)
+    if not terms:
+        return [], None
+
+    dialect = db.bind.dialect.name
+    if dialect == "postgresql":
+        stmt = _postgres_stmt(terms)
+    elif dialect == "sqlite":
+        stmt = _sqlite_stmt(terms)
+    else:
+        stmt = _fallback_stmt(terms)
+
+    # Берем на одну строку больше, чтобы понять, есть ли следующая страница
+    result = await db.execute(
+        stmt.where(_dialog_filter(user_id, other_user_id)).offset(offset).limit(limit + 1)
+    )
+    rows = result.all()
+    next_offset = offset + limit if len(rows) > limit else None
+
+    items = []
+    for row in rows[:limit]:
+        m = row.ChatMessage
+        items.append({
+            "id": m.id,
+            "timestamp": m.timestamp,
+            "message": m.message,
+            "file_path": m.file_path,
+            "sender_id": m.sender_id,
+            "receiver_id": m.receiver_id,
+            "message_type": m.message_type,
+            "snippet": row.snippet,
+            "rank": float(row.rank or 0),
+        })
+    return items, next_offset
@@ -0,0 +1,255 @@
+import asyncio
+import json
+from datetime import datetime
+from typing import Iterable, List, Optional, Set, Tuple
+
+from loguru import logger
+from sqlalchemy import text
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.core.config import CHAT_WRITE_BATCH_SIZE, CHAT_WRITE_BEHIND, CHAT_WRITE_FLUSH_MS
+from app.core.metrics import CHAT_WRITE_BATCH_ROWS, CHAT_WRITE_PENDING
+from app.core.redis import get_redis
+from app.database import async_session_maker
+from app.models.chat import ChatAttachment, ChatMessage
+from app.services import chat_attachments, chat_cache
+from app.services.chat_dialogs import touch_dialogs_batch
+
+# Запись сообщений с отложенной фиксацией (CHAT_WRITE_BEHIND, только PostgreSQL).
+# Сообщение получает id из последовательности chat_messages (nextval на каждое сообщение),
+# записывается в Redis Stream chat:pending и сразу рассылается. Процесс копит сообщения и пишет их
+# в БД одним многострочным INSERT каждые CHAT_WRITE_BATCH_SIZE сообщений или CHAT_WRITE_FLUSH_MS мс,
+# после чего удаляет записи из потока. Если процесс упал, не успев записать пачку, записи остаются
+# в потоке, и их сохраняет задача recover_pending_messages. Повторная вставка безопасна (ON CONFLICT DO NOTHING).
+
+PENDING_STREAM = "chat:pending"
+# Сообщения, которые не удалось записать даже по одному (например, отправитель удален): для разбора вручную
+DEAD_STREAM = "chat:pending:dead"
+# После стольких неудачных попыток записать пачку целиком она пишется по одному сообщению
+FLUSH_RETRIES = 3
+# Сколько секунд повтор client_id распознается по Redis (пока сообщения нет в БД, его не видит SELECT дедупликации)
+CLIENT_ID_TTL = 300
+
+_COLUMNS = (
+    "id", "sender_id", "receiver_id", "message", "file_path", "message_type", "client_id", "duration",
+    "timestamp", "is_read", "reply_to_id", "deleted_by_sender", "deleted_by_receiver", "is_uploading", "upload_id",
+)
+_ATTACHMENT_COLUMNS = ("position", "url", "type", "size", "width", "height", "duration", "thumbnail")
+
+# Атомарно: повтор client_id возвращает уже принятое сообщение, иначе - запись в поток
+_SUBMIT_SCRIPT = """
+if ARGV[1] == '1' then
+    local existing = redis.call('GET', KEYS[2])
+    if existing then
+        return {0, existing}
+    end
+    redis.call('SET', KEYS[2], ARGV[2], 'EX', ARGV[3])
+end
+return {1, redis.call('XADD', KEYS[1], '*', 'm', ARGV[2])}
+"""
+
+# (id записи в потоке, сообщение, элемент буфера истории или None - буфер диалога сбрасывается)
+_buffer: List[Tuple[str, ChatMessage, Optional[dict]]] = []
+_wakeup: Optional[asyncio.Event] = None
+_task: Optional[asyncio.Task] = None
+_warned = False
+
+
+def enabled(db: AsyncSession) -> bool:
+    global _warned
+    if not CHAT_WRITE_BEHIND:
+        return False
+    if db.bind.dialect.name != "postgresql":
+        if not _warned:
+            logger.warning("Chat writer: CHAT_WRITE_BEHIND requires PostgreSQL sequences, writing messages synchronously")
+            _warned = True
+        return False
+    return True
+
+
+def _client_key(sender_id: int, client_id: Optional[str]) -> str:
+    return f"chat:pending:client:{sender_id}:{client_id or ''}"
+
+
+def _insert(db: AsyncSession):
+    return pg_insert if db.bind.dialect.name == "postgresql" else sqlite_insert
+
+
+def _conflict_target(db: AsyncSession) -> list:
+    # В PostgreSQL chat_messages секционирована по timestamp: уникален только ключ (id, timestamp)
+    if db.bind.dialect.name == "postgresql":
+        return [ChatMessage.id, ChatMessage.timestamp]
+    return [ChatMessage.id]
+
+
+def dump_message(msg: ChatMessage) -> str:
+    return json.dumps({
+        **{name: getattr(msg, name) for name in _COLUMNS},
+        "timestamp": msg.timestamp.isoformat(),
+        "attachments": [
+            {name: getattr(a, name) for name in _ATTACHMENT_COLUMNS} for a in msg.attachments
+        ]
+    })
+
+
+def load_message(raw) -> ChatMessage:
+    data = json.loads(raw)
+    data["timestamp"] = datetime.fromisoformat(data["timestamp"])
+    data["attachments"] = [ChatAttachment(**row) for row in data.get("attachments", [])]
+    return ChatMessage(**data)
+
+
+async def _next_id(db: AsyncSession) -> int:
+    """
+    id из последовательности chat_messages: общая с обычными INSERT, поэтому id не пересекаются.
+    Берется по одному на сообщение - прочитанность хранится отметкой по id, и id должны расти в порядке отправки.
+    """
+    res = await db.execute(text("SELECT nextval(pg_get_serial_sequence('chat_messages', 'id'))"))
+    return res.scalar_one()
+
+
+async def submit(
+    db: AsyncSession,
+    sender_id: int,
+    receiver_id: int,
+    content: Optional[str],
+    file_path: Optional[str],
+    message_type: str,
+    client_id: Optional[str],
+    duration: Optional[float],
+    reply_to_id: Optional[int],
+    attachments: Optional[list] = None,
+    cached_item=None
+) -> Optional[Tuple[ChatMessage, bool]]:
+    """
+    Принимает сообщение к отложенной записи. Возвращает (сообщение, created): created=False -
+    повтор client_id, сообщение которого еще не записано в БД. None - Redis недоступен (пишите обычным путем).
+    cached_item(msg) строит элемент буфера истории для повторной записи в него после фиксации.
+    """
+    msg = ChatMessage(
+        id=await _next_id(db),
+        sender_id=sender_id,
+        receiver_id=receiver_id,
+        message=content,
+        file_path=file_path,
+        message_type=message_type,
+        client_id=client_id,
+        duration=duration,
+        timestamp=datetime.utcnow(),
+        is_read=0,
+        reply_to_id=reply_to_id,
+        deleted_by_sender=False,
+        deleted_by_receiver=False,
+        is_uploading=False,
+        upload_id=None,
+        attachments=chat_attachments.build(attachments)
+    )
+    raw = dump_message(msg)
+    try:
+        created, value = await get_redis().eval(
+            _SUBMIT_SCRIPT, 2, PENDING_STREAM, _client_key(sender_id, client_id),
+            "1" if client_id else "0", raw, CLIENT_ID_TTL
+        )
+    except Exception as e:
+        logger.error(f"Chat writer: failed to queue message {msg.id}, writing synchronously: {e}")
+        return None
+    if not created:
+        return load_message(value), False
+
+    _enqueue(value.decode() if isinstance(value, bytes) else value, msg, cached_item(msg) if cached_item else None)
+    return msg, True
+
+
+def _enqueue(entry_id: str, msg: ChatMessage, item: Optional[dict]) -> None:
+    global _wakeup, _task
+    if _wakeup is None:
+        _wakeup = asyncio.Event()
+    _buffer.append((entry_id, msg, item))
+    CHAT_WRITE_PENDING.set(len(_buffer))
+    if len(_buffer) >= CHAT_WRITE_BATCH_SIZE:
+        _wakeup.set()
+    if _task is None or _task.done():
+        _task = asyncio.get_running_loop().create_task(_run())
+
+
+async def _run() -> None:
+    failures = 0
+    while _buffer:
+        if len(_buffer) < CHAT_WRITE_BATCH_SIZE:
+            try:
+                await asyncio.wait_for(_wakeup.wait(), CHAT_WRITE_FLUSH_MS / 1000)
+            except asyncio.TimeoutError:
+                pass
+        _wakeup.clear()
+        batch = _buffer[:CHAT_WRITE_BATCH_SIZE]
+        del _buffer[:len(batch)]
+        try:
+            await _flush(batch)
+            failures = 0
+        except Exception as e:
+            failures += 1
+            if failures < FLUSH_RETRIES:
+                # Записи остаются в chat:pending; пачка возвращается в начало очереди и повторяется
+                logger.error(f"Chat writer: flush of {len(batch)} messages failed, retrying: {e}")
+                _buffer[:0] = batch
+                await asyncio.sleep(1)
+            else:
+                # Одна плохая строка не должна держать очередь: пишем по одному, остальное - задаче восстановления
+                logger.error(f"Chat writer: flush of {len(batch)} messages failed {failures} times, writing one by one: {e}")
+                failures = 0
+                await _flush_rows(batch)
+        CHAT_WRITE_PENDING.set(len(_buffer))
+
+
+async def _flush_rows(batch: List[Tuple[str, ChatMessage, Optional[dict]]]) -> None:
+    for entry in batch:
+        try:
+            await _flush([entry])
+        except Exception as e:
+            logger.error(f"Chat writer: message {entry[1].id} left in {PENDING_STREAM} for recovery: {e}")
+
+
+async def insert_messages(db: AsyncSession, messages: Iterable[ChatMessage]) -> Set[int]:
+    """Многострочный INSERT (с вложениями); уже записанные сообщения пропускаются. Возвращает id вставленных."""
+    messages = list(messages)
+    rows = [{name: getattr(msg, name) for name in _COLUMNS} for msg in messages]
+    if not rows:
+        return set()
+    res = await db.execute(
+        _insert(db)(ChatMessage).values(rows)
+        .on_conflict_do_nothing(index_elements=_conflict_target(db))
+        .returning(ChatMessage.id)
+    )
+    inserted = set(res.scalars().all())
+    attachment_rows = [
+        {"message_id": msg.id, **{name: getattr(a, name) for name in _ATTACHMENT_COLUMNS}}
+        for msg in messages if msg.id in inserted
+        for a in msg.attachments
+    ]
+    if attachment_rows:
+        await db.execute(_insert(db)(ChatAttachment).values(attachment_rows))
+    return inserted
+
+
+async def _flush(batch: List[Tuple[str, ChatMessage, Optional[dict]]]) -> None:
+    messages = [msg for _, msg, _ in batch]
+    async with async_session_maker() as db:
+        inserted = await insert_messages(db, messages)
+        await touch_dialogs_batch(db, [msg for msg in messages if msg.id in inserted])
+        await db.commit()
+    CHAT_WRITE_BATCH_ROWS.observe(len(batch))
+
+    redis = get_redis()
+    try:
+        await redis.xdel(PENDING_STREAM, *[entry_id for entry_id, _, _ in batch])
+    except Exception as e:
+        # Задача восстановления найдет эти записи уже в БД и просто удалит их из потока
+        logger.error(f"Chat writer: failed to trim {PENDING_STREAM}: {e}")
+    # Буфер истории мог заполниться из БД до фиксации пачки - сообщение возвращается в него (версия диалога растет)
+    for _, msg, item in batch:
+        if item is not None:
+            await chat_cache.push(item, redis=redis)
+        else:
+            await chat_cache.invalidate(msg.sender_id, msg.receiver_id, redis=redis)
@@ -0,0 +1,196 @@
+import asyncio
+import time
+from datetime import datetime
+from typing import Awaitable, Callable, Dict, Iterable, Optional, Set, Tuple
+
+from loguru import logger
+from sqlalchemy import select, union, update
+
+from app.core.config import PRESENCE_TTL, PRESENCE_OFFLINE_GRACE
+from app.core.redis import get_redis
+from app.models.chat import ChatDialog
+from app.models.users import User as UserModel, Friendship
+
+# Присутствие хранится в Redis:
+#   presence:conn:{user_id} - zset id соединения -> время истечения heartbeat (unix time)
+#   presence:status         - hash user_id -> последний разосланный статус (online/offline)
+#   presence:last_seen      - hash user_id -> время ухода в офлайн (ISO)
+#   presence:dirty          - set пользователей, чей статус еще не записан в users (пишет задача flush_presence)
+
+STATUS_KEY = "presence:status"
+LAST_SEEN_KEY = "presence:last_seen"
+DIRTY_KEY = "presence:dirty"
+
+
+def conn_key(user_id: int) -> str:
+    return f"presence:conn:{user_id}"
+
+
+# Меняет статус только если он отличается от последнего разосланного; 1 - статус изменился
+_SET_STATUS_SCRIPT = """
+if redis.call('HGET', KEYS[1], ARGV[1]) == ARGV[2] then
+    return 0
+end
+redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+if ARGV[3] ~= '' then
+    redis.call('HSET', KEYS[2], ARGV[1], ARGV[3])
+end
+redis.call('SADD', KEYS[3], ARGV[1])
+return 1
+"""
+
+# publisher(event, recipients) - рассылка user_status; задается роутером уведомлений
+Publisher = Callable[[dict, Set[int]], Awaitable[None]]
+_publisher: Optional[Publisher] = None
+# Ссылки на отложенные проверки offline, чтобы задачи не собрал сборщик мусора
+_grace_tasks: Set[asyncio.Task] = set()
+
+
+def set_publisher(publisher: Publisher) -> None:
+    global _publisher
+    _publisher = publisher
+
+
+def status_event(user_id: int, status: str, last_seen: Optional[str]) -> dict:
+    return {
+        "type": "user_status",
+        "data": {
+            "user_id": user_id,
+            "status": status,
+            "last_seen": last_seen
+        }
+    }
+
+
+async def get_audience(db, user_id: int) -> Set[int]:
+    """Кому интересен статус пользователя: друзья, собеседники по диалогам и он сам (другие его устройства)."""
+    friends_out = select(Friendship.friend_id).where(Friendship.user_id == user_id, Friendship.status == "accepted")
+    friends_in = select(Friendship.user_id).where(Friendship.friend_id == user_id, Friendship.status == "accepted")
+    partners = select(ChatDialog.partner_id).where(ChatDialog.user_id == user_id)
+    result = await db.execute(union(friends_out, friends_in, partners))
+    audience = {row[0] for row in result}
+    audience.add(user_id)
+    return audience
+
+
+async def set_status(user_id: int, status: str, last_seen: Optional[str] = None, redis=None) -> bool:
+    redis = redis or get_redis()
+    changed = await redis.eval(
+        _SET_STATUS_SCRIPT, 3, STATUS_KEY, LAST_SEEN_KEY, DIRTY_KEY, user_id, status, last_seen or ""
+    )
+    return bool(changed)
+
+
+async def live_connections(user_id: int, redis=None) -> int:
+    redis = redis or get_redis()
+    return await redis.zcount(conn_key(user_id), time.time(), "+inf")
+
+
+async def _publish(user_id: int, status: str, last_seen: Optional[str]) -> None:
+    if _publisher is None:
+        return
+    from app.database import async_session_maker
+    async with async_session_maker() as db:
+        audience = await get_audience(db, user_id)
+    await _publisher(status_event(user_id, status, last_seen), audience)
+
+
+async def _write_status_db(user_id: int, status: str, last_seen: Optional[str]) -> None:
+    """Запасной путь, когда Redis недоступен: пишем статус в БД сразу."""
+    from app.database import async_session_maker
+    values = {"status": status}
+    if last_seen:
+        values["last_seen"] = last_seen
+    async with async_session_maker() as db:
+        await db.execute(update(UserModel).where(UserModel.id == user_id).values(**values))
+        await db.commit()
+
+
+async def connected(user_id: int, conn_id: str) -> None:
+    """Новое соединение пользователя. Рассылает online, только если пользователь был офлайн."""
+    now = time.time()
+    try:
+        redis = get_redis()
+        async with redis.pipeline(transaction=True) as pipe:
+            pipe.zremrangebyscore(conn_key(user_id), "-inf", now)
+            pipe.zadd(conn_key(user_id), {conn_id: now + PRESENCE_TTL})
+            pipe.expire(conn_key(user_id), PRESENCE_TTL * 2)
+            await pipe.execute()
+        changed = await set_status(user_id, "online", redis=redis)
+        last_seen = (await redis.hget(LAST_SEEN_KEY, user_id) or b"").decode() or None
+    except Exception as e:
+        logger.error(f"Presence: connect for user {user_id} failed: {e}")
+        await _write_status_db(user_id, "online", None)
+        changed, last_seen = True, None
+    if changed:
+        await _publish(user_id, "online", last_seen)
+
+
+async def heartbeat(user_id: int, conn_id: str) -> None:
+    """
+    Продлевает соединение (вызывается на каждый ping клиента).
+    Если задача flush_presence успела признать соединение мертвым, возвращает пользователя в online.
+    """
+    try:
+        redis = get_redis()
+        async with redis.pipeline(transaction=False) as pipe:
+            pipe.zadd(conn_key(user_id), {conn_id: time.time() + PRESENCE_TTL})
+            pipe.expire(conn_key(user_id), PRESENCE_TTL * 2)
+            await pipe.execute()
+        changed = await set_status(user_id, "online", redis=redis)
+    except Exception as e:
+        logger.error(f"Presence: heartbeat for user {user_id} failed: {e}")
+        return
+    if changed:
+        await _publish(user_id, "online", None)
+
+
+async def disconnected(user_id: int, conn_id: str) -> None:
+    """
+    Соединение закрыто. Офлайн рассылается не сразу, а через PRESENCE_OFFLINE_GRACE секунд
+    и только если за это время пользователь не переподключился (переподключения не порождают событий).
+    """
+    try:
+        await get_redis().zrem(conn_key(user_id), conn_id)
+    except Exception as e:
+        logger.error(f"Presence: disconnect for user {user_id} failed: {e}")
+    task = asyncio.create_task(_offline_after_grace(user_id))
+    _grace_tasks.add(task)
+    task.add_done_callback(_grace_tasks.discard)
+
+
+async def _offline_after_grace(user_id: int) -> None:
+    await asyncio.sleep(PRESENCE_OFFLINE_GRACE)
+    last_seen = datetime.utcnow().isoformat()
+    try:
+        redis = get_redis()
+        if await live_connections(user_id, redis=redis) > 0:
+            return
+        changed = await set_status(user_id, "offline", last_seen, redis=redis)
+    except Exception as e:
+        logger.error(f"Presence: offline check for user {user_id} failed: {e}")
+        await _write_status_db(user_id, "offline", last_seen)
+        changed = True
+    if changed:
+        await _publish(user_id, "offline", last_seen)
+
+
+async def get_statuses(user_ids: Iterable[int], redis=None) -> Dict[int, Tuple[Optional[str], Optional[str]]]:
+    """Актуальные (status, last_seen) из Redis; пользователи без данных в Redis не возвращаются."""
+    user_ids = list(user_ids)
+    if not user_ids:
+        return {}
+    redis = redis or get_redis()
+    try:
+        async with redis.pipeline(transaction=False) as pipe:
+            pipe.hmget(STATUS_KEY, user_ids)
+            pipe.hmget(LAST_SEEN_KEY, user_ids)
+            statuses, last_seens = await pipe.execute()
+    except Exception as e:
+        logger.error(f"Presence: status lookup failed: {e}")
+        return {}
+    result = {}
+    for uid, status, last_seen in zip(user_ids, statuses, last_seens):
+        if status is not None:
+            result[uid] = (status.decode(), last_seen.decode() if last_seen else None)
+    return result
@@ -0,0 +1,127 @@
+from typing import Awaitable, Callable, Dict, Optional
+
+from loguru import logger
+from redis.exceptions import WatchError
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.core.redis import get_redis
+from app.models.chat import ChatDialog
+
+# Счетчики непрочитанных в Redis (зеркало chat_dialogs.unread_count):
+#   unread:{user_id}        - hash partner_id -> количество непрочитанных от partner_id
+#   unread_total:{user_id}  - общее количество непрочитанных (бейдж приложения)
+# Источник истины - БД; расхождения исправляет задача reconcile_unread_counters.
+
+
+def unread_key(user_id: int) -> str:
+    return f"unread:{user_id}"
+
+
+def total_key(user_id: int) -> str:
+    return f"unread_total:{user_id}"
+
+
+# Атомарно обнуляет счетчик диалога и вычитает его из общего
+_RESET_SCRIPT = """
+local n = tonumber(redis.call('HGET', KEYS[1], ARGV[1]) or '0')
+redis.call('HDEL', KEYS[1], ARGV[1])
+local total = redis.call('DECRBY', KEYS[2], n)
+if total < 0 then
+    redis.call('SET', KEYS[2], 0)
+    total = 0
+end
+return total
+"""
+
+
+async def increment_unread(user_id: int, partner_id: int, redis=None) -> Optional[dict]:
+    """
+    Увеличивает счетчик непрочитанных user_id от partner_id.
+    Возвращает бейдж {"total", "from_user_id", "count"} или None, если Redis недоступен.
+    """
+    redis = redis or get_redis()
+    try:
+        async with redis.pipeline(transaction=True) as pipe:
+            pipe.hincrby(unread_key(user_id), partner_id, 1)
+            pipe.incr(total_key(user_id))
+            count, total = await pipe.execute()
+        return {"total": int(total), "from_user_id": partner_id, "count": int(count)}
+    except Exception as e:
+        logger.error(f"Unread counters: increment for user {user_id} failed: {e}")
+        return None
+
+
+async def reset_unread(user_id: int, partner_id: int, redis=None) -> Optional[dict]:
+    """Обнуляет счетчик диалога user_id -> partner_id. Возвращает бейдж или None, если Redis недоступен."""
+    redis = redis or get_redis()
+    try:
+        total = await redis.eval(_RESET_SCRIPT, 2, unread_key(user_id), total_key(user_id), partner_id)
+        return {"total": int(total), "from_user_id": partner_id, "count": 0}
+    except Exception as e:
+        logger.error(f"Unread counters: reset for user {user_id} failed: {e}")
+        return None
+
+
+async def get_unread_counts(user_id: int, db: Optional[AsyncSession] = None, redis=None) -> Dict:
+    """
+    Возвращает {"total": N, "dialogs": {partner_id: count}} из Redis.
+    Если Redis недоступен и передана сессия БД - считает по chat_dialogs.
+    """
+    redis = redis or get_redis()
+    try:
+        async with redis.pipeline(transaction=False) as pipe:
+            pipe.hgetall(unread_key(user_id))
+            pipe.get(total_key(user_id))
+            per_dialog, total = await pipe.execute()
+        dialogs = {int(k): int(v) for k, v in per_dialog.items() if int(v) > 0}
+        return {"total": int(total or 0), "dialogs": dialogs}
+    except Exception as e:
+        logger.error(f"Unread counters: read for user {user_id} failed: {e}")
+        if db is None:
+            return {"total": 0, "dialogs": {}}
+
+    res = await db.execute(
+        select(ChatDialog.partner_id, ChatDialog.unread_count)
+        .where(ChatDialog.user_id == user_id, ChatDialog.unread_count > 0)
+    )
+    dialogs = {row.partner_id: row.unread_count for row in res}
+    return {"total": sum(dialogs.values()), "dialogs": dialogs}
+
+
+async def store_unread_counts(
+    user_id: int,
+    load_dialogs: Callable[[], Awaitable[Dict[int, int]]],
+    redis=None,
+    attempts: int = 3
+) -> bool:
+    """
+    Сверяет счетчики пользователя с БД и перезаписывает их при расхождении (используется reconcile_unread_counters).
+    Ключи наблюдаются (WATCH) до пересчета load_dialogs() по БД, поэтому инкремент или сброс между чтением
+    и записью отменяет транзакцию, и сверка повторяется - такие изменения не теряются.
+    Возвращает True, если счетчики были исправлены.
+    """
+    redis = redis or get_redis()
+    keys = (unread_key(user_id), total_key(user_id))
+    for _ in range(attempts):
+        async with redis.pipeline(transaction=True) as pipe:
+            try:
+                await pipe.watch(*keys)
+                per_dialog = await pipe.hgetall(keys[0])
+                total = await pipe.get(keys[1])
+                # Счетчики в Redis увеличиваются после фиксации сообщения, поэтому все, что уже есть в Redis, видно в БД
+                dialogs = await load_dialogs()
+                current = {int(k): int(v) for k, v in per_dialog.items() if int(v) > 0}
+                if current == dialogs and int(total or 0) == sum(dialogs.values()):
+                    return False
+                pipe.multi()
+                pipe.delete(keys[0])
+                if dialogs:
+                    pipe.hset(keys[0], mapping=dialogs)
+                pipe.set(keys[1], sum(dialogs.values()))
+                await pipe.execute()
+                return True
+            except WatchError:
+                continue
+    logger.warning(f"Unread counters: user {user_id} kept changing during reconcile, left for the next run")
+    return False
@@ -0,0 +1,568 @@
+import json
+import os
+import uuid
+from dataclasses import dataclass
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from anyio import to_thread
+from loguru import logger
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.core.config import UPLOAD_MAX_SIZE, UPLOAD_STATE_TTL
+from app.core.redis import get_redis
+from app.models.chat import ChatMessage, FileUploadSession
+from app.models.users import User as UserModel
+from app.utils import aiofile, storage, storage_s3
+
+
+@dataclass
+class UploadTarget:
+    """Placeholder-сообщение загрузки: кому и в какое сообщение слать upload_progress."""
+    message_id: int
+    sender_id: int
+    receiver_id: int
+
+
+# upload_id -> placeholder. Состояние процесса: заполняется при создании placeholder,
+# на других воркерах подтягивается из БД при первом чанке и дальше берется из памяти
+_targets: Dict[str, UploadTarget] = {}
+
+
+def remember_upload(upload_id: str, message: ChatMessage) -> None:
+    _targets[upload_id] = UploadTarget(message.id, message.sender_id, message.receiver_id)
+
+
+def forget_upload(upload_id: str) -> None:
+    _targets.pop(upload_id, None)
+
+
+async def get_upload_target(db: AsyncSession, upload_id: str, user_id: int) -> Optional[UploadTarget]:
+    target = _targets.get(upload_id)
+    if target is not None:
+        return target if target.sender_id == user_id else None
+
+    res = await db.execute(
+        select(ChatMessage.id, ChatMessage.sender_id, ChatMessage.receiver_id).where(
+            ChatMessage.upload_id == upload_id,
+            ChatMessage.sender_id == user_id
+        )
+    )
+    row = res.first()
+    if row is None:
+        # Placeholder может появиться позже (upload_started по WS) - отрицательный результат не кешируем
+        return None
+    target = UploadTarget(row.id, row.sender_id, row.receiver_id)
+    _targets[upload_id] = target
+    try:
+        await get_redis().eval(
+            _SET_IF_EXISTS_SCRIPT, 1, state_key(upload_id),
+            "message_id", target.message_id, "receiver_id", target.receiver_id
+        )
+    except Exception as e:
+        logger.error(f"Upload {upload_id}: failed to cache placeholder in Redis: {e}")
+    return target
+
+
+def resolve_upload_type(filename: str, mime_type: Optional[str]) -> Tuple[str, str]:
+    """Тип сообщения и Content-Type итогового файла по расширению загруженного файла."""
+    extension = os.path.splitext(filename)[1].lower()
+    content_type = mime_type or "application/octet-stream"
+    if extension == ".pdf":
+        content_type = "application/pdf"
+
+    message_type = "file"
+    if extension in [".jpg", ".jpeg", ".png", ".gif", ".webp"]:
+        message_type = "image"
+    elif extension in [".mp4", ".webm", ".ogg"]:
+        message_type = "video"
+    elif extension in [".m4a", ".mp3", ".wav", ".aac", ".amr", ".3gp"]:
+        message_type = "voice"
+    return message_type, content_type
+
+
+# Общий сервис возобновляемых загрузок: legacy-чанки (/chat/upload/*, /admin/upload-app/*) и tus (/uploads/files).
+# Байты копятся во временном файле media/temp и пишутся по смещению, так что повтор чанка его перезаписывает.
+# Назначение файла (kind) определяет каталог хранилища и действия после загрузки (см. register_kind).
+
+TEMP_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "media", "temp")
+
+
+@dataclass
+class UploadKind:
+    category: str
+    # Что сделать с готовым файлом; хук сам фиксирует сессию БД и возвращает дополнительные поля ответа
+    on_complete: Callable[[AsyncSession, FileUploadSession, str], Awaitable[dict]]
+    # Создание загрузки через tus (метаданные клиента уже в session.upload_metadata)
+    on_create: Optional[Callable[[AsyncSession, UserModel, FileUploadSession], Awaitable[None]]] = None
+    # Отмена загрузки: удаление placeholder-сообщений и т.п.
+    on_terminate: Optional[Callable[[AsyncSession, FileUploadSession], Awaitable[None]]] = None
+    # Принят очередной чанк (рассылка upload_progress)
+    on_progress: Optional[Callable[[AsyncSession, FileUploadSession], Awaitable[None]]] = None
+    # Кто может загружать файлы этого типа
+    authorize: Callable[[UserModel], bool] = lambda user: True
+    # Имя файла в хранилище: исходное (APK) или случайное (медиа чата)
+    keep_filename: bool = False
+    # Можно ли отправлять байты в S3 по мере поступления (изображения в любом случае сжимаются при сохранении)
+    stream: bool = False
+
+
+_kinds: Dict[str, UploadKind] = {}
+
+
+def register_kind(name: str, kind: UploadKind) -> None:
+    _kinds[name] = kind
+
+
+def get_kind(name: str) -> Optional[UploadKind]:
+    return _kinds.get(name)
+
+
+def temp_path(session: FileUploadSession, part_number: Optional[int] = None) -> str:
+    name = f"{session.id}_{os.path.basename(session.filename)}"
+    if part_number is not None:
+        name += f".part{part_number}"
+    return os.path.join(TEMP_DIR, name)
+
+
+def get_metadata(session: FileUploadSession) -> dict:
+    return json.loads(session.upload_metadata or "{}")
+
+
+# Состояние незавершенной загрузки живет в Redis (hash upload:{id}): смещение, размер, части
+# multipart upload и placeholder-сообщение. Чанк не трогает БД: смещение сдвигается атомарной
+# проверкой в Redis (_ADVANCE_SCRIPT). Строка file_upload_sessions пишется при создании,
+# завершении и отмене загрузки; если Redis недоступен, каждый чанк фиксируется в БД, как раньше.
+
+_STATE_FIELDS = (
+    "user_id", "kind", "filename", "file_size", "mime_type", "offset", "concat",
+    "storage_key", "multipart_upload_id", "multipart_parts", "upload_metadata",
+)
+_INT_FIELDS = {"user_id", "file_size", "offset"}
+
+# Заполняет hash, только если его еще нет (первый чанк на любом воркере); 1 - записано
+_INIT_STATE_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return 0
+end
+redis.call('HSET', KEYS[1], unpack(ARGV, 2))
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+return 1
+"""
+
+# Сдвигает смещение, только если оно не изменилось с момента чтения; 1 - успех
+_ADVANCE_SCRIPT = """
+if redis.call('HGET', KEYS[1], 'offset') ~= ARGV[1] then
+    return 0
+end
+redis.call('HSET', KEYS[1], 'offset', ARGV[2])
+if ARGV[3] ~= '' then
+    redis.call('HSET', KEYS[1], 'multipart_parts', ARGV[3])
+end
+redis.call('EXPIRE', KEYS[1], ARGV[4])
+return 1
+"""
+
+_SET_IF_EXISTS_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    redis.call('HSET', KEYS[1], unpack(ARGV))
+end
+return 0
+"""
+
+
+class UploadSizeError(ValueError):
+    """Объявленный размер загрузки не положителен или больше UPLOAD_MAX_SIZE."""
+
+    def __init__(self, file_size: int):
+        super().__init__(f"Upload size must be between 1 and {UPLOAD_MAX_SIZE} bytes, got {file_size}")
+        self.file_size = file_size
+
+
+class UploadConflict(Exception):
+    """Смещение загрузки изменил параллельный запрос."""
+
+    def __init__(self, offset: int):
+        super().__init__(f"Upload offset changed concurrently (now {offset})")
+        self.offset = offset
+
+
+def state_key(upload_id: str) -> str:
+    return f"upload:{upload_id}"
+
+
+def session_from_state(upload_id: str, raw: dict) -> FileUploadSession:
+    data = {k.decode(): v.decode() for k, v in raw.items()}
+    values = {
+        name: int(data[name]) if name in _INT_FIELDS else data[name]
+        for name in _STATE_FIELDS if name in data
+    }
+    if "message_id" in data:
+        _targets[upload_id] = UploadTarget(int(data["message_id"]), values["user_id"], int(data["receiver_id"]))
+    # Объект не привязан к сессии БД; в БД он попадает через db.merge при завершении или отмене
+    return FileUploadSession(id=upload_id, **values)
+
+
+async def load_session(db: AsyncSession, upload_id: str) -> Optional[FileUploadSession]:
+    """
+    Сессия загрузки для приема чанка: из Redis, а при промахе - из БД (после чего состояние
+    кладется в Redis и следующие чанки БД не читают). Если Redis недоступен, возвращается
+    строка БД, и receive фиксирует каждый чанк в БД.
+    """
+    try:
+        redis = get_redis()
+        raw = await redis.hgetall(state_key(upload_id))
+    except Exception as e:
+        logger.error(f"Upload {upload_id}: Redis state lookup failed: {e}")
+        redis = None
+        raw = None
+    if raw:
+        return session_from_state(upload_id, raw)
+
+    res = await db.execute(select(FileUploadSession).where(FileUploadSession.id == upload_id))
+    session = res.scalar_one_or_none()
+    if session is None or session.is_completed or redis is None:
+        return session
+
+    fields = []
+    for name in _STATE_FIELDS:
+        value = getattr(session, name)
+        if value is not None:
+            fields.extend((name, value))
+    target = _targets.get(upload_id)
+    if target is not None:
+        fields.extend(("message_id", target.message_id, "receiver_id", target.receiver_id))
+    try:
+        if not await redis.eval(_INIT_STATE_SCRIPT, 1, state_key(upload_id), UPLOAD_STATE_TTL, *fields):
+            # Другой воркер успел раньше - его состояние новее
+            raw = await redis.hgetall(state_key(upload_id))
+            if raw:
+                db.expunge(session)
+                return session_from_state(upload_id, raw)
+    except Exception as e:
+        logger.error(f"Upload {upload_id}: failed to store state in Redis: {e}")
+        return session
+    db.expunge(session)
+    return session
+
+
+async def get_offsets(upload_ids: List[str]) -> Dict[str, int]:
+    """Текущие смещения незавершенных загрузок из Redis (для статуса и истории чата)."""
+    if not upload_ids:
+        return {}
+    try:
+        async with get_redis().pipeline(transaction=False) as pipe:
+            for upload_id in upload_ids:
+                pipe.hget(state_key(upload_id), "offset")
+            offsets = await pipe.execute()
+    except Exception as e:
+        logger.error(f"Upload offsets lookup failed: {e}")
+        return {}
+    return {upload_id: int(offset) for upload_id, offset in zip(upload_ids, offsets) if offset is not None}
+
+
+async def _advance_state(session: FileUploadSession, expected_offset: int) -> bool:
+    parts = session.multipart_parts if session.multipart_upload_id else ""
+    return bool(await get_redis().eval(
+        _ADVANCE_SCRIPT, 1, state_key(session.id), expected_offset, session.offset, parts or "", UPLOAD_STATE_TTL
+    ))
+
+
+# Завершение (сохранение файла и хук on_complete) выполняет один запрос: параллельный последний чанк
+# с тем же смещением получает UploadConflict. Ключ живет не дольше FINALIZE_LOCK_TTL секунд
+FINALIZE_LOCK_TTL = 600
+
+
+async def _lock_finalize(upload_id: str) -> bool:
+    try:
+        return bool(await get_redis().set(f"{state_key(upload_id)}:finalize", 1, nx=True, ex=FINALIZE_LOCK_TTL))
+    except Exception as e:
+        # Без Redis загрузка и так идет через БД - завершаем без блокировки
+        logger.error(f"Upload {upload_id}: failed to take finalize lock: {e}")
+        return True
+
+
+async def _unlock_finalize(upload_id: str) -> None:
+    try:
+        await get_redis().delete(f"{state_key(upload_id)}:finalize")
+    except Exception as e:
+        logger.error(f"Upload {upload_id}: failed to release finalize lock: {e}")
+
+
+async def drop_state(upload_id: str) -> None:
+    try:
+        await get_redis().delete(state_key(upload_id))
+    except Exception as e:
+        logger.error(f"Upload {upload_id}: failed to drop Redis state: {e}")
+
+
+async def create_session(
+    db: AsyncSession,
+    user_id: int,
+    filename: str,
+    file_size: int,
+    mime_type: Optional[str],
+    kind: str = "chat",
+    concat: Optional[str] = None,
+    metadata: Optional[dict] = None
+) -> FileUploadSession:
+    # Под file_size сразу резервируется место на диске (write_stream) - размер проверяется для всех точек входа
+    if not 0 < file_size <= UPLOAD_MAX_SIZE:
+        raise UploadSizeError(file_size)
+    session = FileUploadSession(
+        id=str(uuid.uuid4()),
+        user_id=user_id,
+        filename=filename,
+        file_size=file_size,
+        mime_type=mime_type,
+        offset=0,
+        kind=kind,
+        concat=concat,
+        upload_metadata=json.dumps(metadata) if metadata else None
+    )
+    upload_kind = _kinds.get(kind)
+    if concat is None and upload_kind is not None and upload_kind.stream and can_stream(filename, mime_type):
+        try:
+            await start_multipart(session, upload_kind.category)
+        except Exception as e:
+            # Хранилище не приняло multipart upload - собираем файл на диске
+            logger.error(f"Upload {session.id}: S3 multipart upload could not be started: {e}")
+    db.add(session)
+    return session
+
+
+# Мелкие куски тела запроса (tus PATCH) копятся до такого размера перед записью на диск
+WRITE_BUFFER_SIZE = 1024 * 1024
+
+
+async def write_stream(session: FileUploadSession, offset: int, chunks: AsyncIterator[bytes]) -> List[str]:
+    """
+    Пишет байты загрузки начиная с offset (совпадение offset с session.offset проверяет вызывающий)
+    и сдвигает session.offset. При потоковой загрузке в S3 заполненные части сразу уходят в хранилище.
+    Возвращает временные файлы отправленных частей: их удаляют после фиксации сессии (discard_files),
+    чтобы при откате транзакции клиент мог повторить чанк.
+    """
+    os.makedirs(TEMP_DIR, exist_ok=True)
+    sent_files = []
+    position = offset
+    buffer = bytearray()
+
+    async def flush():
+        nonlocal position
+        if not buffer:
+            return
+        data = bytes(buffer)
+        buffer.clear()
+        if session.multipart_upload_id:
+            parts = json.loads(session.multipart_parts or "[]")
+            part_number = len(parts) + 1
+            path = temp_path(session, part_number)
+            part_position = position - sum(p["Size"] for p in parts)
+            await aiofile.pwrite(path, part_position, data, truncate=True)
+            position += len(data)
+            if part_position + len(data) >= storage_s3.MIN_PART_SIZE:
+                await _upload_part_file(session, path, part_number)
+                sent_files.append(path)
+        else:
+            await aiofile.pwrite(temp_path(session), position, data, preallocate=session.file_size)
+            position += len(data)
+
+    async for data in chunks:
+        buffer.extend(data)
+        if len(buffer) >= WRITE_BUFFER_SIZE:
+            await flush()
+    await flush()
+    session.offset = position
+    return sent_files
+
+
+async def _upload_part_file(session: FileUploadSession, path: str, part_number: int) -> None:
+    body = await aiofile.read_bytes(path)
+    etag = await to_thread.run_sync(
+        storage_s3.upload_part, session.storage_key, session.multipart_upload_id, part_number, body
+    )
+    parts = json.loads(session.multipart_parts or "[]")[:part_number - 1]
+    parts.append({"PartNumber": part_number, "ETag": etag, "Size": len(body)})
+    session.multipart_parts = json.dumps(parts)
+
+
+async def discard_files(paths: List[str]) -> None:
+    await aiofile.remove_many(paths)
+
+
+def session_files(session: FileUploadSession) -> List[str]:
+    """Все временные файлы загрузки (собираемый файл и буферы частей)."""
+    paths = [temp_path(session)]
+    parts = json.loads(session.multipart_parts or "[]")
+    paths.extend(temp_path(session, n) for n in range(1, len(parts) + 2))
+    return paths
+
+
+async def iter_upload_file(file, chunk_size: int = 1024 * 1024) -> AsyncIterator[bytes]:
+    while True:
+        data = await file.read(chunk_size)
+        if not data:
+            break
+        yield data
+
+
+async def receive(db: AsyncSession, session: FileUploadSession, offset: int, chunks: AsyncIterator[bytes]) -> dict:
+    """
+    Принимает очередную порцию байтов загрузки: пишет ее, сообщает о прогрессе и,
+    если файл получен целиком, завершает загрузку. Промежуточное смещение сохраняется в Redis,
+    в БД сессия пишется только при завершении. При ошибке хранилища смещение не сдвигается,
+    клиент повторяет порцию с прежнего смещения.
+    """
+    persistent = session in db
+    try:
+        sent_files = await write_stream(session, offset, chunks)
+    except Exception:
+        if persistent:
+            await db.rollback()
+        raise
+
+    upload_kind = _kinds[session.kind]
+    complete = session.offset >= session.file_size
+    if session.concat != "partial" and upload_kind.on_progress is not None:
+        try:
+            await upload_kind.on_progress(db, session)
+        except Exception as e:
+            logger.error(f"Upload {session.id}: progress hook failed: {e}")
+
+    if not complete and not persistent:
+        try:
+            advanced = await _advance_state(session, offset)
+        except Exception as e:
+            logger.error(f"Upload {session.id}: Redis state update failed, persisting to DB: {e}")
+        else:
+            if not advanced:
+                raise UploadConflict(int(await get_redis().hget(state_key(session.id), "offset") or 0))
+            await discard_files(sent_files)
+            return {"status": "ok", "offset": session.offset}
+
+    if complete and session.concat != "partial":
+        upload_id = session.id
+        if not await _lock_finalize(upload_id):
+            if persistent:
+                await db.rollback()
+            raise UploadConflict(int(await get_redis().hget(state_key(upload_id), "offset") or offset))
+        try:
+            if not persistent:
+                session = await db.merge(session)
+            result = await finalize(db, session)
+        except Exception:
+            await db.rollback()
+            await _unlock_finalize(upload_id)
+            raise
+        await drop_state(upload_id)
+        await _unlock_finalize(upload_id)
+        return result
+
+    if not persistent:
+        session = await db.merge(session)
+    if complete:
+        # Часть tus concatenation: файл остается на диске до создания итоговой загрузки
+        session.is_completed = True
+
+    await db.commit()
+    if complete:
+        await drop_state(session.id)
+    await discard_files(sent_files)
+    return {"status": "ok", "offset": session.offset}
+
+
+async def finalize(db: AsyncSession, session: FileUploadSession) -> dict:
+    """
+    Все байты получены: сохраняет файл в постоянное хранилище и передает его хуку типа загрузки.
+    Возвращает ответ legacy-эндпоинтов: {"status": "completed", "file_path": url, ...}.
+    """
+    upload_kind = _kinds[session.kind]
+    session.is_completed = True
+    session.offset = session.file_size
+
+    if session.multipart_upload_id:
+        # Хвост (последняя часть может быть меньше 5 MB) и завершение multipart upload
+        parts = json.loads(session.multipart_parts or "[]")
+        tail_path = temp_path(session, len(parts) + 1)
+        if os.path.exists(tail_path) and os.path.getsize(tail_path) > 0:
+            await _upload_part_file(session, tail_path, len(parts) + 1)
+        url = await complete_multipart(session)
+    else:
+        _, content_type = resolve_upload_type(session.filename, session.mime_type)
+        if upload_kind.keep_filename:
+            filename_hint = session.filename
+        else:
+            filename_hint = f"{uuid.uuid4()}{os.path.splitext(session.filename)[1]}"
+        url, _ = await aiofile.save_path(upload_kind.category, filename_hint, temp_path(session), content_type)
+
+    await discard_files(session_files(session))
+    session.result_url = url
+    result = await upload_kind.on_complete(db, session, url)
+    return {"status": "completed", "file_path": url, **(result or {})}
+
+
+async def concatenate(db: AsyncSession, session: FileUploadSession, partials: List[FileUploadSession]) -> dict:
+    """tus concatenation: склеивает завершенные partial-загрузки в файл итоговой загрузки и завершает ее."""
+    os.makedirs(TEMP_DIR, exist_ok=True)
+    await aiofile.concat(temp_path(session), [temp_path(partial) for partial in partials])
+    result = await finalize(db, session)
+    for partial in partials:
+        await discard_files(session_files(partial))
+        await db.delete(partial)
+    await db.commit()
+    return result
+
+
+async def terminate(db: AsyncSession, session: FileUploadSession) -> None:
+    """Отмена загрузки: временные файлы, незавершенный multipart upload и хук типа загрузки."""
+    await discard_files(session_files(session))
+    try:
+        await abort_multipart(session)
+    except Exception as e:
+        logger.error(f"Upload {session.id}: failed to abort S3 multipart upload: {e}")
+    await drop_state(session.id)
+    if session not in db:
+        session = await db.merge(session)
+    await db.delete(session)
+    upload_kind = _kinds.get(session.kind)
+    if upload_kind is not None and upload_kind.on_terminate is not None and session.concat != "partial":
+        await upload_kind.on_terminate(db, session)
+    await db.commit()
+
+
+# Потоковая загрузка в S3.
+# Чанки клиента копятся в буфере текущей части (media/temp/{id}_{name}.partN) до MIN_PART_SIZE
+# и уходят в хранилище частью multipart upload; на последнем чанке загрузка завершается.
+# Собранный файл на диск не пишется и повторно не читается.
+# Изображения идут обычным путем: их нужно сжать перед сохранением.
+# Видео при потоковой загрузке не перекодируется через ffmpeg.
+
+def can_stream(filename: str, mime_type: Optional[str]) -> bool:
+    if storage.MEDIA_STORAGE != "s3":
+        return False
+    message_type, content_type = resolve_upload_type(filename, mime_type)
+    return message_type != "image" and content_type.lower() not in storage.IMAGE_CONTENT_TYPES
+
+
+async def start_multipart(session: FileUploadSession, category: str = "chat") -> None:
+    _, content_type = resolve_upload_type(session.filename, session.mime_type)
+    key = storage.build_key(category, f"{uuid.uuid4()}{os.path.splitext(session.filename)[1]}")
+    session.multipart_upload_id = await to_thread.run_sync(storage_s3.create_multipart_upload, key, content_type)
+    session.storage_key = key
+    session.multipart_parts = "[]"
+
+
+async def complete_multipart(session: FileUploadSession) -> str:
+    parts = [{"PartNumber": p["PartNumber"], "ETag": p["ETag"]} for p in json.loads(session.multipart_parts or "[]")]
+    url = await to_thread.run_sync(
+        storage_s3.complete_multipart_upload, session.storage_key, session.multipart_upload_id, parts
+    )
+    session.multipart_upload_id = None
+    return url
+
+
+async def abort_multipart(session: FileUploadSession) -> None:
+    if not session.multipart_upload_id:
+        return
+    await to_thread.run_sync(storage_s3.abort_multipart_upload, session.storage_key, session.multipart_upload_id)
+    session.multipart_upload_id = None
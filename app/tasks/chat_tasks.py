@@ -0,0 +1,222 @@
+import asyncio
+import time
+from collections import defaultdict
+from datetime import datetime
+
+from loguru import logger
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
+from sqlalchemy.pool import NullPool
+
+from app.core.celery_app import celery_app
+from app.core.config import CHAT_ARCHIVE_AFTER_MONTHS, CHAT_COMPACTION_BATCH_SIZE, CHAT_WRITE_RECOVER_AFTER, DATABASE_URL
+from app.core.redis import new_redis
+from app.models.chat import ChatDialog
+from app.services import chat_archive, chat_cache, chat_compaction, chat_writer, unread
+from app.services.chat_dialogs import refresh_dialog_pair
+
+
+def task_session_maker():
+    """
+    Фабрика сессий для задач Celery.
+    Каждая задача работает в своем event loop (asyncio.run), поэтому пул соединений не переиспользуется.
+    """
+    engine = create_async_engine(DATABASE_URL, poolclass=NullPool)
+    return engine, async_sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
+
+
+async def _load_unread(db: AsyncSession, user_id: int) -> dict:
+    res = await db.execute(
+        select(ChatDialog.partner_id, ChatDialog.unread_count)
+        .where(ChatDialog.user_id == user_id, ChatDialog.unread_count > 0)
+    )
+    # Читающая транзакция закрывается, чтобы повторная попытка видела свежие данные
+    dialogs = {row.partner_id: row.unread_count for row in res}
+    await db.rollback()
+    return dialogs
+
+
+async def _reconcile_unread_counters() -> dict:
+    engine, session_maker = task_session_maker()
+    redis = new_redis()
+    try:
+        async with session_maker() as db:
+            res = await db.execute(
+                select(ChatDialog.user_id, ChatDialog.partner_id, ChatDialog.unread_count)
+                .where(ChatDialog.unread_count > 0)
+            )
+            expected = defaultdict(dict)
+            for row in res:
+                expected[row.user_id][row.partner_id] = row.unread_count
+            await db.rollback()
+
+            # Пользователи, у которых в Redis есть счетчики, но в БД непрочитанных нет
+            user_ids = set(expected)
+            async for key in redis.scan_iter(match="unread:*", count=500):
+                try:
+                    user_ids.add(int(key.decode().split(":", 1)[1]))
+                except ValueError:
+                    continue
+
+            # Общий снимок БД только отбирает кандидатов: перезапись идет по свежему пересчету под WATCH
+            repaired = 0
+            for user_id in user_ids:
+                dialogs = expected.get(user_id, {})
+                current = await unread.get_unread_counts(user_id, redis=redis)
+                if current["dialogs"] == dialogs and current["total"] == sum(dialogs.values()):
+                    continue
+                if await unread.store_unread_counts(user_id, lambda: _load_unread(db, user_id), redis=redis):
+                    repaired += 1
+
+        if repaired:
+            logger.warning(f"Unread counters: repaired drift for {repaired} of {len(user_ids)} users")
+        return {"status": "success", "checked": len(user_ids), "repaired": repaired}
+    finally:
+        await redis.aclose()
+        await engine.dispose()
+
+
+@celery_app.task(name="reconcile_unread_counters")
+def reconcile_unread_counters():
+    """Сверяет счетчики непрочитанных в Redis с chat_dialogs и исправляет расхождения."""
+    try:
+        return asyncio.run(_reconcile_unread_counters())
+    except Exception as e:
+        logger.error(f"Celery task reconcile_unread_counters failed: {e}")
+        return {"status": "error", "message": str(e)}
+
+
+async def _store_recovered(session_maker, messages) -> set:
+    async with session_maker() as db:
+        inserted = await chat_writer.insert_messages(db, messages)
+        pairs = {
+            (min(m.sender_id, m.receiver_id), max(m.sender_id, m.receiver_id))
+            for m in messages if m.id in inserted
+        }
+        for user_a, user_b in pairs:
+            await refresh_dialog_pair(db, user_a, user_b)
+        await db.commit()
+    return inserted
+
+
+async def _recover_pending_messages() -> dict:
+    engine, session_maker = task_session_maker()
+    redis = new_redis()
+    # Записи моложе CHAT_WRITE_RECOVER_AFTER еще может записать своя пачка в веб-процессе
+    max_entry = str(int((time.time() - CHAT_WRITE_RECOVER_AFTER) * 1000))
+    recovered = 0
+    try:
+        while True:
+            entries = await redis.xrange(chat_writer.PENDING_STREAM, min="-", max=max_entry, count=500)
+            if not entries:
+                break
+            messages = [chat_writer.load_message(fields[b"m"]) for _, fields in entries]
+            try:
+                inserted = await _store_recovered(session_maker, messages)
+            except IntegrityError:
+                # В пачке есть строка, которую нельзя записать (например, отправитель удален):
+                # пишем по одному, а такие строки переносим в chat:pending:dead
+                inserted = set()
+                for (_, fields), message in zip(entries, messages):
+                    try:
+                        inserted |= await _store_recovered(session_maker, [message])
+                    except IntegrityError as e:
+                        logger.error(f"Chat writer: message {message.id} moved to {chat_writer.DEAD_STREAM}: {e.orig}")
+                        await redis.xadd(chat_writer.DEAD_STREAM, {"m": fields[b"m"]})
+            pairs = {
+                (min(m.sender_id, m.receiver_id), max(m.sender_id, m.receiver_id))
+                for m in messages if m.id in inserted
+            }
+            await redis.xdel(chat_writer.PENDING_STREAM, *[entry_id for entry_id, _ in entries])
+            for user_a, user_b in pairs:
+                await chat_cache.invalidate(user_a, user_b, redis=redis)
+            recovered += len(inserted)
+
+        if recovered:
+            logger.warning(f"Chat writer: recovered {recovered} messages from {chat_writer.PENDING_STREAM}")
+        return {"status": "success", "recovered": recovered}
+    finally:
+        await redis.aclose()
+        await engine.dispose()
+
+
+@celery_app.task(name="recover_pending_messages")
+def recover_pending_messages():
+    """Сохраняет в БД сообщения из chat:pending, которые веб-процесс не успел записать пачкой."""
+    try:
+        return asyncio.run(_recover_pending_messages())
+    except Exception as e:
+        logger.error(f"Celery task recover_pending_messages failed: {e}")
+        return {"status": "error", "message": str(e)}
+
+
+async def _maintain_chat_partitions() -> dict:
+    engine, session_maker = task_session_maker()
+    try:
+        if engine.dialect.name != "postgresql":
+            return {"status": "skipped", "reason": "chat_messages is partitioned only on PostgreSQL"}
+        async with session_maker() as db:
+            created = await chat_archive.ensure_partitions(db)
+            if created:
+                logger.info(f"Chat partitions: created {', '.join(created)}")
+
+            # Секция уходит в архив, когда весь ее месяц старше CHAT_ARCHIVE_AFTER_MONTHS
+            cutoff = chat_archive.add_months(chat_archive.month_start(datetime.utcnow()), -CHAT_ARCHIVE_AFTER_MONTHS)
+            expired = [(name, start) for name, start in await chat_archive.list_partitions(db)
+                       if chat_archive.add_months(start, 1) <= cutoff]
+            archived = []
+            if expired and not chat_archive.available():
+                logger.warning(f"Chat partitions: pandas/pyarrow are not installed, {len(expired)} partitions are not archived")
+                expired = []
+            for name, start in expired:
+                archive = await chat_archive.archive_partition(db, name, start)
+                archived.append({"partition": name, "rows": archive.row_count, "bytes": archive.size_bytes})
+        return {"status": "success", "created": created, "archived": archived}
+    finally:
+        await engine.dispose()
+
+
+@celery_app.task(name="maintain_chat_partitions")
+def maintain_chat_partitions():
+    """Создает будущие секции chat_messages и выгружает старые в архив Parquet."""
+    try:
+        return asyncio.run(_maintain_chat_partitions())
+    except Exception as e:
+        logger.error(f"Celery task maintain_chat_partitions failed: {e}")
+        return {"status": "error", "message": str(e)}
+
+
+async def _compact_deleted_messages() -> dict:
+    engine, session_maker = task_session_maker()
+    redis = new_redis()
+    rows = files = reclaimed = 0
+    try:
+        while True:
+            async with session_maker() as db:
+                count, pairs, urls = await chat_compaction.compact_batch(db, CHAT_COMPACTION_BATCH_SIZE)
+                deleted, size = await chat_compaction.delete_media(db, urls)
+            rows += count
+            files += deleted
+            reclaimed += size
+            for user_a, user_b in pairs:
+                await chat_cache.invalidate(user_a, user_b, redis=redis)
+            if count < CHAT_COMPACTION_BATCH_SIZE:
+                break
+
+        if rows:
+            logger.info(f"Chat compaction: removed {rows} messages and {files} files, reclaimed {reclaimed} bytes")
+        return {"status": "success", "rows": rows, "files": files, "bytes": reclaimed}
+    finally:
+        await redis.aclose()
+        await engine.dispose()
+
+
+@celery_app.task(name="compact_deleted_messages")
+def compact_deleted_messages():
+    """Удаляет из chat_messages сообщения, удаленные обоими участниками, вместе с их файлами."""
+    try:
+        return asyncio.run(_compact_deleted_messages())
+    except Exception as e:
+        logger.error(f"Celery task compact_deleted_messages failed: {e}")
+        return {"status": "error", "message": str(e)}
@@ -0,0 +1,96 @@
+import asyncio
+import time
+from datetime import datetime
+
+from loguru import logger
+from sqlalchemy import update
+
+from app.core.celery_app import celery_app
+from app.core.redis import new_redis
+from app.core.ws import RedisBackend, encode_event
+from app.models.users import User as UserModel
+from app.services import presence
+from app.tasks.chat_tasks import task_session_maker
+
+FLUSH_BATCH = 500
+# Пространства имен сокетов, в которые уходит user_status (см. ConnectionManager и StreamManager)
+STATUS_NAMESPACES = ("notifications", "stream.presence")
+
+
+async def _expire_dead_connections(redis, session_maker) -> int:
+    """
+    Пользователи, помеченные online, у которых не осталось живых heartbeat
+    (воркер упал и не успел вызвать disconnected), переводятся в offline.
+    """
+    expired = 0
+    async for raw_uid, status in redis.hscan_iter(presence.STATUS_KEY):
+        if status != b"online":
+            continue
+        user_id = int(raw_uid)
+        if await redis.zcount(presence.conn_key(user_id), time.time(), "+inf") > 0:
+            continue
+        last_seen = datetime.utcnow().isoformat()
+        if not await presence.set_status(user_id, "offline", last_seen, redis=redis):
+            continue
+        expired += 1
+        async with session_maker() as db:
+            audience = await presence.get_audience(db, user_id)
+        frame = encode_event(presence.status_event(user_id, "offline", last_seen))
+        for recipient_id in audience:
+            for namespace in STATUS_NAMESPACES:
+                await redis.publish(RedisBackend._user_channel(namespace, recipient_id), frame)
+    return expired
+
+
+async def _flush_presence() -> dict:
+    redis = new_redis()
+    engine, session_maker = task_session_maker()
+    try:
+        expired = await _expire_dead_connections(redis, session_maker)
+
+        flushed = 0
+        while True:
+            user_ids = [int(uid) for uid in await redis.spop(presence.DIRTY_KEY, FLUSH_BATCH) or []]
+            if not user_ids:
+                break
+            async with redis.pipeline(transaction=False) as pipe:
+                pipe.hmget(presence.STATUS_KEY, user_ids)
+                pipe.hmget(presence.LAST_SEEN_KEY, user_ids)
+                statuses, last_seens = await pipe.execute()
+
+            online, offline = [], []
+            for user_id, status, last_seen in zip(user_ids, statuses, last_seens):
+                if status is None:
+                    continue
+                if status == b"online":
+                    online.append({"id": user_id, "status": "online"})
+                else:
+                    offline.append({"id": user_id, "status": status.decode(), "last_seen": last_seen.decode() if last_seen else None})
+
+            try:
+                async with session_maker() as db:
+                    # Bulk UPDATE по первичному ключу: один executemany на пачку
+                    for rows in (online, offline):
+                        if rows:
+                            await db.execute(update(UserModel), rows)
+                    await db.commit()
+            except Exception:
+                # Не теряем пачку: вернем пользователей в очередь на следующий запуск
+                await redis.sadd(presence.DIRTY_KEY, *user_ids)
+                raise
+            flushed += len(online) + len(offline)
+
+        return {"status": "success", "flushed": flushed, "expired": expired}
+    finally:
+        await redis.aclose()
+        await engine.dispose()
+
+
+@celery_app.task(name="flush_presence")
+def flush_presence():
+    """Записывает накопленные в Redis статусы присутствия в users.status/last_seen пачками."""
+    try:
+        return asyncio.run(_flush_presence())
+    except Exception as e:
+        logger.error(f"Celery task flush_presence failed: {e}")
+        return {"status": "error", "message": str(e)}
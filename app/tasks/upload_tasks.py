@@ -0,0 +1,196 @@
+import asyncio
+import os
+from datetime import datetime, timedelta
+
+from anyio import to_thread
+from loguru import logger
+from sqlalchemy import or_, select
+
+from app.core.celery_app import celery_app
+from app.core.config import UPLOAD_ABANDON_AFTER, UPLOAD_STATE_TTL
+from app.core.redis import new_redis
+from app.core.ws import RedisBackend, encode_event, log_event
+from app.models.chat import ChatMessage, FileUploadSession
+from app.services import chat_attachments, chat_cache, uploads
+from app.services.chat_dialogs import refresh_dialog_pair
+from app.tasks.chat_tasks import task_session_maker
+from app.utils import storage, storage_s3
+
+# Пространства имен сокетов, в которые уходят события сообщений (см. чат и уведомления)
+MESSAGE_NAMESPACES = ("chat", "notifications")
+
+
+async def _notify(redis, event: dict, user_ids) -> None:
+    frame = encode_event(event)
+    for user_id in set(user_ids):
+        for namespace in MESSAGE_NAMESPACES:
+            logged = await log_event(namespace, user_id, frame, redis=redis)
+            await redis.publish(RedisBackend._user_channel(namespace, user_id), logged)
+
+
+async def _is_active(redis, session: FileUploadSession) -> bool:
+    """Незавершенная загрузка жива, если чанк приходил позже UPLOAD_ABANDON_AFTER (TTL состояния в Redis продлевается чанком)."""
+    if session.is_completed:
+        return False
+    ttl = await redis.ttl(uploads.state_key(session.id))
+    return ttl > 0 and UPLOAD_STATE_TTL - ttl < UPLOAD_ABANDON_AFTER
+
+
+async def _release_session(redis, session: FileUploadSession) -> None:
+    """Временные файлы, незавершенный multipart upload и состояние в Redis брошенной загрузки."""
+    raw = await redis.hgetall(uploads.state_key(session.id))
+    # В Redis актуальный список частей: по нему находятся буферы частей на диске
+    current = uploads.session_from_state(session.id, raw) if raw else session
+    for path in uploads.session_files(current):
+        try:
+            if os.path.exists(path):
+                os.remove(path)
+        except Exception as e:
+            logger.error(f"Upload GC: failed to delete {path}: {e}")
+    if current.multipart_upload_id:
+        try:
+            await to_thread.run_sync(storage_s3.abort_multipart_upload, current.storage_key, current.multipart_upload_id)
+        except Exception as e:
+            logger.error(f"Upload GC: failed to abort multipart upload of {session.id}: {e}")
+    await redis.delete(uploads.state_key(session.id))
+
+
+def _sweep_temp_dir(live_ids: set, limit: datetime) -> int:
+    """Файлы media/temp без сессии (сессия удалена, а файл остался после сбоя)."""
+    if not os.path.isdir(uploads.TEMP_DIR):
+        return 0
+    removed = 0
+    for entry in os.scandir(uploads.TEMP_DIR):
+        upload_id = entry.name.split("_", 1)[0]
+        if upload_id in live_ids or datetime.utcfromtimestamp(entry.stat().st_mtime) >= limit:
+            continue
+        try:
+            os.remove(entry.path)
+            removed += 1
+        except Exception as e:
+            logger.error(f"Upload GC: failed to delete {entry.path}: {e}")
+    return removed
+
+
+def _abort_orphan_multipart(live_upload_ids: set, limit: datetime) -> int:
+    """Multipart upload в S3, на которые не ссылается ни одна сессия (части занимают место до abort)."""
+    aborted = 0
+    for upload in storage_s3.list_multipart_uploads():
+        initiated = upload["Initiated"].replace(tzinfo=None)
+        if upload["UploadId"] in live_upload_ids or initiated >= limit:
+            continue
+        try:
+            storage_s3.abort_multipart_upload(upload["Key"], upload["UploadId"])
+            aborted += 1
+        except Exception as e:
+            logger.error(f"Upload GC: failed to abort orphan multipart upload {upload['Key']}: {e}")
+    return aborted
+
+
+async def _collect_abandoned_uploads() -> dict:
+    redis = new_redis()
+    engine, session_maker = task_session_maker()
+    limit = datetime.utcnow() - timedelta(seconds=UPLOAD_ABANDON_AFTER)
+    stats = {"sessions": 0, "placeholders_deleted": 0, "placeholders_finalized": 0, "temp_files": 0, "multipart_aborted": 0}
+    try:
+        async with session_maker() as db:
+            res = await db.execute(select(FileUploadSession).where(FileUploadSession.created_at < limit))
+            expired = [s for s in res.scalars().all() if not await _is_active(redis, s)]
+            abandoned_ids = [s.id for s in expired if not s.is_completed]
+
+            # Placeholder-сообщения: загрузка брошена или сессии нет (upload_started по WS без init_upload) -
+            # удаляем; файл успел сохраниться - завершаем сообщение, как это сделал бы последний чанк
+            res = await db.execute(
+                select(ChatMessage, FileUploadSession)
+                .outerjoin(FileUploadSession, ChatMessage.upload_id == FileUploadSession.id)
+                .where(
+                    ChatMessage.is_uploading == True,
+                    or_(ChatMessage.timestamp < limit, ChatMessage.upload_id.in_(abandoned_ids))
+                )
+            )
+            deleted, finalized, pairs, refreshed = [], [], set(), set()
+            for msg, session in res:
+                if session is not None and session.is_completed and session.result_url:
+                    message_type, _ = uploads.resolve_upload_type(session.filename, session.mime_type)
+                    msg.file_path = session.result_url
+                    if msg.message_type != "video_note":
+                        msg.message_type = message_type
+                    msg.is_uploading = False
+                    msg.upload_id = None
+                    attachments = await chat_attachments.replace(db, msg.id, [{
+                        **uploads.get_metadata(session),
+                        "file_path": session.result_url,
+                        "type": msg.message_type,
+                        "size": session.file_size
+                    }])
+                    finalized.append((msg, session.id, chat_attachments.items(attachments)))
+                    refreshed.add((msg.sender_id, msg.receiver_id))
+                elif session is None or session.id in abandoned_ids:
+                    deleted.append((msg.id, msg.upload_id, msg.sender_id, msg.receiver_id))
+                    pairs.add((msg.sender_id, msg.receiver_id))
+                    await db.delete(msg)
+            await db.flush()
+            for sender_id, receiver_id in pairs | refreshed:
+                await refresh_dialog_pair(db, sender_id, receiver_id)
+
+            for session in expired:
+                await _release_session(redis, session)
+                await db.delete(session)
+            await db.commit()
+
+            stats["sessions"] = len(expired)
+            stats["placeholders_deleted"] = len(deleted)
+            stats["placeholders_finalized"] = len(finalized)
+
+            res = await db.execute(select(FileUploadSession.id, FileUploadSession.multipart_upload_id))
+            live = res.all()
+
+        for sender_id, receiver_id in pairs:
+            await chat_cache.invalidate(sender_id, receiver_id, redis=redis)
+        for message_id, upload_id, sender_id, receiver_id in deleted:
+            await _notify(redis, {
+                "type": "message_deleted",
+                "data": {"message_id": message_id, "upload_id": upload_id}
+            }, (sender_id, receiver_id))
+        for msg, upload_id, attachments in finalized:
+            await chat_cache.patch(msg.sender_id, msg.receiver_id, msg.id, {
+                "file_path": msg.file_path,
+                "message_type": msg.message_type,
+                "is_uploading": False,
+                "upload_id": None,
+                "attachments": attachments
+            }, redis=redis)
+            await _notify(redis, {"type": "message_updated", "data": {
+                "id": msg.id,
+                "file_path": msg.file_path,
+                "message_type": msg.message_type,
+                "is_uploading": False,
+                "upload_id": upload_id,
+                "attachments": attachments,
+                "client_id": msg.client_id,
+                "sender_id": msg.sender_id,
+                "receiver_id": msg.receiver_id,
+                "timestamp": msg.timestamp.isoformat() if msg.timestamp else None
+            }}, (msg.sender_id, msg.receiver_id))
+
+        stats["temp_files"] = _sweep_temp_dir({row.id for row in live}, limit)
+        if storage.MEDIA_STORAGE == "s3":
+            live_upload_ids = {row.multipart_upload_id for row in live if row.multipart_upload_id}
+            stats["multipart_aborted"] = await to_thread.run_sync(_abort_orphan_multipart, live_upload_ids, limit)
+
+        if any(stats.values()):
+            logger.info(f"Upload GC: {stats}")
+        return {"status": "success", **stats}
+    finally:
+        await redis.aclose()
+        await engine.dispose()
+
+
+@celery_app.task(name="collect_abandoned_uploads")
+def collect_abandoned_uploads():
+    """Удаляет брошенные загрузки: сессии, временные файлы, multipart upload в S3 и placeholder-сообщения."""
+    try:
+        return asyncio.run(_collect_abandoned_uploads())
+    except Exception as e:
+        logger.error(f"Celery task collect_abandoned_uploads failed: {e}")
+        return {"status": "error", "message": str(e)}
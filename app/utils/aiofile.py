@@ -0,0 +1,169 @@
+import asyncio
+import os
+import shutil
+import time
+from typing import Callable, IO, List, Optional, Tuple, TypeVar
+
+from anyio import CapacityLimiter, to_thread
+from loguru import logger
+
+from app.core.config import MEDIA_IO_THREADS
+from app.core.metrics import EVENT_LOOP_LAG_SECONDS, MEDIA_IO_SECONDS, MEDIA_IO_WAIT_SECONDS
+from app.utils import storage
+
+# Файловый ввод-вывод медиа (чанки загрузок, сохранение и удаление файлов) выполняется
+# в отдельном ограниченном пуле потоков, а не в обработчиках async def: иначе запись
+# на медленный диск останавливает цикл событий вместе со всеми сокетами воркера.
+# Пул отдельный от общего пула anyio, чтобы очередь на диск не задерживала S3 и прочие run_sync.
+
+T = TypeVar("T")
+
+_limiter: Optional[CapacityLimiter] = None
+_monitor: Optional[asyncio.Task] = None
+# Период замера задержки цикла событий (секунды)
+LOOP_LAG_INTERVAL = 0.5
+
+
+def _get_limiter() -> CapacityLimiter:
+    global _limiter
+    if _limiter is None:
+        _limiter = CapacityLimiter(MEDIA_IO_THREADS)
+    return _limiter
+
+
+async def _watch_loop_lag() -> None:
+    """Насколько позже запланированного просыпается цикл событий: синхронная работа в цикле видна как лаг."""
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        EVENT_LOOP_LAG_SECONDS.observe(max(0.0, loop.time() - started - LOOP_LAG_INTERVAL))
+
+
+def _ensure_monitor() -> None:
+    global _monitor
+    if _monitor is None or _monitor.done():
+        _monitor = asyncio.get_running_loop().create_task(_watch_loop_lag())
+
+
+async def run(op: str, func: Callable[..., T], *args) -> T:
+    """Выполняет блокирующую файловую операцию в пуле медиа-потоков с учетом времени ожидания и работы."""
+    _ensure_monitor()
+    queued = time.perf_counter()
+
+    def _timed():
+        started = time.perf_counter()
+        MEDIA_IO_WAIT_SECONDS.observe(started - queued)
+        try:
+            return func(*args)
+        finally:
+            MEDIA_IO_SECONDS.labels(op).observe(time.perf_counter() - started)
+
+    return await to_thread.run_sync(_timed, limiter=_get_limiter())
+
+
+def _preallocate(fd: int, size: int) -> None:
+    # Файл загрузки резервируется целиком при создании: меньше фрагментации и ошибка нехватки места сразу
+    if size and hasattr(os, "posix_fallocate"):
+        try:
+            os.posix_fallocate(fd, 0, size)
+        except OSError as e:
+            logger.warning(f"posix_fallocate failed, writing without preallocation: {e}")
+
+
+def _pwrite(path: str, position: int, data: bytes, preallocate: int, truncate: bool) -> None:
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT, 0o644)
+    try:
+        if preallocate and position == 0 and os.fstat(fd).st_size == 0:
+            _preallocate(fd, preallocate)
+        os.pwrite(fd, data, position)
+        if truncate:
+            os.ftruncate(fd, position + len(data))
+    finally:
+        os.close(fd)
+
+
+async def pwrite(path: str, position: int, data: bytes, preallocate: int = 0, truncate: bool = False) -> None:
+    """
+    Пишет data в файл с позиции position (повтор чанка перезаписывает те же байты).
+    preallocate - полный размер файла, резервируемый при его создании;
+    truncate - обрезать файл по концу записанных данных.
+    """
+    await run("write", _pwrite, path, position, data, preallocate, truncate)
+
+
+def _read_bytes(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+
+async def read_bytes(path: str) -> bytes:
+    return await run("read", _read_bytes, path)
+
+
+def _remove(path: str) -> bool:
+    try:
+        os.remove(path)
+        return True
+    except FileNotFoundError:
+        return False
+
+
+async def remove(path: str) -> bool:
+    """Удаляет файл; отсутствующий файл ошибкой не считается (False)."""
+    return await run("remove", _remove, path)
+
+
+async def remove_many(paths: List[str]) -> None:
+    for path in paths:
+        try:
+            await remove(path)
+        except Exception as e:
+            logger.error(f"Failed to delete media file {path}: {e}")
+
+
+def _concat(dest: str, sources: List[str]) -> None:
+    with open(dest, "wb") as out:
+        for source in sources:
+            with open(source, "rb") as f_in:
+                shutil.copyfileobj(f_in, out)
+
+
+async def concat(dest: str, sources: List[str]) -> None:
+    await run("concat", _concat, dest, sources)
+
+
+def _save_path(category: str, filename_hint: str, path: str, content_type: Optional[str], private: bool) -> Tuple[str, str]:
+    with open(path, "rb") as f_in:
+        return storage.save_file(category, filename_hint, f_in, content_type, private)
+
+
+async def save_file(
+    category: str,
+    filename_hint: str,
+    fileobj: IO[bytes],
+    content_type: Optional[str] = None,
+    private: bool = False
+) -> Tuple[str, str]:
+    """storage.save_file вне цикла событий: сжатие, запись на диск или отправка в S3."""
+    return await run("save", storage.save_file, category, filename_hint, fileobj, content_type, private)
+
+
+async def save_path(
+    category: str,
+    filename_hint: str,
+    path: str,
+    content_type: Optional[str] = None,
+    private: bool = False
+) -> Tuple[str, str]:
+    """То же для файла на диске (собранная загрузка): файл открывается и читается в пуле."""
+    return await run("save", _save_path, category, filename_hint, path, content_type, private)
+
+
+async def delete(category_or_key: str, key_or_path: str) -> None:
+    await run("remove", storage.delete, category_or_key, key_or_path)
+
+
+async def delete_url(url: str, category: Optional[str] = None) -> int:
+    """storage.delete_url вне цикла событий. Возвращает число освобожденных байт."""
+    return await run("remove", storage.delete_url, url, category)
@@ -153,3 +153,40 @@ def delete(category_or_key: str, key_or_path: str) -> None:
             os.remove(key_or_path)
     except Exception:
         pass
+
+
+def _media_root() -> str:
+    project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    return os.getenv("MEDIA_ROOT", os.path.join(project_root, "media"))
+
+
+def delete_url(url: str, category: Optional[str] = None) -> int:
+    """
+    Deletes a file by the URL returned from save_file (public/s3:// URL or "/media/..." path).
+    If category is given, only files saved under that category are deleted.
+    Returns the number of bytes freed (0 if the file did not exist or the URL is not ours).
+    """
+    prefix = f"{category.strip('/')}/" if category else ""
+    if url.startswith(("http://", "https://", "s3://")):
+        key = storage_s3.key_from_url(url)
+        if not key or not key.startswith(prefix):
+            return 0
+        size = storage_s3.object_size(key)
+        if size:
+            storage_s3.delete_object(key)
+        return size
+
+    if not url.startswith("/media/"):
+        return 0
+    media_root = os.path.realpath(_media_root())
+    root = os.path.realpath(os.path.join(media_root, prefix)) if prefix else media_root
+    path = os.path.realpath(os.path.join(media_root, url[len("/media/"):]))
+    # URL вложения приходит от клиента: удаляем только файлы внутри MEDIA_ROOT (и каталога категории)
+    if not path.startswith(root + os.sep):
+        return 0
+    try:
+        size = os.path.getsize(path)
+        os.remove(path)
+        return size
+    except FileNotFoundError:
+        return 0
@@ -1,7 +1,8 @@
 import os
-from typing import Optional
+from typing import List, Optional
 import boto3
 from botocore.config import Config
+from botocore.exceptions import ClientError
 
 
 YC_S3_ENDPOINT = os.getenv("YC_S3_ENDPOINT", "https://storage.yandexcloud.net")
@@ -64,3 +65,95 @@ def delete_object(key: str) -> None:
         return
     client = _client()
     client.delete_object(Bucket=YC_S3_BUCKET, Key=key)
+
+
+def object_size(key: str) -> int:
+    """Returns the object size in bytes (0 if the object does not exist)."""
+    if not YC_S3_BUCKET:
+        return 0
+    try:
+        return _client().head_object(Bucket=YC_S3_BUCKET, Key=key)["ContentLength"]
+    except ClientError:
+        return 0
+
+
+def key_from_url(url: str) -> Optional[str]:
+    """Object key for a URL returned by upload_fileobj (public URL or s3://bucket/key)."""
+    prefixes = [f"s3://{YC_S3_BUCKET}/", f"{YC_S3_ENDPOINT.rstrip('/')}/{YC_S3_BUCKET}/"]
+    if YC_S3_PUBLIC_BASE_URL:
+        prefixes.insert(0, f"{YC_S3_PUBLIC_BASE_URL.rstrip('/')}/")
+    for prefix in prefixes:
+        if url.startswith(prefix):
+            return url[len(prefix):]
+    return None
+
+
+def download_file(key: str, path: str) -> None:
+    """Downloads an object to a local file."""
+    if not YC_S3_BUCKET:
+        raise RuntimeError("YC_S3_BUCKET is not configured")
+    client = _client()
+    client.download_file(Bucket=YC_S3_BUCKET, Key=key, Filename=path)
+
+
+# Multipart upload: файл отправляется в хранилище частями по мере поступления, без сборки на диске.
+# Все части, кроме последней, должны быть не меньше 5 MB (ограничение S3).
+MIN_PART_SIZE = 5 * 1024 * 1024
+
+
+def create_multipart_upload(key: str, content_type: Optional[str] = None, acl: Optional[str] = None) -> str:
+    """Starts a multipart upload and returns its UploadId."""
+    if not YC_S3_BUCKET:
+        raise RuntimeError("YC_S3_BUCKET is not configured")
+
+    params = {"Bucket": YC_S3_BUCKET, "Key": key}
+    if content_type:
+        params["ContentType"] = content_type
+    if acl or YC_S3_DEFAULT_ACL:
+        params["ACL"] = (acl or YC_S3_DEFAULT_ACL)
+    return _client().create_multipart_upload(**params)["UploadId"]
+
+
+def upload_part(key: str, upload_id: str, part_number: int, body: bytes) -> str:
+    """Uploads one part and returns its ETag."""
+    response = _client().upload_part(
+        Bucket=YC_S3_BUCKET,
+        Key=key,
+        UploadId=upload_id,
+        PartNumber=part_number,
+        Body=body,
+    )
+    return response["ETag"]
+
+
+def complete_multipart_upload(key: str, upload_id: str, parts: List[dict], acl: Optional[str] = None) -> str:
+    """
+    Completes a multipart upload. parts - [{"PartNumber": n, "ETag": "..."}, ...] in order.
+    Returns the same URL as upload_fileobj would.
+    """
+    _client().complete_multipart_upload(
+        Bucket=YC_S3_BUCKET,
+        Key=key,
+        UploadId=upload_id,
+        MultipartUpload={"Parts": parts},
+    )
+    if (acl or YC_S3_DEFAULT_ACL) == "public-read":
+        return make_public_url(key)
+    return f"s3://{YC_S3_BUCKET}/{key}"
+
+
+def abort_multipart_upload(key: str, upload_id: str) -> None:
+    if not YC_S3_BUCKET:
+        return
+    _client().abort_multipart_upload(Bucket=YC_S3_BUCKET, Key=key, UploadId=upload_id)
+
+
+def list_multipart_uploads() -> List[dict]:
+    """Незавершенные multipart upload бакета: [{"Key", "UploadId", "Initiated"}, ...]."""
+    if not YC_S3_BUCKET:
+        return []
+    uploads = []
+    paginator = _client().get_paginator("list_multipart_uploads")
+    for page in paginator.paginate(Bucket=YC_S3_BUCKET):
+        uploads.extend(page.get("Uploads", []))
+    return uploads
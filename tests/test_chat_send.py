@@ -0,0 +1,129 @@
+import asyncio
+import os
+
+os.environ.setdefault("DATABASE_URL", "sqlite+aiosqlite://")
+os.environ.setdefault("SECRET_KEY", "test")
+
+import fakeredis
+import pytest
+from sqlalchemy import event, select
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+
+import app.models  # noqa: F401 - регистрирует все таблицы в Base.metadata
+from app.core import redis as redis_module
+from app.database import Base
+from app.models.chat import ChatAttachment, ChatDialog, ChatMessage
+from app.models.users import User
+from app.services import chat as chat_service
+
+# Отправка сообщения (services.chat.send) должна стоить фиксированное число запросов:
+# один SELECT до записи, затем INSERT/UPDATE сообщения, вложений и один upsert сводок обоих участников.
+
+
+@pytest.fixture
+def env(tmp_path, monkeypatch):
+    monkeypatch.setattr(redis_module, "_client", fakeredis.FakeAsyncRedis())
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'chat.db'}")
+    session_maker = async_sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
+
+    async def setup():
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+        async with session_maker() as db:
+            for user_id in (1, 2):
+                db.add(User(
+                    id=user_id, email=f"u{user_id}@example.com", hashed_password="x",
+                    first_name=f"U{user_id}", last_name="L", fcm_token=f"token{user_id}"
+                ))
+            await db.commit()
+
+    asyncio.run(setup())
+    statements = []
+    last_batch = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        # SQLite не гарантирует порядок RETURNING в многострочном INSERT, и ORM шлет пачку строк
+        # отдельными executemany-вызовами (PostgreSQL - одним). Подряд идущие вызовы одной пачки - один запрос
+        if executemany and last_batch == [statement]:
+            return
+        last_batch[:] = [statement] if executemany else []
+        statements.append(statement.split()[0].upper())
+
+    event.listen(engine.sync_engine, "before_cursor_execute", record)
+    yield session_maker, statements, last_batch
+    asyncio.run(engine.dispose())
+
+
+def run_send(session_maker, statements, last_batch, **kwargs):
+    async def send():
+        async with session_maker() as db:
+            statements.clear()
+            last_batch.clear()
+            sent = await chat_service.send(db, **kwargs)
+            return sent, list(statements)
+    return asyncio.run(send())
+
+
+def test_new_message_statements(env):
+    session_maker, statements, last_batch = env
+    sent, executed = run_send(
+        session_maker, statements, last_batch, sender_id=1, receiver_id=2, content="hello", file_path=None,
+        message_type="text", client_id="c1"
+    )
+    assert sent.created and sent.receiver_fcm_token == "token2"
+    # SELECT получателя/ответа/client_id, INSERT сообщения, upsert сводок диалога
+    assert executed == ["SELECT", "INSERT", "INSERT"]
+
+    async def dialogs():
+        async with session_maker() as db:
+            rows = (await db.execute(select(ChatDialog.user_id, ChatDialog.last_message_id, ChatDialog.unread_count)))
+            return sorted(rows.all())
+
+    assert asyncio.run(dialogs()) == [(1, sent.message.id, 0), (2, sent.message.id, 1)]
+
+
+def test_new_media_group_statements(env):
+    session_maker, statements, last_batch = env
+    sent, executed = run_send(
+        session_maker, statements, last_batch, sender_id=1, receiver_id=2, content=None, file_path=None,
+        message_type="media_group", attachments=[{"file_path": "/a.jpg", "type": "image"}, {"file_path": "/b.mp4"}]
+    )
+    assert sent.created
+    # Вложения - один многострочный INSERT
+    assert executed == ["SELECT", "INSERT", "INSERT", "INSERT"]
+
+
+def test_placeholder_completion_statements(env):
+    session_maker, statements, last_batch = env
+
+    async def placeholder():
+        async with session_maker() as db:
+            msg = ChatMessage(
+                sender_id=1, receiver_id=2, message_type="video", client_id="up1",
+                is_uploading=True, upload_id="u1", deleted_by_sender=False, deleted_by_receiver=False
+            )
+            db.add(msg)
+            await db.commit()
+            return msg.id
+
+    placeholder_id = asyncio.run(placeholder())
+    sent, executed = run_send(
+        session_maker, statements, last_batch, sender_id=1, receiver_id=2, content=None, file_path="/media/chat/v.mp4",
+        message_type="video", client_id="up1", attachments=[{"file_path": "/media/chat/v.mp4", "type": "video"}]
+    )
+    assert not sent.created and sent.message.id == placeholder_id
+    # SELECT, UPDATE placeholder (autoflush перед заменой вложений), DELETE и INSERT вложений,
+    # upsert сводок диалога
+    assert executed == ["SELECT", "UPDATE", "DELETE", "INSERT", "INSERT"]
+
+    async def check():
+        async with session_maker() as db:
+            msg = await db.get(ChatMessage, placeholder_id)
+            urls = (await db.execute(
+                select(ChatAttachment.url).where(ChatAttachment.message_id == placeholder_id)
+            )).scalars().all()
+            return msg, urls
+
+    msg, urls = asyncio.run(check())
+    assert not msg.is_uploading and msg.file_path == "/media/chat/v.mp4"
+    assert urls == ["/media/chat/v.mp4"]
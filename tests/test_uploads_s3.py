@@ -0,0 +1,145 @@
+import asyncio
+import json
+import os
+
+os.environ.setdefault("DATABASE_URL", "sqlite+aiosqlite://")
+os.environ.setdefault("SECRET_KEY", "test")
+
+import boto3
+import fakeredis
+import pytest
+from moto import mock_aws
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+
+import app.models  # noqa: F401 - регистрирует все таблицы в Base.metadata
+from app.core import redis as redis_module
+from app.database import Base
+from app.models.chat import FileUploadSession
+from app.services import uploads
+from app.utils import storage, storage_s3
+
+# Потоковая загрузка в S3 (moto): чанки копятся до MIN_PART_SIZE, уходят частями multipart upload
+# и склеиваются CompleteMultipartUpload на последнем чанке; отмена загрузки делает AbortMultipartUpload.
+
+BUCKET = "chat-test"
+PART = storage_s3.MIN_PART_SIZE
+CHUNK = 1024 * 1024
+
+
+@pytest.fixture
+def env(tmp_path, monkeypatch):
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "test")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "test")
+    for name, value in (
+        ("YC_S3_BUCKET", BUCKET),
+        ("YC_S3_ENDPOINT", "https://s3.amazonaws.com"),
+        ("YC_S3_REGION", "us-east-1"),
+        ("YC_S3_ACCESS_KEY_ID", "test"),
+        ("YC_S3_SECRET_ACCESS_KEY", "test"),
+        ("YC_S3_PUBLIC_BASE_URL", None),
+        ("YC_S3_DEFAULT_ACL", "private"),
+    ):
+        monkeypatch.setattr(storage_s3, name, value)
+    monkeypatch.setattr(storage, "MEDIA_STORAGE", "s3")
+    monkeypatch.setattr(uploads, "TEMP_DIR", str(tmp_path / "temp"))
+    monkeypatch.setattr(redis_module, "_client", fakeredis.FakeAsyncRedis())
+
+    completed = {}
+
+    async def on_complete(db, session, url):
+        completed[session.id] = url
+        await db.commit()
+        return {}
+
+    monkeypatch.setitem(uploads._kinds, "test", uploads.UploadKind(category="chat", on_complete=on_complete, stream=True))
+
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'uploads.db'}")
+    session_maker = async_sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
+
+    async def setup():
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+
+    with mock_aws():
+        s3 = boto3.client("s3", region_name="us-east-1")
+        s3.create_bucket(Bucket=BUCKET)
+        asyncio.run(setup())
+        yield session_maker, s3, completed, tmp_path / "temp"
+        asyncio.run(engine.dispose())
+
+
+async def _chunks(data: bytes):
+    for start in range(0, len(data), CHUNK):
+        yield data[start:start + CHUNK]
+
+
+async def _create(session_maker, size: int) -> str:
+    async with session_maker() as db:
+        session = await uploads.create_session(db, 1, "movie.mp4", size, "video/mp4", kind="test")
+        await db.commit()
+        assert session.multipart_upload_id
+        return session.id
+
+
+async def _send(session_maker, upload_id: str, data: bytes) -> dict:
+    """Один запрос клиента: чанк data с текущего смещения загрузки."""
+    async with session_maker() as db:
+        session = await uploads.load_session(db, upload_id)
+        return await uploads.receive(db, session, session.offset, _chunks(data))
+
+
+async def _state(session_maker, upload_id: str) -> FileUploadSession:
+    async with session_maker() as db:
+        return await uploads.load_session(db, upload_id)
+
+
+def test_multipart_upload_assembles_object(env):
+    session_maker, s3, completed, temp_dir = env
+    data = os.urandom(2 * PART + 12345)
+    # Чанки клиента не совпадают с границами частей: 3 MB, 3 MB, 4 MB и хвост
+    bounds = [0, 3 * CHUNK, 6 * CHUNK, 10 * CHUNK, len(data)]
+
+    async def scenario():
+        upload_id = await _create(session_maker, len(data))
+        parts_seen = []
+        for start, end in zip(bounds, bounds[1:]):
+            result = await _send(session_maker, upload_id, data[start:end])
+            if end < len(data):
+                state = await _state(session_maker, upload_id)
+                assert result["offset"] == end == state.offset
+                parts_seen.append([p["Size"] for p in json.loads(state.multipart_parts)])
+        return upload_id, parts_seen, result
+
+    upload_id, parts_seen, result = asyncio.run(scenario())
+
+    # Часть уходит в хранилище только набрав MIN_PART_SIZE; последняя (хвост) может быть меньше
+    assert parts_seen == [[], [PART], [PART, PART]]
+    assert result["status"] == "completed"
+    url = result["file_path"]
+    assert completed[upload_id] == url
+    assert url.startswith(f"s3://{BUCKET}/chat/") and url.endswith(".mp4")
+
+    key = storage_s3.key_from_url(url)
+    assert s3.head_object(Bucket=BUCKET, Key=key)["ContentLength"] == len(data)
+    assert s3.get_object(Bucket=BUCKET, Key=key)["Body"].read() == data
+    assert not s3.list_multipart_uploads(Bucket=BUCKET).get("Uploads")
+    assert not os.listdir(temp_dir)
+
+
+def test_terminate_aborts_multipart_upload(env):
+    session_maker, s3, completed, temp_dir = env
+    data = os.urandom(PART + 10)
+
+    async def scenario():
+        upload_id = await _create(session_maker, 3 * PART)
+        await _send(session_maker, upload_id, data)
+        assert len(s3.list_multipart_uploads(Bucket=BUCKET)["Uploads"]) == 1
+        async with session_maker() as db:
+            await uploads.terminate(db, await uploads.load_session(db, upload_id))
+        return upload_id
+
+    upload_id = asyncio.run(scenario())
+    assert upload_id not in completed
+    assert not s3.list_multipart_uploads(Bucket=BUCKET).get("Uploads")
+    assert not s3.list_objects_v2(Bucket=BUCKET).get("Contents")
+    assert not os.listdir(temp_dir)